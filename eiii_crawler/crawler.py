@@ -5,6 +5,7 @@
 import sys, os
 import Queue
 import robocop
+import sitemap
 import urlparse
 import signal
 import re
@@ -15,9 +16,10 @@ import collections
 import sgmllib
 import uuid
 import sqlite3
-import cPickle
+import json
 import socket
 import multiprocessing
+import threading
 import marshal
 import signal
 import gc
@@ -27,9 +29,16 @@ import mimetypes
 import imp
 
 from eiii_crawler import crawlerbase
-from eiii_crawler.crawlerevent import CrawlerEventRegistry, subscribe
+from eiii_crawler import crawlercontext
+from eiii_crawler.crawlerevent import CrawlerEventRegistry, subscribe, subscribe_module
 from eiii_crawler.crawlerscoping import CrawlPolicy, CrawlerLimitRules, CrawlerScopingRules
 from eiii_crawler.crawlerstats import CrawlerStats
+from eiii_crawler.crawlertiming import CrawlerTimings
+from eiii_crawler.crawlerprofiler import CrawlerProfiler
+from eiii_crawler.crawlertransport import CrawlerTransport
+from eiii_crawler.warcwriter import WarcWriter
+from eiii_crawler.crawlerpages import PageStore
+from eiii_crawler.urlindex import URLIndex, URLSet, URLPairSet, URLGraph
 from eiii_crawler import urlhelper
 from eiii_crawler import utils
 
@@ -65,8 +74,10 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
     def __init__(self, config, manager):
         self.manager = manager
         self.stop_now = False
-        # Robots parser
-        self.robots_p = robocop.Robocop(useragent=config.get_real_useragent())
+        # Robots parser - robots.txt files are cached for all workers
+        self.robots_p = robocop.Robocop(useragent=config.get_real_useragent(),
+                                        ttl=config.time_robots_ttl,
+                                        cache=robocop.RobotsCache.getInstance(config.robotsdir))
         # Event registry
         self.eventr = CrawlerEventRegistry.getInstance()
         super(EIIICrawlerQueuedWorker,  self).__init__(config)
@@ -99,7 +110,36 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
         """ Make an instance of the URL data class
         which fetches the URL """
 
-        return urldata.CachingUrlData(url, parent_url, content_type, self.config)
+        urlobj = urldata.CachingUrlData(url, parent_url, content_type, self.config)
+        # Last modified time of the URL in sitemaps if any
+        urlobj.lastmod = self.manager.lastmod_hints.get(url)
+        return urlobj
+
+    def reuse_children(self, url, urlobj):
+        """ Return (URL, child URLs) of an unchanged URL as parsed by
+        an earlier crawl, or None if the content is to be parsed """
+
+        # Near duplicates of pages already crawled give nothing new
+        if urlobj.near_duplicate:
+            log.debug("URL",url,"is a near duplicate, not parsing it")
+            return (url, [])
+        
+        # Only for URLs found unchanged in the cache
+        if not (self.config.flag_incremental and urlobj.from_cache):
+            return None
+
+        # Child URLs as parsed - not only the ones in the
+        # URL graph - so filtered and failed ones are seen again.
+        reused = urlobj.read_children()
+        if reused != None:
+            log.debug("URL",url,"is unchanged, reusing",len(reused[1]),"child URLs of last crawl")
+        return reused
+
+    def save_children(self, url, urlobj, child_urls):
+        """ Save the child URLs got by parsing the content of a URL
+        for reuse by later crawls """
+
+        urlobj.write_children(url, child_urls)
 
     def build_url(self, child_url, parent_url):
         """ Build the complete URL for child URL using the parent URL """
@@ -130,7 +170,7 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
         # NOTE that this might cause scope issues if
         # crawl is in folder scope.
 
-        if self.config.flag_supplement_urls:
+        if self.settings.flag_supplement_urls:
             dir_url = urlhelper.get_url_parent_directory(url)
             if dir_url:
                 return [dir_url]
@@ -140,12 +180,17 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
     def _parse(self, data, url):
         """ Parse the HTML and return child URLs """
 
+        timings = CrawlerTimings.getInstance()
         # Fix for issue #449 - Use Super parser
         parser = urlhelper.SuperHTMLParser()
         # Remove content between '<noscript>...</noscript>' tags
+        t = time.time()
         data = utils.clean_noscript(data)
+        timings.record('noscript', time.time() - t, url)
         log.info("Parsing URL", url)
+        t = time.time()
         parser.feed(data)
+        timings.record('html_parse', time.time() - t, url)
         
         self.eventr.publish(self, 'url_parsed',
                             params=locals())
@@ -171,10 +216,15 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
         urls, redirect = [], False
         
         # First parse with JS parser
-        if self.config.flag_jsredirects:
+        if self.settings.flag_jsredirects:
             try:
-                jsp = jsparser.JSParser()
-                jsp.parse(data)
+                # Parser is re-used for all pages of this thread
+                jsp = jsparser.get_parser()
+                t = time.time()
+                try:
+                    jsp.parse(data)
+                finally:
+                    CrawlerTimings.getInstance().record('js_parse', time.time() - t, url)
                 # Check if location changed
                 if jsp.location_changed:
                     jsurl = jsp.getLocation().href
@@ -218,10 +268,21 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
         # NOTE: This is a wrapper over the actual function _allowed which does all
         # the work. This is to allow publication of events after capturing the return
         # value of the method.
+        t = time.time()
+        # Set by _allowed if robots.txt rules are checked
+        self.robots_time = 0.0
         result = self._allowed(url, parent_url=parent_url, content=content,
                                content_type=content_type, headers=headers,
                                parse=parse, download=download)
 
+        # Checks of child URLs are admission, others are rules. Filtered
+        # URLs - mostly links to other sites - make no histograms of hosts.
+        stage = 'rules' if (parse or download or parent_url == None) else 'admission'
+        timings = CrawlerTimings.getInstance()
+        timings.record(stage, time.time() - t - self.robots_time, url, add_host=bool(result))
+        if self.robots_time:
+            timings.record('robots', self.robots_time, url, add_host=bool(result))
+
         if not result:
             # Filtered
             # This is a StatusMessage object
@@ -236,6 +297,7 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
                  parse=False, download=False):
         """ Is fetching of URL allowed ? - Actual Implementation """                
 
+        settings = self.settings
         # import pdb; pdb.set_trace()
         # Is already downloaded ? Then skip right away
         # NOTE - Do this only for child URLs!
@@ -245,12 +307,12 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
         if (parse) and content_type not in ('text/html','text/xhtml','application/xml','application/xhtml+xml'):
             return utils.StatusMessage(False, "Skipping URL for parsing as mime-type is not (X)HTML or XML", type='mime-type')
         
-        if content_type not in self.config.client_mimetypes + self.config.client_extended_mimetypes:
+        if content_type not in settings.client_valid_mimetypes:
             return utils.StatusMessage(False, 'Skipping URL ' + url + ' as content-type ' + content_type + ' is not valid.',
                                        type='content-type')
 
         # Part of client mime-types, check if part of fake mime-types
-        elif content_type in self.config.client_cheat_mimetypes and download:
+        elif content_type in settings.client_cheat_mimetypes and download:
            # Simulate download event for this URL so it gets added to URL graph
            # Publish cheat download complete event          
            self.eventr.publish(self, 'download_complete_cheat',
@@ -315,20 +377,24 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
             return self.check_content_rules(url, parent_url, content, content_type, headers)
 
         # Check robots.txt
-        if not self.flag_ignorerobots:
-            status, msg = self.robots_p.parse_site(url)
-            if not status:
-                log.error("Error fetching/parsing robots.txt rules for",url,": robots.txt would be ignored")
-                log.error("\t=>",msg)
-                # Don't bother to check as now robots.txt rules don't apply
-                return utils.StatusMessage(True, 'Error fetching/parsing robots.txt rules for "%s" robots.txt would be ignored' % url,
-                                           type='robots', subtype='robots.txt')
-            
-            # NOTE: Don't check meta NOW since content of URL has not been downloaded yet.
-            if not self.robots_p.can_fetch(url, content=content, meta=False):
-                log.extra('Robots.txt rules disallows URL =>',url)
-                return utils.StatusMessage(False, 'Robots.txt rules disallows URL %s' % url,
-                                           type='robots', subtype='robots.txt')                
+        if not settings.flag_ignorerobots:
+            t = time.time()
+            try:
+                status, msg = self.robots_p.parse_site(url)
+                if not status:
+                    log.error("Error fetching/parsing robots.txt rules for",url,": robots.txt would be ignored")
+                    log.error("\t=>",msg)
+                    # Don't bother to check as now robots.txt rules don't apply
+                    return utils.StatusMessage(True, 'Error fetching/parsing robots.txt rules for "%s" robots.txt would be ignored' % url,
+                                               type='robots', subtype='robots.txt')
+
+                # NOTE: Don't check meta NOW since content of URL has not been downloaded yet.
+                if not self.robots_p.can_fetch(url, content=content, meta=False):
+                    log.extra('Robots.txt rules disallows URL =>',url)
+                    return utils.StatusMessage(False, 'Robots.txt rules disallows URL %s' % url,
+                                               type='robots', subtype='robots.txt')
+            finally:
+                self.robots_time = time.time() - t
 
         return utils.StatusMessage(True, 'Default allowed')
 
@@ -342,7 +408,9 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
         # whether content can be indexed or followed AFTER downloading the
         # content.
 
-        if self.flag_metarobots:
+        settings = self.settings
+
+        if settings.flag_metarobots:
             index, follow = self.robots_p.check_meta(url, content=content)
             # Don't bother too much with NO index, but bother with NOFOLLOW
             if not follow:
@@ -350,7 +418,7 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
                 return utils.StatusMessage(False, 'META robots rules disallows URL "%s"' % url,
                                            type='robots', subtype='meta-robots')              
 
-        if self.flag_x_robots:
+        if settings.flag_x_robots:
             index, follow = self.robots_p.x_robots_check(url, headers=headers)
             # Don't bother too much with NO index, but bother with NOFOLLOW
             if not follow:
@@ -364,28 +432,44 @@ class EIIICrawlerQueuedWorker(threaded.ThreadedWorkerBase):
 class EIIICrawlerStats(CrawlerStats):
     """ EIII crawler stats class """
 
+    # Counters published as deltas in result fragments
+    counter_keys = ('num_urls', 'num_urls_downloaded', 'num_urls_skipped',
+                    'num_urls_error', 'num_urls_notfound', 'num_urls_cache')
+    # Attributes which are not in the stats dictionary as they are
+    internal_keys = ('config', 'url_index', 'timings', '_journal', '_journal_lock', '_published',
+                     'urls_a', 'urls_ag', 'urls_f', 'urls_fd', 'urls_d', 'urls_e',
+                     'url_graph', 'ext_url_graph')
+    
     def __init__(self, config):
         super(EIIICrawlerStats, self).__init__()
         self.config = config
 
     def reset(self):
         super(EIIICrawlerStats, self).reset()
+        # Every URL is kept once here, the sets and graphs
+        # below keep integer ids of URLs.
+        self.url_index = URLIndex()
         # URLs downloaded 
-        self.urls_d = set()
+        self.urls_d = URLSet(self.url_index)
         # URLs filtered
-        self.urls_f = set()
+        self.urls_f = URLSet(self.url_index)
         # Dynamic URLs filtered
         self.urls_fd = collections.defaultdict(list)
         # All URLs
-        self.urls_a = set()
+        self.urls_a = URLSet(self.url_index)
         # All URLs with children graph
         self.urls_ag = collections.defaultdict(list)
         # URLs with error
-        self.urls_e = set()
+        self.urls_e = URLPairSet(self.url_index)
         # URL graph
-        self.url_graph = collections.defaultdict(set)
+        self.url_graph = URLGraph(self.url_index)
         # External URL graph
-        self.ext_url_graph = collections.defaultdict(set)
+        self.ext_url_graph = URLGraph(self.url_index)
+        # URL graph entries not yet published in a result fragment
+        self._journal = []
+        self._journal_lock = threading.Lock()
+        # Counter values published in result fragments
+        self._published = {}
         
     def update_total_urls_downloaded(self, event):
         """ Update total number of URLs downloaded """
@@ -405,7 +489,7 @@ class EIIICrawlerStats(CrawlerStats):
         # If this is an external URL, log it to the external URL graph if config option is enabled.
         if self.config.flag_ext_url_graph and error_msg.scope == 1:
             # print 'EXTERNAL URL:',url,'<=>',parent_url
-            self.ext_url_graph[parent_url].add((url, event.params.get('content_type')))
+            self.ext_url_graph.add(parent_url, url, event.params.get('content_type'))
             
         self.urls_f.add(url)
         
@@ -439,8 +523,8 @@ class EIIICrawlerStats(CrawlerStats):
 
         super(EIIICrawlerStats, self).update_total_urls_error(event)
         # The error URLs entry is a tuple of (url, parent_url)
-        self.urls_e.add((event.params.get('url'),
-                         event.params.get('parent_url')))
+        self.urls_e.add(event.params.get('url'),
+                        event.params.get('parent_url'))
 
     def update_url_download(self, parent_url, url, content_type):
         """ Update URL download information """
@@ -456,14 +540,41 @@ class EIIICrawlerStats(CrawlerStats):
             if url_sans_www[-1] == '/':
                 url_sans_www = url_sans_www[:-1]               
 
-            entry = self.url_graph[parent_url]
-            present = ((url, content_type) in entry) or ((url_sans_www, content_type) in entry)
+            graph = self.url_graph
+            present = graph.has(parent_url, url, content_type) or graph.has(parent_url, url_sans_www, content_type)
 
             if not present:
-                self.url_graph[parent_url].add((url, content_type))
+                graph.add(parent_url, url, content_type)
+                if self.config.flag_stream_results:
+                    with self._journal_lock:
+                        self._journal.append((parent_url, url, content_type))
         else:
             # Child itself is the parent - i.e top level URL, add empty children
-            self.url_graph[url] = set()         
+            self.url_graph.reset(url)
+            if self.config.flag_stream_results:
+                with self._journal_lock:
+                    self._journal.append((url, None, None))
+
+    def get_fragment(self):
+        """ Return the URL graph entries and the changes to the
+        counters since the last fragment was returned """
+
+        with self._journal_lock:
+            journal, self._journal = self._journal, []
+
+        graph = {}
+        for parent_url, url, content_type in journal:
+            children = graph.setdefault(utils.safedata(parent_url), [])
+            if url != None:
+                children.append((utils.safedata(url), content_type))
+
+        deltas = {}
+        for key in self.counter_keys:
+            value = getattr(self, key)
+            deltas[key] = value - self._published.get(key, 0)
+            self._published[key] = value
+
+        return {'graph': graph, 'stats': deltas}
 
     def normalize(self, entries):
         """ Normalize the URLs in the URL graph. This drops duplicate URLs
@@ -508,8 +619,9 @@ class EIIICrawlerStats(CrawlerStats):
 
         return entries_fixed
 
-    def clean_url_graph(self, url_graph):
-        """ Clean the URL graph for writing it as JSON """
+    def clean_url_graph(self, url_graph, safe=utils.safedata):
+        """ Clean the URL graph for writing it as JSON. URLs are
+        made safe with the function safe """
 
         graph = {}
         
@@ -533,15 +645,13 @@ class EIIICrawlerStats(CrawlerStats):
             urlbucket[url_entry] = 1
             entries = graph[parent_url]
             
-            # Child URLs
-            entries = list(entries)
             # Make URLs safe
-            entries_safe =  [(utils.safedata(url), ctype) for url, ctype in entries]
+            entries_safe =  [(safe(url), ctype) for url, ctype in entries]
             # Fix wrong content-type for "text" types.
             entries_safe = self.normalize(entries_safe)
             
             # Make entry safe
-            parent_url_safe = utils.safedata(parent_url)
+            parent_url_safe = safe(parent_url)
             if parent_url_safe != parent_url:
                 # Delete original key
                 del graph[parent_url]
@@ -551,37 +661,44 @@ class EIIICrawlerStats(CrawlerStats):
 
         return graph
             
-    def get_stats_dict(self):
-        """ Get stats dictionary. """
-
-        statsdict = self.__dict__.copy()
-
-        mapping = {'urls_a': 'urls_all',
-                   'urls_ag': 'urls_ag',
-                   'urls_f': 'urls_filtered',
-                   'urls_fd': 'urls_dynamic_filtered',
-                   'urls_d': 'urls_downloaded',
-                   'urls_e': 'urls_error'}
+    def iter_stats(self):
+        """ Yield (key, value) sections of the stats dictionary one
+        after another. Each section is made from the URL sets and graphs
+        only when it is reached, so that a writer can be done with it
+        before the next one is made. """
+
+        self.update_times()
+        # Counters and times
+        for key, val in self.__dict__.items():
+            if key not in self.internal_keys:
+                yield key, (str(val) if type(val) is datetime.datetime else val)
+                
+        # Histograms of time taken by stages of the crawl
+        yield 'timings', self.timings.get_dict()
 
-        # Create another graph for external URLs - Issue #456
+        # Every URL is made safe once, though it is in many
+        # of the sets and graphs.
+        safe_urls = {None: None}
+        def safe(url):
+            try:
+                return safe_urls[url]
+            except KeyError:
+                val = safe_urls[url] = utils.safedata(url)
+                return val
         
-        # print 'URLS_E=>',statsdict['urls_e']
+        # Create another graph for external URLs - Issue #456
+
         # Convert sets to list
-        for key in ('urls_f', 'urls_e','urls_d','urls_a'):
-            # Make all URL data safe
-            entries = list(statsdict[key])
-            if key == 'urls_e':
-                entries_safe = [map(lambda x: utils.safedata(x), item) for item in entries]
-            else:
-                entries_safe = map(utils.safedata, entries)
-            
-            statsdict[mapping.get(key)] = entries_safe
-            # Drop original key
-            del statsdict[key]
+        yield 'urls_all', map(safe, self.urls_a)
+        yield 'urls_filtered', map(safe, self.urls_f)
+        yield 'urls_downloaded', map(safe, self.urls_d)
+        # The error URLs entries are [url, parent_url]
+        yield 'urls_error', [map(safe, item) for item in self.urls_e]
 
-        statsdict['urls_audio_visual'] = {}
+        yield 'urls_ag', dict(self.urls_ag)
+        urls_audio_visual = {}
         
-        for parent_url, curls in statsdict['urls_ag'].items():
+        for parent_url, curls in self.urls_ag.items():
             av = []
             for url in curls:
                 ctype = mimetypes.guess_type(url)
@@ -591,36 +708,24 @@ class EIIICrawlerStats(CrawlerStats):
 
             if len(av):
                 # This is an A/V URL
-                statsdict['urls_audio_visual'][parent_url] = av
+                urls_audio_visual[parent_url] = av
 
-        # Dictionary items
-        for key in ('urls_fd',):
-            entries = statsdict[key]
-            entries_safe = {}
-            
-            for regex, urls in entries.items():
-                urls_safe = map(utils.safedata, urls)
-                entries_safe[regex] = urls_safe
+        yield 'urls_audio_visual', urls_audio_visual
 
-            statsdict[mapping.get(key)] = entries_safe
+        # Dictionary items
+        yield 'urls_fd', dict(self.urls_fd)
+        yield 'urls_dynamic_filtered', dict((regex, map(safe, urls)) for regex, urls in self.urls_fd.items())
 
         # Process URL graph - make a copy as we will be modifying it.
         # Fix for issue #454 - convert everything into lists when copying from
         # original graph.
-        graph, ext_graph = map(self.clean_url_graph, (self.url_graph, self.ext_url_graph))
-        # Dump the graph
-        # marshal.dump(graph, open('urlgraph.dump','wb'))
-        statsdict['url_graph'] = graph
-        statsdict['ext_url_graph'] = ext_graph
-        
-        # delete copy
-        del statsdict['config']
-
-        for key,val in statsdict.items():
-            if type(val) is datetime.datetime:
-                statsdict[key] = str(val)
-            
-        return statsdict
+        yield 'url_graph', self.clean_url_graph(self.url_graph.to_dict(), safe)
+        yield 'ext_url_graph', self.clean_url_graph(self.ext_url_graph.to_dict(), safe)
+        
+    def get_stats_dict(self):
+        """ Get stats dictionary. """
+
+        return dict(self.iter_stats())
 
     def get_json(self):
         """ Get stats JSON """
@@ -628,30 +733,62 @@ class EIIICrawlerStats(CrawlerStats):
         encoder = utils.MyEncoder()
         # Indent by 4 spaces
         encoder.indent = 4
-
-        sdict = self.get_stats_dict()
-        # Pickle it
-        cPickle.dump(sdict, open('stats.dump','wb'))
         
-        # This is a string - eval it and convert to JSON object
-        return encoder.encode(sdict)
+        return encoder.encode(self.get_stats_dict())
+
+    def write_json(self, sections, statspath):
+        """ Write (key, value) sections of the stats dictionary as a
+        JSON object to statspath, each section as soon as it comes """
+
+        encoder = utils.MyEncoder()
+        # Indent by 4 spaces
+        encoder.indent = 4
+
+        with open(statspath, 'w') as f:
+            sep = '{\n    '
+            for key, val in sections:
+                f.write(sep + encoder.encode(key) + ': ')
+                # Values are one level down - JSON strings have
+                # no raw newlines, so only indentation is changed
+                for chunk in encoder.iterencode(val):
+                    f.write(chunk.replace('\n', '\n    '))
+                sep = ',\n    '
+            f.write('{}' if sep[0] == '{' else '\n}')
     
-    def publish_stats(self):
-        """ Publish stats """
+    def publish_stats(self, keep=True):
+        """ Publish stats and return the stats dictionary. If keep
+        is False the sections of the stats are dropped once written
+        and None is returned """
         
         super(EIIICrawlerStats, self).publish_stats()
         # Filtered - downloaded
         # Write stats.json
         statspath = os.path.expanduser(os.path.join(self.config.statsdir, self.config._task_id + '.json'))
+        # The binary stats need all of it
+        keep = keep or self.config.flag_stats_binary
+        sdict = {} if keep else None
+
+        def sections():
+            for key, val in self.iter_stats():
+                if keep: sdict[key] = val
+                yield key, val
 
         try:
             # import pdb; pdb.set_trace()
-            json_data = self.get_json()
-            open(statspath,'w').write(json_data)
+            self.write_json(sections(), statspath)
             log.info("Stats written to",statspath)
         except Exception, e:
             raise
             log.error("Error writing stats JSON", str(e))           
+
+        if self.config.flag_stats_binary:
+            # Same data in marshal format - faster to load for tools
+            binpath = os.path.splitext(statspath)[0] + '.marshal'
+            try:
+                marshal.dump(sdict, open(binpath, 'wb'))
+                log.info("Binary stats written to",binpath)
+            except (IOError, ValueError), e:
+                log.error("Error writing binary stats", str(e))
         
         try:
             dbpath = os.path.expanduser(os.path.join(self.config.configdir, 'config.db'))
@@ -668,13 +805,19 @@ class EIIICrawlerStats(CrawlerStats):
             log.error("Error writing to crawls db", str(e))
         except UnicodeDecodeError, e:
             pass
+
+        return sdict
         
 class EIIICrawler(multiprocessing.Process):
     """ EIII Web Crawler """
 
     def __init__(self, urls=[], cfgfile='config.json', fromdict={},
-                 args=None, task_queue=None, value_dict=None, state=None):
+                 args=None, task_queue=None, value_dict=None, state=None, slot=0,
+                 ncrawls=1, metrics=None):
 
+        # Config file name - kept for making crawlers for
+        # concurrent crawls
+        self.cfgfile = cfgfile
         # Load config from file.
         cfgfile = self.load_config(fname=cfgfile)
         if cfgfile:
@@ -707,6 +850,16 @@ class EIIICrawler(multiprocessing.Process):
         self.value_dict = value_dict
         # Shared state between server and the crawler
         self.state = state
+        # Index of this crawler in the shared state
+        self.slot = slot
+        # Live metrics shared with the server (CrawlerMetrics)
+        self.metrics = metrics
+        # Number of crawls run concurrently by this process
+        # when used from the crawler server
+        self.ncrawls = ncrawls
+        
+        # Log files are shared by all crawls of the process
+        log.setAsync(self.config.flag_log_async)
         
         # Crawler ID
         self.id = 'Crawler-' + str(uuid.uuid1())
@@ -722,7 +875,7 @@ class EIIICrawler(multiprocessing.Process):
         
         if len(urls):
             self.task_logfile = utils.get_logfilename(task_id, urls, self.config)
-            log.addLogFile(self.task_logfile)
+            log.setTaskLogFile(self.task_logfile)
             log.info("Log file for this crawl can be found at", os.path.abspath(self.task_logfile))
         
         # Prepare config
@@ -775,10 +928,26 @@ class EIIICrawler(multiprocessing.Process):
         # or exception indicating to stop crawl
         # this cant be overridden
         self.red_flag = False
+        # Whether the crawl is paused by the server - set
+        # by the first worker finding it paused
+        self.paused = False
+        self.pause_lock = threading.Lock()
         # Indicates crawler is busy
         self.busy = False
         # Server flag - used by the Crawler server only
         self.server_flag = True
+        # Sequence number of next result fragment
+        self.fragment_seq = 0
+        # Last modified times of URLs given by sitemaps
+        self.lastmod_hints = {}
+        # Thread reading sitemaps
+        self.sitemap_thread = None
+        # Sampling profiler if profiling
+        self.profiler = None
+        # WARC writer if writing WARC files
+        self.warc = None
+        # Store of pages if keeping pages for clients
+        self.pages = None
         # Crawl failure message - when the starting URL
         # doesn't take off
         self.fatal_msg = { 'msg': '',
@@ -789,6 +958,8 @@ class EIIICrawler(multiprocessing.Process):
         self.stats.reset()
         self.limit_checker.reset()
         self.eventr.reset()
+        # Network or record/replay
+        CrawlerTransport.getInstance().configure(self.config)
 
         log.reset()
         
@@ -810,10 +981,17 @@ class EIIICrawler(multiprocessing.Process):
         """ Load plugin modules which are enabled in the configuration """
 
         for plugin in self.config.plugins:
-            print 'Loading plugin',plugin,'...'
-            # mod = getattr(eiii_plugins, plugin)
-            m = imp.find_module(plugin, eiii_plugins.__path__)
-            mod = imp.load_module(plugin, *m)
+            mod = sys.modules.get(plugin)
+            if mod == None:
+                print 'Loading plugin',plugin,'...'
+                # mod = getattr(eiii_plugins, plugin)
+                m = imp.find_module(plugin, eiii_plugins.__path__)
+                mod = imp.load_module(plugin, *m)
+            else:
+                # Plugins are loaded once per process, subscribe
+                # them to the events of this crawl.
+                subscribe_module(mod)
+                
             # If module defines a setup function, call it
             try:
                 setup = getattr(mod, 'set_config')
@@ -845,7 +1023,7 @@ class EIIICrawler(multiprocessing.Process):
         """ Return the URL graph showing the tree of
         URLs crawled """
 
-        return self.stats.url_graph
+        return self.stats.url_graph.to_dict()
     
     def prepare_config(self):
         """ Prepare steps if any for config object """
@@ -887,6 +1065,12 @@ class EIIICrawler(multiprocessing.Process):
         self.config._url_dynamic_exclude_rules = []
         self.config._dynamic_rules_stats = collections.defaultdict(int)
 
+        # Fragments are taken only by the crawler server - else
+        # the journal of graph entries would only grow.
+        if self.value_dict == None and self.config.flag_stream_results:
+            log.info("Not streaming results, since the crawl is not run by the crawler server.")
+            self.config.flag_stream_results = False
+
         return True
     
     def sighandler(self, signum, stack):
@@ -925,6 +1109,12 @@ class EIIICrawler(multiprocessing.Process):
         self.eventr.subscribe('worker_threw_exception', self.replace_worker)
         self.eventr.subscribe('url_filtered', self.url_filtered)
         self.eventr.subscribe('url_not_allowed', self.url_filtered)     
+        self.eventr.subscribe('download_complete', self.url_download_warc)
+        self.eventr.subscribe('download_error', self.url_download_warc)
+        self.eventr.subscribe('download_complete', self.url_download_retain)
+        self.eventr.subscribe('download_cache', self.url_download_retain)
+        if self.metrics != None:
+            self.metrics.subscribe(self.eventr, self.slot)
 
     def check_idna_domains(self):
         """ Check if the URL domains are IDNA neutral, if not
@@ -955,8 +1145,34 @@ class EIIICrawler(multiprocessing.Process):
     def get(self):
         """ Return the data for crawling """
 
+        self.wait_paused()
         return self.dqueue.get()
 
+    def wait_paused(self):
+        """ Wait while the crawler server has paused this crawl
+        for running a higher priority one """
+
+        if not hasattr(self.value_dict, 'is_paused'):
+            return
+
+        task_id = self.config._task_id
+        if self.value_dict.is_paused(task_id):
+            # Workers all wait, but the pause is published once
+            with self.pause_lock:
+                if not self.paused:
+                    self.paused = True
+                    log.info('Crawl',task_id,'paused by server.')
+                    self.eventr.publish(self, 'crawl_paused')
+                
+            while self.value_dict.is_paused(task_id) and not self.red_flag:
+                time.sleep(1.0)
+
+            with self.pause_lock:
+                if self.paused:
+                    self.paused = False
+                    log.info('Crawl',task_id,'resumed.')
+                    self.eventr.publish(self, 'crawl_resumed')
+
     def put(self, content_type, url, parent_url=None, key=None):
         """ Push further data to be crawled """
 
@@ -1009,7 +1225,9 @@ class EIIICrawler(multiprocessing.Process):
         # print '====> WORKERS IDLE:',self.workers_idle()
         # print '====> EMPTY:',self.is_empty()
         
-        return (not self.red_flag) and not (self.workers_idle() and self.is_empty())
+        # Sitemaps being read may give more work
+        seeding = (self.sitemap_thread != None) and self.sitemap_thread.isAlive()
+        return (not self.red_flag) and not (self.workers_idle() and self.is_empty() and not seeding)
     
     def check_already_downloaded(self, url):
         """ Is a URL already downloaded """
@@ -1089,6 +1307,30 @@ class EIIICrawler(multiprocessing.Process):
 
         self.stats.update_url_download(parent_url, url, content_type)
                         
+    def url_download_warc(self, event):
+        """ Event callback for writing a downloaded URL to WARC files """
+
+        params = event.params
+        # Not for URLs from cache, HEAD requests and network errors
+        if self.warc == None or params.get('status_code') == None:
+            return
+
+        self.warc.write(params['url'], params['status_code'], params['reason'],
+                        params['headers'], params['content'], params['request_headers'])
+        
+    def url_download_retain(self, event):
+        """ Event callback for keeping a downloaded page for clients """
+
+        params = event.params
+        if self.pages == None or not params.get('content'):
+            return
+
+        from_cache = params.get('from_cache', False)
+        # Pages from cache were fine when cached
+        status_code = 200 if from_cache else params.get('status_code', event.code)
+        self.pages.add(params['url'], params.get('content_type'), status_code,
+                       dict(params.get('headers', {})), params['content'], from_cache)
+        
     def url_download_error(self, event):
         """ Event callback for notifying download for a URL in error """
 
@@ -1166,6 +1408,41 @@ class EIIICrawler(multiprocessing.Process):
         # Issue #426 - turn off global crawl.log for server crawls
         log.removeLogFile(utils.get_crawl_log())
         log.debug("Starting Crawler Process =>", self.id)
+
+        if self.ncrawls > 1:
+            # Run crawls concurrently, each in its own thread
+            # and crawl context
+            threads = []
+            for i in range(self.ncrawls):
+                t = threading.Thread(target=self.serve_context, args=(i,),
+                                     name='%s-%d' % (self.id, i))
+                t.setDaemon(True)
+                threads.append(t)
+                t.start()
+
+            for t in threads:
+                # Join with a timeout so that signals get handled
+                while t.isAlive():
+                    t.join(1.0)
+        else:
+            self.serve()
+
+    def serve_context(self, index):
+        """ Serve crawl tasks from the server in a new crawl context """
+
+        with crawlercontext.CrawlContext(name='%s-%d' % (self.id, index)):
+            # Config, events, stats and limits of this crawler are
+            # of this context
+            crawler = self.__class__(cfgfile=self.cfgfile,
+                                     task_queue=self.taskq,
+                                     value_dict=self.value_dict,
+                                     state=self.state,
+                                     slot=self.slot,
+                                     metrics=self.metrics)
+            crawler.serve()
+
+    def serve(self):
+        """ Serve crawl tasks from the server one after the other """
         
         while self.server_flag:
             log.info(self.id,"=> waiting on task queue from server ...")
@@ -1184,13 +1461,16 @@ class EIIICrawler(multiprocessing.Process):
             log.info('Setting log level to' , loglevel)
             log.setLevel(loglevel)
             
-            # Set state to busy
-            self.state[self.id] = 1
+            # Increment busy crawls
+            with self.state.get_lock():
+                self.state[self.slot] += 1
+                
             self.crawl_using(urls, configdict)
             self.wait_crawl()
 
-            # Set state to idling
-            self.state[self.id] = 0
+            # Decrement busy crawls
+            with self.state.get_lock():
+                self.state[self.slot] -= 1
             log.debug("Crawler",self.id,"done crawl",self.server_flag)
             
     def crawl_using(self, urls, fromdict):
@@ -1210,9 +1490,9 @@ class EIIICrawler(multiprocessing.Process):
         # Task id
         task_id = self.config.__dict__.get('task_id',uuid.uuid4().hex)
         
-        # Add another crawl log file to the logger
+        # Log lines of this crawl go to its own log file also
         self.task_logfile = utils.get_logfilename(task_id, urls, self.config)
-        log.addLogFile(self.task_logfile)
+        log.setTaskLogFile(self.task_logfile)
         # log.info("Log file for this crawl can be found at", os.path.abspath(self.task_logfile))     
         
         # Insert task id
@@ -1251,9 +1531,36 @@ class EIIICrawler(multiprocessing.Process):
         for url in self.urls:
             self.dqueue.put(('text/html',url,None))
 
+        if self.config.flag_incremental:
+            self.seed_previous_graph()
+
+        if self.config.flag_sitemaps:
+            # Sitemaps are read while the crawl runs
+            self.sitemap_thread = threading.Thread(target=self.seed_sitemaps,
+                                                   args=(crawlercontext.get_context(),))
+            self.sitemap_thread.setDaemon(True)
+            self.sitemap_thread.start()
+
         # Mark start time
         self.eventr.publish(self, 'crawl_started')
 
+        if self.config.flag_profile:
+            self.profiler = CrawlerProfiler(self.get_worker_threads, self.config.profile_rate)
+            self.profiler.start()
+
+        if self.config.flag_warc:
+            self.warc = WarcWriter(self.config.warcdir, self.config._task_id,
+                                   max_size=self.config.warc_maxsize*1024*1024,
+                                   info={'software': 'EIII Web Crawler %s' % __version__,
+                                         'format': 'WARC File Format 1.0',
+                                         'isPartOf': self.config._task_id,
+                                         'description': ' '.join(self.urls)})
+            self.warc.start()
+
+        if self.config.flag_retain_pages:
+            self.pages = PageStore(self.config.pagesdir, self.config._task_id, self.config.pages_ttl)
+            self.pages.open()
+            
         nworkers = self.config.num_workers
         
         for i in range(nworkers):
@@ -1264,8 +1571,106 @@ class EIIICrawler(multiprocessing.Process):
             worker.start()
             # Give subsequent workers some time to start so that the other
             # workers fill in some data.
-            time.sleep(10*(nworkers - i))
+            time.sleep(self.config.time_worker_rampup*(nworkers - i))
+
+    def load_previous_graph(self):
+        """ Return the URL graph of the last crawl of the same URLs as a
+        dictionary mapping parent URLs to their child URLs and content-types """
+
+        dbpath = os.path.expanduser(os.path.join(self.config.configdir, 'config.db'))
+        url_string = ','.join(self.config._urls)
+        
+        try:
+            conn = sqlite3.connect(dbpath)
+            c = conn.cursor()
+            c.execute("""SELECT crawl_id, statspath FROM crawls WHERE urls=?
+            ORDER BY timestamp DESC""", (url_string,))
+            rows = c.fetchall()
+            conn.close()
+        except sqlite3.Error, e:
+            log.error("Error reading crawls db", str(e))
+            return {}
+
+        for crawl_id, statspath in rows:
+            if crawl_id == self.config._task_id: continue
+            
+            try:
+                url_graph = json.load(open(statspath)).get('url_graph', {})
+            except (IOError, ValueError, TypeError), e:
+                log.debug("Could not load stats of crawl",crawl_id,"=>",str(e))
+                continue
+
+            log.info("Incremental crawl using URL graph of crawl",crawl_id,"...")
+            return url_graph
+
+        log.info("No earlier crawl of",url_string,"found for incremental crawl.")
+        return {}
+    
+    def seed_previous_graph(self):
+        """ Push the URLs of the last crawl of the same URLs to the queue
+        so they are revalidated right from the start. Unchanged URLs
+        reuse their child URLs saved in the cache (see reuse_children) """
+
+        # Keys without trailing / - the graph stores child
+        # URLs without it
+        previous_graph = {}
+        for parent_url, children in self.load_previous_graph().items():
+            previous_graph[parent_url.rstrip('/')] = [child_url for child_url, ctype in children]
+            
+        # Push in breadth-first order from the start URLs, so every
+        # URL is pushed with its parent URL.
+        seen = set(url.rstrip('/') for url in self.urls)
+        queue = collections.deque(self.urls)
+        count = 0
+        
+        while queue:
+            parent_url = queue.popleft()
+            for child_url in previous_graph.get(parent_url.rstrip('/'), []):
+                if child_url.rstrip('/') in seen: continue
+                seen.add(child_url.rstrip('/'))
+                queue.append(child_url)
+                
+                if self.put(urlhelper.guess_content_type(child_url), child_url, parent_url, key=child_url):
+                    count += 1
+
+        log.info("Pushed",count,"URLs of last crawl to the queue.")
+
+    def seed_sitemaps(self, context):
+        """ Push the URLs listed in the sitemaps of the start URLs
+        to the queue along with their last modified times """
+
+        # Run in the crawl context of the crawl
+        crawlercontext.set_context(context)
+        
+        # Worker for checking the URLs against the crawl rules - not started
+        worker = self.make_worker()
+        maxurls = self.config.sitemap_maxurls or self.config.url_limits.get('text/html', 0)
+        reader = sitemap.SitemapReader(self.config, maxurls=maxurls)
+        count = 0
+        
+        for start_url in self.urls:
+            # Sitemaps from robots.txt, else the default location
+            sitemaps = worker.robots_p.get_sitemaps(start_url)
+            if not sitemaps:
+                sitemaps = [urlhelper.get_website(start_url, scheme=True) + '/sitemap.xml']
 
+            for url, lastmod in reader.iter_urls(sitemaps):
+                if self.red_flag: return
+                # Already pushed ?
+                if url in self.url_keys: continue
+
+                # Sitemap URLs are children of the start URL for scoping
+                content_type = urlhelper.guess_content_type(url)
+                if not worker.allowed(url, parent_url=start_url, content_type=content_type):
+                    continue
+
+                if lastmod != None:
+                    self.lastmod_hints[url] = lastmod
+                if self.put(content_type, url, start_url, key=url):
+                    count += 1
+
+        log.info("Pushed",count,"URLs from sitemaps to the queue.")
+        
     def wait_crawl(self):
         """ Waiting method used when crawler is run as a separate
         process through the EIII crawler server """
@@ -1273,29 +1678,128 @@ class EIIICrawler(multiprocessing.Process):
         # Wait for some time
         time.sleep(10)
 
-        count = 0
+        # URLs of this crawl in the frontier gauge
+        depth = 0
         while self.work_pending():
             time.sleep(5)
+            self.publish_fragment()
+            depth = self.update_frontier_metric(depth)
+            self.check_snapshot_request()
                 
+        self.update_frontier_metric(depth, 0)
         self.eventr.publish(self, 'crawl_ended')        
+        self.stop_profiler()
+        self.close_warc()
+        self.close_pages()
+        # Last fragment goes before the result
+        self.publish_fragment()
         log.info('Crawl done.')
 
         # print self.url_graph
-        self.stats.publish_stats()
+        # Stats written are the stats returned
+        stats_dict = self.stats.publish_stats()
         log.info("Log file for this crawl can be found at", os.path.abspath(self.task_logfile))
+        log.clearTaskLogFile()
         # log.info(utils.bye_message())
         
         # Get the graph
         url_graph = self.get_url_graph()
-        stats_dict = self.stats.get_stats_dict()
 
         self.value_dict[self.config._task_id] = {'stats': stats_dict,
                                                  'graph': url_graph,
-                                                 'error': self.fatal_msg}
+                                                 'error': self.fatal_msg,
+                                                 # Fragments published before
+                                                 'fragments': self.fragment_seq}
         # Force gc collection
         gc.set_debug(gc.DEBUG_STATS|gc.DEBUG_COLLECTABLE|gc.DEBUG_UNCOLLECTABLE)
         gc.collect()
 
+    def get_worker_threads(self):
+        """ Return thread ids of the workers """
+
+        return [w.ident for w in self.workers if w.ident != None]
+
+    def stop_profiler(self):
+        """ Stop profiling and write the collapsed stacks next to the stats """
+
+        if self.profiler == None:
+            return
+
+        self.profiler.stop()
+        self.profiler.write(os.path.expanduser(os.path.join(self.config.statsdir,
+                                                            self.config._task_id + '.folded')))
+        self.profiler = None
+
+    def close_warc(self):
+        """ Finish writing WARC files of the crawl """
+
+        if self.warc == None:
+            return
+
+        self.warc.close()
+        self.warc = None
+        
+    def close_pages(self):
+        """ Finish storing pages of the crawl - their time to live starts now """
+
+        if self.pages == None:
+            return
+
+        self.pages.close()
+        self.pages = None
+        
+    def check_snapshot_request(self, duration=2.0):
+        """ Send the server a profile snapshot of this crawl if it
+        asked for one. If the crawl is not being profiled, sample the
+        workers for duration seconds for the snapshot """
+
+        if not hasattr(self.value_dict, 'snapshot_requested'):
+            return
+
+        task_id = self.config._task_id
+        if not self.value_dict.snapshot_requested(task_id):
+            return
+
+        self.value_dict.cancel_snapshot(task_id)
+        profiler = self.profiler
+        if profiler == None:
+            profiler = CrawlerProfiler(self.get_worker_threads, self.config.profile_rate)
+            profiler.start()
+            time.sleep(duration)
+            profiler.stop()
+
+        log.info('Sending profile snapshot of',profiler.nsamples,'samples to server.')
+        self.value_dict[(task_id, 'profile')] = {'folded': profiler.get_folded(),
+                                                 'samples': profiler.nsamples,
+                                                 'rate': profiler.rate}
+        
+    def update_frontier_metric(self, depth, new_depth=None):
+        """ Update the frontier depth metric of this process from
+        the queue size of this crawl. Return the new queue size """
+
+        if new_depth == None:
+            new_depth = self.dqueue.qsize()
+        if self.metrics != None and new_depth != depth:
+            self.metrics.add(self.slot, 'frontier', new_depth - depth)
+
+        return new_depth
+    
+    def publish_fragment(self):
+        """ Publish URL graph entries and stats changes since the
+        last fragment to the server, if the crawl streams results.
+        Fragments are numbered from 0 and the server removes them
+        as the client fetches them """
+
+        if not self.config.flag_stream_results:
+            return
+
+        fragment = self.stats.get_fragment()
+        if len(fragment['graph'])==0 and not any(fragment['stats'].values()):
+            return
+
+        self.value_dict[(self.config._task_id, self.fragment_seq)] = fragment
+        self.fragment_seq += 1
+        
     def stop_server(self):
         """ Stop method used only by the Crawler Server to stop the crawl process """
 
@@ -1333,14 +1837,18 @@ class EIIICrawler(multiprocessing.Process):
         # [w.join() for w in self.workers]
         
         self.eventr.publish(self, 'crawl_ended')        
+        self.stop_profiler()
+        self.close_warc()
+        self.close_pages()
         log.info('Crawl done.')
 
         # Wait a bit
         time.sleep(2)
         
         # print self.url_graph
-        self.stats.publish_stats()
+        self.stats.publish_stats(keep=False)
         log.info("Log file for this crawl can be found at", os.path.abspath(self.task_logfile))
+        log.clearTaskLogFile()
 
     def quit(self):
         """ Clean-up and exit """
@@ -25,8 +25,8 @@ class ConfigOutdatedException(Exception):
 class CrawlerConfig(object):
     """ Configuration for the Crawler """
 
-    # This class is a Singleton
-    __metaclass__ = utils.SingletonMeta
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
     
     def __init__(self):
         # Site scope
@@ -45,6 +45,12 @@ class CrawlerConfig(object):
         # Times
         # Sleep times between crawls
         self.time_sleeptime = 1.0
+        # Maximum time in seconds for which a site's robots.txt
+        # is cached before fetching it again
+        self.time_robots_ttl = 86400
+        # Wait after starting a worker at crawl start, in seconds per
+        # worker yet to start - so that the first workers fill the queue
+        self.time_worker_rampup = 10
 
         # Boolean Flags
         # Randomize sleep ?
@@ -91,9 +97,44 @@ class CrawlerConfig(object):
         self.flag_ssl_validate = True
         # Log & write external URLs graph ?
         self.flag_ext_url_graph = True
+        # Publish fragments of the URL graph and stats while crawling ?
+        self.flag_stream_results = False
+        # Incremental crawl - start from the URL graph of the last
+        # crawl of the same URLs and reuse the child URLs parsed
+        # then for unchanged URLs ?
+        self.flag_incremental = False
+        # Seed the crawl with the URLs of the sitemaps of the site ?
+        self.flag_sitemaps = False
+        # Maximum number of URLs read from sitemaps - 0 means
+        # the URL limit of HTML
+        self.sitemap_maxurls = 0
+        # Write downloaded content to WARC files ?
+        self.flag_warc = False
+        # Maximum size of a WARC file in MB
+        self.warc_maxsize = 1024
+        # Keep the pages of the crawl for clients of the server ?
+        self.flag_retain_pages = False
+        # Seconds for which the pages are kept after the crawl
+        self.pages_ttl = 86400
+        # Profile the crawl by sampling stacks of workers ?
+        self.flag_profile = False
+        # Stack samples per second when profiling
+        self.profile_rate = 50
+        # Write log files from a writer thread, so that workers
+        # never wait for the disk when logging ?
+        self.flag_log_async = True
+        # Write stats in marshal format also, next to the JSON ?
+        self.flag_stats_binary = False
         
         # Network settings - Address of network proxy including port if any
         self.network_proxy = ''
+        # Folder of HTTP archive to record all requests of the crawl to
+        self.network_record = ''
+        # Folder of HTTP archive to replay all requests of the crawl
+        # from, instead of the network
+        self.network_replay = ''
+        # Factor of recorded times to sleep when replaying - 0 for none
+        self.network_timescale = 1.0
 
         # Client settings
         self.client_useragent = 'EIII Web Crawler v1.0 - http://www.eiii.eu'
@@ -156,6 +197,12 @@ class CrawlerConfig(object):
         self.storedir = os.path.join(self.configdir, 'store')
         # Stats folder
         self.statsdir = os.path.join(self.configdir, 'stats')
+        # Robots.txt cache folder
+        self.robotsdir = os.path.join(self.configdir, 'robots')
+        # WARC files folder
+        self.warcdir = os.path.join(self.configdir, 'warc')
+        # Folder of pages kept for clients of the server
+        self.pagesdir = os.path.join(self.configdir, 'pages')
         # Additional filtering rules if any in the form of a list like
         # [('+', include_rule_regex), ('-', exclude_rule_regex)] tried
         # in that order.
@@ -202,7 +249,12 @@ class CrawlerConfig(object):
         # Plugin configuration
         self.plugin_conf = {'circuitbreaker': {'threshold': 20,
                                                'min_hits': 10,
-                                               'url_patterns': []}}
+                                               'url_patterns': [],
+                                               'max_patterns': 5000},
+                            'nearduplicate': {'max_distance': 3,
+                                              'min_words': 50,
+                                              'min_hits': 10,
+                                              'threshold': 50}}
 
     def update(self, configdict):
         """ Update configuration from another dictionary """
@@ -236,7 +288,13 @@ class CrawlerConfig(object):
 
         fpath = os.path.expanduser(os.path.join(self.configdir, 'config.json'))
         return self.save(fpath)
-    
+
+    def snapshot(self):
+        """ Return an immutable snapshot of the settings used
+        by the crawl workers in their per-URL loop """
+
+        return CrawlerSettings(self)
+
     @classmethod
     def fromfile(cls, filename):
         """ Create config by loading data from a JSON file """
@@ -256,7 +314,41 @@ class CrawlerConfig(object):
         # Set value
         cfg.__dict__ = config
         return cfg
-        
+
+class CrawlerSettings(object):
+    """ Read-only snapshot of the effective crawl settings taken at
+    crawl start. Workers look up these on every URL, so this is a slotted
+    object whose attribute access doesn't go through the config
+    __dict__ or any fallback. Rules that change during the crawl
+    (dynamic exclusion rules for example) are not part of it and should
+    be read from the config """
+
+    __slots__ = ('flag_ignorerobots', 'flag_metarobots', 'flag_x_robots',
+                 'flag_jsredirects', 'flag_supplement_urls', 'flag_randomize_urls',
+                 'flag_randomize_sleep', 'time_sleeptime', 'client_cheat_mimetypes',
+                 'client_valid_mimetypes')
+
+    def __init__(self, config):
+        setter = super(CrawlerSettings, self).__setattr__
+
+        for attr in self.__slots__:
+            if attr == 'client_valid_mimetypes':
+                # Regular + extended mime-types, which otherwise gets
+                # built as a list for every URL.
+                value = frozenset(config.client_mimetypes + config.client_extended_mimetypes)
+            elif attr == 'client_cheat_mimetypes':
+                value = frozenset(config.client_cheat_mimetypes)
+            else:
+                value = getattr(config, attr)
+
+            setter(attr, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError, "Crawler settings are read-only"
+
+    def __delattr__(self, name):
+        raise AttributeError, "Crawler settings are read-only"
+
 class CrawlerUrlData(object):
     """ Class representing downloaded data for a URL """
 
@@ -313,6 +405,18 @@ class CrawlerWorkerBase(object):
         """ Parse web-page content and return an iterator on child URLs """
         raise NotImplementedError
 
+    def reuse_children(self, url, urlobj):
+        """ Return (URL, child URLs) of an unchanged URL as parsed by
+        an earlier crawl, or None if the content is to be parsed """
+
+        return None
+
+    def save_children(self, url, urlobj, child_urls):
+        """ Save the child URLs got by parsing the content of a URL
+        for reuse by later crawls """
+
+        pass
+
     def build_url(self, child_url, parent_url):
         """ Build the complete URL for child URL using the parent URL """
 
@@ -0,0 +1,49 @@
+""" Crawl scoped contexts which allow a crawler process to
+run several crawls concurrently.
+
+Classes using utils.ContextSingletonMeta as metaclass (config,
+event registry, stats and limit rules) have one instance per crawl
+context instead of one per process. The context is thread-local,
+so the thread running a crawl enters a context and every worker
+thread of the crawl inherits the context of the thread creating it.
+Outside of any context these classes are regular singletons.
+
+"""
+
+import threading
+
+# Current context of each thread
+_local = threading.local()
+
+class CrawlContext(object):
+    """ Scope of a single crawl. Holds the instances of context
+    singleton classes created in the scope """
+
+    def __init__(self, name=None):
+        self.name = name
+        # Singleton instances keyed on class
+        self.instances = {}
+        # Context this one replaced on enter
+        self.previous = []
+
+    def __enter__(self):
+        self.previous.append(get_context())
+        set_context(self)
+        return self
+
+    def __exit__(self, *args):
+        set_context(self.previous.pop())
+
+    def __repr__(self):
+        return '<CrawlContext %s>' % self.name
+
+def get_context():
+    """ Return the crawl context of the current thread,
+    None if there is none """
+
+    return getattr(_local, 'context', None)
+
+def set_context(context):
+    """ Set the crawl context of the current thread """
+
+    _local.context = context
@@ -88,8 +88,8 @@ class CrawlerEventRegistry(object):
     """ Event mediator class which allows subscribers to listen to published
     events from event publishers and take actions accordingly """
 
-    # This class is a Singleton
-    __metaclass__ = utils.SingletonMeta
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
     # Dictionary of allowed event names and descriptions
     __events__ = {'download_complete': 'Published when a URL is downloaded successfully',
                   'download_complete_fake': 'Published when a URL is fetched using HEAD request only',
@@ -104,6 +104,8 @@ class CrawlerEventRegistry(object):
                   'crawl_started': "Published when the crawl is started, no events can be published before this event",
                   'crawl_ended': "Published when the crawl ends, no events can be published after this event",
                   'abort_crawling': "Published if the crawl has to be aborted midway",
+                  'crawl_paused': "Published when the crawl is paused by the crawler server",
+                  'crawl_resumed': "Published when a paused crawl is resumed",
                   'worker_threw_exception': 'Published if a crawler worker thread dies due to an uncaught exception.',
                   'heartbeat': 'Heartbeat of the crawler'
                   
@@ -176,7 +178,11 @@ class CrawlerEventRegistry(object):
         self.subscribers[event_name].add(method)
 
 def subscribe(*wargs):
-    """ Subscription decorator """
+    """ Subscription decorator. The subscription is made to
+    the registry of the current crawl context. The decorated
+    function keeps it in its __subscribes__ attribute so that
+    it can be made again in other crawl contexts - see
+    subscribe_module """
     # print 'Wargs =>',wargs
     
     def f(*fargs):
@@ -185,6 +191,18 @@ def subscribe(*wargs):
         CrawlerEventRegistry.getInstance().subscribe(wargs[0], func)
         def wrapper(self, *args):
             return func(self, *args)
+        wrapper.__subscribes__ = (wargs[0], func)
         return wrapper
     return f
 
+def subscribe_module(module):
+    """ Make the subscriptions of all functions in a module
+    decorated with subscribe to the registry of the current
+    crawl context """
+
+    eventr = CrawlerEventRegistry.getInstance()
+    for item in module.__dict__.values():
+        subscription = getattr(item, '__subscribes__', None)
+        if subscription != None:
+            eventr.subscribe(*subscription)
+
@@ -0,0 +1,141 @@
+""" Live metrics of the crawler processes of the crawler server """
+
+import os
+import time
+import multiprocessing
+
+class CrawlerMetrics(object):
+    """ Counters and gauges of all crawler processes of the crawler
+    server, kept in a shared memory array with one row per process.
+
+    Every crawler process updates only its own row, from the events
+    of its crawls. The server sums the rows and computes rates when
+    asked for the metrics, so nothing is sent from the crawler
+    processes to the server for this """
+
+    # Counters, frontier is a gauge
+    fields = ('pages',              # URLs downloaded
+              'bytes',              # Bytes downloaded
+              'cache_hits',         # URLs served unchanged from cache
+              'filtered',           # URLs filtered by rules
+              'errors_network',     # URLs failing with network errors
+              'errors_http_4xx',    # URLs failing with 4XX status codes
+              'errors_http_5xx',    # URLs downloaded with 5XX status codes
+              'errors_http_other',  # URLs failing with other status codes
+              'crawls',             # Crawls done
+              'frontier')           # URLs waiting in queues of crawls
+
+    error_fields = ('errors_network', 'errors_http_4xx', 'errors_http_5xx', 'errors_http_other')
+
+    def __init__(self, nprocs):
+        self.nprocs = nprocs
+        self.index = dict((field, i) for i, field in enumerate(self.fields))
+        self.counters = multiprocessing.Array('d', nprocs*len(self.fields))
+        # Two last samples of (time, pages, bytes) for rates
+        self.samples = multiprocessing.Array('d', 6)
+        self.start_time = time.time()
+
+    def add(self, slot, field, value=1):
+        """ Add value to a field of the row of a crawler process """
+
+        i = slot*len(self.fields) + self.index[field]
+        # Concurrent crawls of a process share the row
+        with self.counters.get_lock():
+            self.counters[i] += value
+
+    def get_row(self, slot):
+        """ Return the fields of a crawler process as a dictionary """
+
+        n = len(self.fields)
+        return dict(zip(self.fields, self.counters[slot*n:(slot+1)*n]))
+
+    def get_totals(self):
+        """ Return the fields summed over all crawler processes """
+
+        values = self.counters[:]
+        n = len(self.fields)
+        return dict((field, sum(values[i::n])) for i, field in enumerate(self.fields))
+
+    def get_rates(self, totals, min_interval=1.0):
+        """ Return (pages, bytes) per second since the last sample,
+        taking a new sample if the last one is at least min_interval
+        seconds old. The rates are over the time between two calls,
+        so they follow whoever asks for the metrics regularly """
+
+        now = time.time()
+        current = (now, totals['pages'] + totals['cache_hits'], totals['bytes'])
+
+        with self.samples.get_lock():
+            last, previous = self.samples[3:6], self.samples[0:3]
+            if last[0] == 0:
+                # First call - since the start
+                last = previous = (self.start_time, 0, 0)
+            if now - last[0] >= min_interval:
+                self.samples[0:3], self.samples[3:6] = last, current
+                previous = last
+
+        elapsed = max(now - previous[0], 1e-6)
+        return ((current[1] - previous[1])/elapsed, (current[2] - previous[2])/elapsed)
+
+    def subscribe(self, eventr, slot):
+        """ Subscribe the counters of a crawler process to the
+        events of the registry of a crawl """
+
+        def downloaded(event):
+            self.add(slot, 'pages')
+            self.add(slot, 'bytes', event.params.get('content_length', 0))
+            if event.code == 500:
+                self.add(slot, 'errors_http_5xx')
+
+        def failed(event):
+            if event.code == 0:
+                self.add(slot, 'errors_network')
+            elif 400 <= event.code < 500:
+                self.add(slot, 'errors_http_4xx')
+            else:
+                self.add(slot, 'errors_http_other')
+
+        eventr.subscribe('download_complete', downloaded)
+        eventr.subscribe('download_error', failed)
+        eventr.subscribe('download_cache', lambda event: self.add(slot, 'cache_hits'))
+        eventr.subscribe('url_filtered', lambda event: self.add(slot, 'filtered'))
+        eventr.subscribe('crawl_ended', lambda event: self.add(slot, 'crawls'))
+
+def get_rss(pid):
+    """ Return resident memory size of a process in
+    bytes or None if it cannot be found """
+
+    try:
+        statm = open('/proc/%d/statm' % pid).read().split()
+        return int(statm[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+if __name__ == "__main__":
+    from eiii_crawler.crawlerevent import CrawlerEvent
+
+    class Registry(object):
+        def __init__(self): self.subscribers = {}
+        def subscribe(self, name, func): self.subscribers.setdefault(name, []).append(func)
+        def publish(self, name, **kwargs):
+            for func in self.subscribers.get(name, []):
+                func(CrawlerEvent(self, name, **kwargs))
+
+    metrics = CrawlerMetrics(2)
+    eventr = Registry()
+    metrics.subscribe(eventr, 1)
+    eventr.publish('download_complete', code=200, params={'content_length': 1000})
+    eventr.publish('download_complete', code=500, params={'content_length': 24})
+    eventr.publish('download_error', code=404, params={})
+    eventr.publish('download_error', code=0, params={})
+    eventr.publish('download_cache', code=304, params={})
+    metrics.add(0, 'frontier', 10)
+
+    totals = metrics.get_totals()
+    assert totals['pages'] == 2 and totals['bytes'] == 1024 and totals['frontier'] == 10
+    assert totals['errors_http_4xx'] == totals['errors_network'] == totals['errors_http_5xx'] == 1
+    assert metrics.get_row(0)['pages'] == 0 and metrics.get_row(1)['cache_hits'] == 1
+    pages_rate, bytes_rate = metrics.get_rates(totals)
+    assert pages_rate > 0 and bytes_rate > 0
+    assert get_rss(os.getpid()) > 0
+    print 'All tests passed.'
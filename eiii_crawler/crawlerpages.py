@@ -0,0 +1,208 @@
+""" Store of the pages downloaded by a crawl, kept for a time after
+the crawl so that clients of the crawler server can take the bodies
+and headers of the pages instead of downloading them again.
+
+The pages of a task are kept in a folder named by the task id in the
+pages folder, which has
+
+pages.dat - zlib compressed bodies one after the other
+manifest.json - one JSON entry per line for every page, with its URL,
+                content-type, status code, headers, whether it was
+                from the cache and the offset and length of its body
+                in pages.dat
+expires - time (seconds since the epoch) when the pages expire,
+          written when the crawl is done
+
+Bodies are compressed once when stored and are handed to clients as
+they are stored.
+"""
+
+import os
+import json
+import time
+import zlib
+import shutil
+import itertools
+import threading
+
+from eiii_crawler import utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+def get_task_dir(pagesdir, task_id):
+    """ Return folder of the pages of a task """
+
+    # Task ids come from clients of the server
+    if (not task_id) or os.sep in task_id or task_id.startswith('.'):
+        raise ValueError('Invalid task id %r' % task_id)
+
+    return os.path.join(os.path.expanduser(pagesdir), task_id)
+
+class PageStore(object):
+    """ Writer of the pages of a crawl """
+
+    # Favour speed over size, the store is local
+    compress_level = 1
+
+    def __init__(self, pagesdir, task_id, ttl):
+        self.dirpath = get_task_dir(pagesdir, task_id)
+        # Seconds to keep the pages after the crawl
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.fdata = None
+        self.fmanifest = None
+        self.npages = 0
+
+    def open(self):
+        """ Open the store for writing """
+
+        with utils.ignore(): os.makedirs(self.dirpath)
+        self.fdata = open(os.path.join(self.dirpath, 'pages.dat'), 'wb')
+        self.fmanifest = open(os.path.join(self.dirpath, 'manifest.json'), 'wb')
+
+    def add(self, url, content_type, status_code, headers, content, from_cache=False):
+        """ Add a page """
+
+        data = zlib.compress(content, self.compress_level)
+
+        with self.lock:
+            if self.fdata == None:
+                return
+
+            offset = self.fdata.tell()
+            self.fdata.write(data)
+            # Body first, so that a manifest entry is never ahead of it
+            self.fdata.flush()
+            entry = {'url': url,
+                     'content_type': content_type,
+                     'status_code': status_code,
+                     'headers': headers,
+                     'from_cache': from_cache,
+                     'size': len(content),
+                     'offset': offset,
+                     'length': len(data)}
+            # Headers are not always ASCII or UTF-8
+            self.fmanifest.write(json.dumps(entry, encoding='latin-1') + '\n')
+            self.fmanifest.flush()
+            self.npages += 1
+
+    def close(self):
+        """ Close the store and start the time to live of the pages """
+
+        with self.lock:
+            if self.fdata == None:
+                return
+
+            self.fdata.close()
+            self.fmanifest.close()
+            self.fdata = self.fmanifest = None
+
+        open(os.path.join(self.dirpath, 'expires'), 'wb').write(str(int(time.time() + self.ttl)))
+        log.info('Kept',self.npages,'pages in',self.dirpath,'for',self.ttl,'seconds')
+
+def read_pages(pagesdir, task_id, offset=0, limit=100):
+    """ Return (pages, total pages so far, done) for pages of a task
+    from offset. Each page is a dictionary with the body of the page
+    zlib compressed in 'content'. Pages are empty if the task has no
+    stored pages """
+
+    dirpath = get_task_dir(pagesdir, task_id)
+    # Check this first so that no page written before done is missed
+    done = os.path.isfile(os.path.join(dirpath, 'expires'))
+
+    try:
+        fmanifest = open(os.path.join(dirpath, 'manifest.json'), 'rb')
+        fdata = open(os.path.join(dirpath, 'pages.dat'), 'rb')
+    except IOError:
+        return [], 0, done
+
+    pages, total = [], offset
+    with fmanifest, fdata:
+        for line in itertools.islice(fmanifest, offset, None):
+            # Entry being written
+            if not line.endswith('\n'):
+                break
+
+            total += 1
+            if len(pages) >= limit:
+                continue
+
+            page = json.loads(line)
+            # Bodies are read in order, so mostly without seeking
+            if fdata.tell() != page['offset']:
+                fdata.seek(page['offset'])
+            page['content'] = fdata.read(page.pop('length'))
+            del page['offset']
+            pages.append(page)
+
+    return pages, total, done
+
+def drop_pages(pagesdir, task_id):
+    """ Remove stored pages of a task """
+
+    dirpath = get_task_dir(pagesdir, task_id)
+    shutil.rmtree(dirpath, ignore_errors=True)
+
+def expire_pages(pagesdir, max_age=7*86400):
+    """ Remove stored pages of tasks which have expired. Pages of
+    crawls which never finished are removed max_age seconds after
+    they were last written to """
+
+    pagesdir = os.path.expanduser(pagesdir)
+    now = time.time()
+
+    try:
+        task_ids = os.listdir(pagesdir)
+    except OSError:
+        return
+
+    for task_id in task_ids:
+        dirpath = os.path.join(pagesdir, task_id)
+        try:
+            expires = int(open(os.path.join(dirpath, 'expires')).read())
+        except (IOError, ValueError):
+            try:
+                expires = os.path.getmtime(os.path.join(dirpath, 'manifest.json')) + max_age
+            except OSError:
+                continue
+
+        if expires < now:
+            log.info('Removing expired pages of task',task_id,'...')
+            shutil.rmtree(dirpath, ignore_errors=True)
+
+if __name__ == "__main__":
+    import tempfile
+
+    pagesdir = tempfile.mkdtemp()
+    try:
+        store = PageStore(pagesdir, 'task1', ttl=60)
+        store.open()
+        for i in range(5):
+            store.add('http://www.foo.com/%d.html' % i, 'text/html', 200,
+                      {'content-type': 'text/html'}, '<html>%d</html>' % i)
+
+        pages, total, done = read_pages(pagesdir, 'task1', offset=1, limit=2)
+        assert total == 5 and not done
+        assert [p['url'] for p in pages] == ['http://www.foo.com/1.html', 'http://www.foo.com/2.html']
+        assert zlib.decompress(pages[1]['content']) == '<html>2</html>' and pages[1]['size'] == 14
+
+        store.close()
+        pages, total, done = read_pages(pagesdir, 'task1', offset=4)
+        assert done and total == 5 and len(pages) == 1
+        assert read_pages(pagesdir, 'task2') == ([], 0, False)
+        try:
+            drop_pages(pagesdir, '..')
+            assert False
+        except ValueError:
+            pass
+
+        expire_pages(pagesdir)
+        assert os.path.isdir(os.path.join(pagesdir, 'task1'))
+        open(os.path.join(pagesdir, 'task1', 'expires'), 'wb').write(str(int(time.time() - 1)))
+        expire_pages(pagesdir)
+        assert not os.path.isdir(os.path.join(pagesdir, 'task1'))
+    finally:
+        shutil.rmtree(pagesdir)
+
+    print 'All tests passed.'
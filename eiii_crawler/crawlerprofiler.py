@@ -0,0 +1,133 @@
+""" Sampling profiler for crawls """
+
+import os
+import sys
+import threading
+import collections
+
+from eiii_crawler import utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+class CrawlerProfiler(object):
+    """ Low overhead sampling profiler for the worker threads of a crawl.
+
+    A sampler thread looks at the current stack of each worker thread
+    rate times a second through sys._current_frames and counts the
+    stacks seen. Nothing is done in the worker threads themselves, so
+    the overhead depends only on the rate and number of workers.
+
+    The counts are written as collapsed (folded) stacks - one line per
+    stack with the frames from the outermost, separated by semi-colons,
+    followed by its count - as taken by flamegraph.pl and speedscope """
+
+    def __init__(self, get_threads, rate=50):
+        # Callable returning thread ids of threads to sample
+        self.get_threads = get_threads
+        # Samples per second
+        self.rate = rate
+        # Number of samples per collapsed stack
+        self.counts = collections.Counter()
+        self.nsamples = 0
+        # Frame labels keyed on code objects
+        self.labels = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def label(self, code):
+        """ Return label of a code object in a stack """
+
+        label = self.labels.get(code)
+        if label == None:
+            label = self.labels[code] = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                      code.co_firstlineno)
+        return label
+
+    def sample(self):
+        """ Take one sample of the stacks of the threads """
+
+        frames = sys._current_frames()
+        stacks = []
+
+        for ident in self.get_threads():
+            frame = frames.get(ident)
+            stack = []
+            while frame != None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                stacks.append(';'.join(reversed(stack)))
+
+        with self.lock:
+            self.counts.update(stacks)
+            self.nsamples += 1
+
+    def run(self):
+        """ Sampler thread loop """
+
+        interval = 1.0/self.rate
+        while not self.stopped.wait(interval):
+            try:
+                self.sample()
+            except Exception, e:
+                log.error('Error sampling stacks =>',e)
+
+    def start(self):
+        """ Start sampling """
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='CrawlerProfiler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop sampling """
+
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def get_folded(self):
+        """ Return collapsed stacks of the samples so far """
+
+        with self.lock:
+            items = sorted(self.counts.items())
+
+        return ''.join('%s %d\n' % item for item in items)
+
+    def write(self, fpath):
+        """ Write collapsed stacks to a file """
+
+        try:
+            with open(fpath, 'wb') as f:
+                f.write(self.get_folded())
+            log.info('Wrote',self.nsamples,'profile samples to',fpath)
+        except (IOError, OSError), e:
+            log.error('Error writing profile to',fpath,'=>',e)
+
+if __name__ == "__main__":
+    import time
+
+    def busy(stop):
+        while not stop.is_set():
+            sum(range(1000))
+
+    stop = threading.Event()
+    worker = threading.Thread(target=busy, args=(stop,))
+    worker.start()
+
+    profiler = CrawlerProfiler(lambda: [worker.ident], rate=100)
+    profiler.start()
+    time.sleep(0.5)
+    profiler.stop()
+    stop.set()
+    worker.join()
+
+    folded = profiler.get_folded()
+    assert profiler.nsamples > 10
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in folded.splitlines())
+    assert 'busy (crawlerprofiler.py' in folded
+    print 'All tests passed.'
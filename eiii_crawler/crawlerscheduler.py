@@ -0,0 +1,312 @@
+""" Scheduling of crawl tasks submitted to the crawler server """
+
+import os
+import json
+import time
+import urlparse
+import threading
+import itertools
+import tempfile
+import collections
+import multiprocessing
+
+from eiii_crawler import utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+class CrawlerTaskScheduler(object):
+    """ Scheduler which holds submitted crawl tasks and hands them
+    to the crawler processes only when there is a free crawl slot.
+
+    The next task is picked by, in that order,
+
+    1. Priority class of the task ('high', 'normal' or 'low')
+    2. Number of crawls running for the client submitting it, so
+       that one client cannot hog the server (per-client fairness)
+    3. Estimated size of the crawl - smaller first. The size is the
+       number of URLs crawled by the last crawl of the same site or
+       the URL limit of the task for sites not crawled before.
+    4. Order of submission
+
+    If preemption is enabled and a task waits while no slot is free,
+    a running crawl of a lower priority class is paused at its next
+    URL till the waiting task is done. A paused crawl keeps its crawl
+    thread, so this is done only if a crawl thread is free to run the
+    task - the crawler processes have spare threads for that.
+
+    The scheduler state is owned by one process - the scheduler
+    process started by start() before the server forks its handler
+    processes. Submissions and sizes of finished crawls are put to it
+    on a queue by any process and it takes the result notifications
+    of the crawler processes, so tasks are marked done and paused
+    crawls resumed by the process which scheduled them. The counts
+    of get_info are shared with the other processes """
+
+    # Priority classes
+    priorities = {'high': 0, 'normal': 1, 'low': 2}
+    # Counts shared by the scheduler process
+    info_fields = ('queued', 'running', 'paused', 'queued_high', 'queued_normal', 'queued_low')
+
+    def __init__(self, task_queue, state, capacity, spool, sizesfile=None, preempt=False,
+                 result_queue=None, result_cond=None, threads=None):
+        # Queue the crawler processes take tasks from
+        self.task_queue = task_queue
+        # Shared state - number of active crawls per process
+        self.state = state
+        # Maximum number of concurrent crawls
+        self.capacity = capacity
+        # Number of crawl threads of all crawler processes -
+        # paused crawls keep theirs
+        self.threads = threads or capacity
+        # Result spool - also used for pausing crawls
+        self.spool = spool
+        # Preempt lower priority crawls ?
+        self.preempt = preempt
+        # File keeping number of URLs crawled per site
+        self.sizesfile = None
+        self.sizes = {}
+        if sizesfile:
+            self.sizesfile = os.path.expanduser(sizesfile)
+            with utils.ignore():
+                self.sizes = json.load(open(self.sizesfile))
+
+        # Tasks waiting for a slot
+        self.pending = []
+        # Tasks handed to crawler processes keyed on task id
+        self.running = {}
+        # Paused task ids mapped to the task ids they were paused for
+        self.paused = {}
+        # Number of running tasks per client
+        self.client_running = collections.defaultdict(int)
+        # Sites of tasks whose size is not recorded yet
+        self.sites = {}
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        # Requests to the scheduler process
+        self.requests = multiprocessing.Queue()
+        # Queue on which crawler processes notify results and
+        # condition notified for every result
+        self.result_queue = result_queue
+        self.result_cond = result_cond
+        # Counts of info_fields
+        self.info = multiprocessing.Array('i', len(self.info_fields))
+        self.process = None
+
+    def get_site(self, urls):
+        """ Return the site of a crawl """
+
+        return urlparse.urlparse(urls[0]).netloc.lower() if urls else ''
+
+    def estimate_size(self, site, config_dict):
+        """ Return the estimated number of URLs of a crawl """
+
+        limit = config_dict.get('url_limits', {}).get('text/html', 0)
+        size = self.sizes.get(site)
+        if size == None:
+            return limit
+        if limit:
+            return min(size, limit)
+        return size
+
+    def record_size(self, task_id, stats_dict):
+        """ Record number of URLs crawled by a finished task """
+
+        if not stats_dict: return
+
+        size = stats_dict.get('num_urls_downloaded', 0) + stats_dict.get('num_urls_cache', 0)
+        self.requests.put(('size', task_id, size))
+
+    def save_size(self, task_id, size):
+        """ Save number of URLs crawled by a finished task - in
+        the scheduler process """
+
+        site = self.sites.pop(task_id, None)
+        if site == None: return
+
+        self.sizes[site] = size
+
+        if self.sizesfile:
+            try:
+                fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(self.sizesfile))
+                with os.fdopen(fd, 'wb') as f:
+                    json.dump(self.sizes, f)
+                os.rename(tmppath, self.sizesfile)
+            except (IOError, OSError), e:
+                log.error('Error saving site sizes =>',e)
+
+    def submit(self, task, client='', priority='normal'):
+        """ Submit a task - a (urls, config_dict) tuple """
+
+        self.requests.put(('submit', task, client, priority))
+
+    def add_task(self, task, client, priority):
+        """ Add a submitted task - in the scheduler process """
+
+        urls, config_dict = task
+        site = self.get_site(urls)
+        entry = {'task_id': config_dict['task_id'],
+                 'task': task,
+                 'client': client,
+                 'priority': self.priorities.get(priority, self.priorities['normal']),
+                 'site': site,
+                 'size': self.estimate_size(site, config_dict),
+                 'seq': self.seq.next(),
+                 'submitted': time.time()}
+
+        with self.cond:
+            self.pending.append(entry)
+            self.sites[entry['task_id']] = site
+            self.cond.notify_all()
+
+    def task_done(self, task_id):
+        """ Mark a task as done - in the scheduler process """
+
+        with self.cond:
+            entry = self.running.pop(task_id, None)
+            if entry != None:
+                self.client_running[entry['client']] -= 1
+
+            # Resume crawls paused for this one
+            for paused_id, for_id in self.paused.items():
+                if task_id in (paused_id, for_id):
+                    self.spool.resume(paused_id)
+                    del self.paused[paused_id]
+
+            self.cond.notify_all()
+
+    def get_queued(self):
+        """ Return the number of tasks waiting in the task queue """
+
+        try:
+            return self.task_queue.qsize()
+        except NotImplementedError:
+            return 0
+
+    def free_slots(self):
+        """ Return the number of free crawl slots """
+
+        # Crawls taken by processes are in the shared state, paused
+        # ones don't count. Others are waiting in the task queue.
+        return self.capacity - (sum(self.state[:]) - len(self.paused)) - self.get_queued()
+
+    def free_threads(self):
+        """ Return the number of crawl threads free to take a task """
+
+        # Paused crawls hold on to their threads
+        return self.threads - sum(self.state[:]) - self.get_queued()
+
+    def next_task(self):
+        """ Return the task that is to run next """
+
+        return min(self.pending, key=lambda entry: (entry['priority'],
+                                                    self.client_running[entry['client']],
+                                                    entry['size'],
+                                                    entry['seq']))
+
+    def pause_for(self, entry):
+        """ Pause a running crawl of lower priority than the task.
+        Return True if a crawl was paused """
+
+        victims = [r for r in self.running.values() \
+                   if r['priority'] > entry['priority'] and r['task_id'] not in self.paused]
+        if not victims:
+            return False
+
+        # Pause the least urgent and most recent crawl
+        victim = max(victims, key=lambda r: (r['priority'], r['seq']))
+        log.info('Pausing crawl',victim['task_id'],'for',entry['task_id'],'...')
+        self.spool.pause(victim['task_id'])
+        self.paused[victim['task_id']] = entry['task_id']
+        return True
+
+    def dispatch(self):
+        """ Hand tasks to crawler processes while slots are free """
+
+        while self.pending:
+            # No thread to run it - it would wait in the task queue
+            if self.free_threads() <= 0:
+                break
+
+            entry = self.next_task()
+            if self.free_slots() <= 0:
+                if not (self.preempt and self.pause_for(entry)):
+                    break
+
+            self.pending.remove(entry)
+            self.running[entry['task_id']] = entry
+            self.client_running[entry['client']] += 1
+            self.task_queue.put(entry['task'])
+
+    def publish_info(self):
+        """ Share the counts of queued and running tasks """
+
+        counts = [len(self.pending), len(self.running) - len(self.paused), len(self.paused)]
+        counts += [len([e for e in self.pending if e['priority']==self.priorities[name]]) \
+                   for name in ('high', 'normal', 'low')]
+        self.info[:] = counts
+
+    def listen_requests(self):
+        """ Serve requests of other processes """
+
+        while True:
+            try:
+                request = self.requests.get()
+            except (IOError, EOFError, ValueError), e:
+                break
+
+            if request[0] == 'submit':
+                self.add_task(*request[1:])
+            elif request[0] == 'size':
+                with self.cond:
+                    self.save_size(*request[1:])
+
+    def listen_results(self):
+        """ Mark tasks done when crawler processes notify results
+        and wake up clients waiting for results """
+
+        while True:
+            try:
+                key = self.result_queue.get()
+            except (IOError, EOFError, ValueError), e:
+                break
+
+            # Keys of fragments are tuples
+            if not isinstance(key, tuple):
+                self.task_done(key)
+
+            with self.result_cond:
+                self.result_cond.notify_all()
+
+    def run(self):
+        """ Scheduler process loop """
+
+        for target in (self.listen_requests, self.listen_results):
+            t = threading.Thread(target=target)
+            t.setDaemon(True)
+            t.start()
+
+        while True:
+            with self.cond:
+                self.dispatch()
+                self.publish_info()
+                # Slots are freed by crawler processes, so
+                # also check every now and then.
+                self.cond.wait(1.0)
+
+    def start(self):
+        """ Start the scheduler process """
+
+        self.process = multiprocessing.Process(target=self.run, name='CrawlerTaskScheduler')
+        self.process.daemon = True
+        self.process.start()
+
+    def get_info(self):
+        """ Return information on queued and running tasks """
+
+        info = dict(zip(self.info_fields, self.info[:]))
+        return {'queued': info['queued'],
+                'running': info['running'],
+                'paused': info['paused'],
+                'capacity': self.capacity,
+                'queued_by_priority': dict((name, info['queued_' + name]) for name in self.priorities)}
@@ -204,8 +204,8 @@ class CrawlerLimitRules(object):
     """ Class implementing crawler limiting rules with respect
     to maximum limits set if any """
 
-    # This class is a Singleton
-    __metaclass__ = utils.SingletonMeta
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
 
     def __init__(self, config):
         self.config = config
@@ -213,6 +213,9 @@ class CrawlerLimitRules(object):
         self.eventr = CrawlerEventRegistry.getInstance()
         self.eventr.subscribe('heartbeat', self.check_crawler_limits)       
         self.eventr.subscribe('crawl_started', self.mark_start_time)
+        # Time paused does not count against the time limit
+        self.eventr.subscribe('crawl_paused', self.mark_pause_time)
+        self.eventr.subscribe('crawl_resumed', self.mark_resume_time)
         # Do we need to apply URL limits also for retrievel from cache ?
         # Maybe we should since that also includes a HEAD request for the URL.
         # Anyway for the time being this is enabled.
@@ -238,16 +241,35 @@ class CrawlerLimitRules(object):
         self.start_timestamp = 0
         # Duration
         self.duration = 0
+        # Time the crawl was paused for and start of current pause
+        self.paused_time = datetime.timedelta(0)
+        self.pause_timestamp = None
         
     def mark_start_time(self, event):
         """ Mark starting time of crawl """
 
         self.start_timestamp = datetime.datetime.now().replace(microsecond=0)
 
+    def mark_pause_time(self, event):
+        """ Mark starting time of a pause of the crawl """
+
+        if self.pause_timestamp == None:
+            self.pause_timestamp = datetime.datetime.now()
+
+    def mark_resume_time(self, event):
+        """ Add the time of a pause of the crawl """
+
+        if self.pause_timestamp != None:
+            self.paused_time += datetime.datetime.now() - self.pause_timestamp
+            self.pause_timestamp = None
+            
     def update_time(self):
         """ Update the time taken for crawl """
 
-        tdelta = (datetime.datetime.now() - self.start_timestamp)
+        now = datetime.datetime.now()
+        tdelta = (now - self.start_timestamp) - self.paused_time
+        if self.pause_timestamp != None:
+            tdelta -= now - self.pause_timestamp
         self.duration = tdelta.total_seconds()/60.0
         log.debug("*** Duration of crawl -",self.duration,"(max: " + str(self.time_limit) + ") minutes ***")
 
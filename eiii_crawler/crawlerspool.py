@@ -0,0 +1,167 @@
+""" Spool for handing crawl results from crawler processes
+to the crawler server through local files """
+
+import os
+import zlib
+import struct
+import hashlib
+import tempfile
+import cPickle
+
+from eiii_crawler import utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+class CrawlerResultSpool(object):
+    """ Dictionary like store of crawl results shared by the crawler
+    server and its crawler processes.
+
+    Every value is pickled, compressed and written to its own file in
+    the spool folder with a length prefix. Files are written to a
+    temporary file and renamed, so readers never see partial results.
+    The key of every value written is put on the optional notification
+    queue so the server need not poll for results.
+
+    Keys are task ids or (task id, sequence number) tuples for result
+    fragments. Values are removed once read by pop.
+
+    The spool also holds the pause requests the server makes to
+    crawls when preempting them and its requests for profile
+    snapshots of crawls """
+
+    # File header - magic and length of compressed data
+    header = struct.Struct('!4sQ')
+    magic = 'EIIR'
+    # Favour speed over size, the spool is local
+    compress_level = 1
+
+    def __init__(self, spooldir, notify=None):
+        self.spooldir = os.path.expanduser(spooldir)
+        # Queue for notifying keys of values written
+        self.notify = notify
+
+        if not os.path.isdir(self.spooldir):
+            os.makedirs(self.spooldir)
+
+    def get_path(self, key, suffix='.result'):
+        """ Return spool file path for a key """
+
+        return os.path.join(self.spooldir, hashlib.sha1(repr(key)).hexdigest() + suffix)
+
+    def clear(self):
+        """ Remove all spooled results """
+
+        for fname in os.listdir(self.spooldir):
+            if ('.result' in fname) or fname.endswith(('.pause', '.snapshot')) or fname.startswith('.tmp'):
+                with utils.ignore():
+                    os.remove(os.path.join(self.spooldir, fname))
+
+    def read(self, fpath):
+        """ Read and return value from a spool file """
+
+        with open(fpath, 'rb') as f:
+            magic, length = self.header.unpack(f.read(self.header.size))
+            data = f.read()
+
+        if magic != self.magic or len(data) != length:
+            raise ValueError('Corrupt spool file %s' % fpath)
+
+        return cPickle.loads(zlib.decompress(data))
+
+    def __setitem__(self, key, value):
+        data = zlib.compress(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL), self.compress_level)
+
+        fd, tmppath = tempfile.mkstemp(prefix='.tmp', dir=self.spooldir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.header.pack(self.magic, len(data)))
+            f.write(data)
+        os.rename(tmppath, self.get_path(key))
+
+        if self.notify != None:
+            self.notify.put(key)
+
+    def __getitem__(self, key):
+        try:
+            return self.read(self.get_path(key))
+        except (IOError, OSError):
+            raise KeyError(key)
+
+    def __delitem__(self, key):
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.get_path(key))
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def drop_fragments(self, task_id, count):
+        """ Remove the result fragments of a task left in the spool,
+        count being the number of fragments published by the task """
+
+        for seq in range(count):
+            with utils.ignore():
+                os.remove(self.get_path((task_id, seq)))
+
+    def pause(self, task_id):
+        """ Ask the crawl of a task to pause """
+
+        open(self.get_path(task_id, '.pause'), 'wb').close()
+
+    def resume(self, task_id):
+        """ Let a paused crawl continue """
+
+        with utils.ignore():
+            os.remove(self.get_path(task_id, '.pause'))
+
+    def is_paused(self, task_id):
+        """ Is the crawl of a task asked to pause ? """
+
+        return os.path.exists(self.get_path(task_id, '.pause'))
+
+    def request_snapshot(self, task_id):
+        """ Ask the crawl of a task for a profile snapshot """
+
+        open(self.get_path(task_id, '.snapshot'), 'wb').close()
+
+    def cancel_snapshot(self, task_id):
+        """ Drop a profile snapshot request """
+
+        with utils.ignore():
+            os.remove(self.get_path(task_id, '.snapshot'))
+
+    def snapshot_requested(self, task_id):
+        """ Is a profile snapshot of the crawl of a task requested ? """
+
+        return os.path.exists(self.get_path(task_id, '.snapshot'))
+    
+    def pop(self, key, default=None):
+        """ Remove and return value for key or default if not found.
+        Only one of several processes popping the same key gets the
+        value """
+
+        fpath = self.get_path(key)
+        # Claim the file first
+        claimed = fpath + '.%d' % os.getpid()
+        try:
+            os.rename(fpath, claimed)
+        except OSError:
+            return default
+
+        try:
+            return self.read(claimed)
+        except (IOError, ValueError, zlib.error), e:
+            log.error('Error reading spooled result for',key,'=>',e)
+            return default
+        finally:
+            with utils.ignore():
+                os.remove(claimed)
@@ -4,6 +4,7 @@ import datetime
 
 from eiii_crawler import utils
 from eiii_crawler.crawlerevent import CrawlerEventRegistry
+from eiii_crawler.crawlertiming import CrawlerTimings
 
 # Default logging object
 log = utils.get_default_logger()
@@ -12,8 +13,8 @@ class CrawlerStats(object):
     """ Class keeping crawler statistics such as total URLs downloaded,
     total URLs parsed, total time taken etc """
 
-    # This class is a Singleton
-    __metaclass__ = utils.SingletonMeta
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
     
     def __init__(self):
         self.reset()
@@ -55,6 +56,16 @@ class CrawlerStats(object):
         self.download_time = 0
         # Total sleep time
         self.sleep_time = 0
+        # Time taken by stages of the crawl
+        self.timings = CrawlerTimings.getInstance()
+        self.timings.reset()
+        
+    def update_times(self):
+        """ Update download and sleep times from the stage timings.
+        These are summed over all workers """
+
+        self.download_time = round(self.timings.get_total('connect_ttfb', 'transfer'), 3)
+        self.sleep_time = round(self.timings.get_total('sleep'), 3)
         
     def update_total_urls(self, event):
         """ Update total number of URLs """
@@ -99,6 +110,7 @@ class CrawlerStats(object):
 
         self.end_timestamp = datetime.datetime.now().replace(microsecond=0)
         self.crawl_time = str(self.end_timestamp - self.start_timestamp)
+        self.update_times()
 
     def get_crawl_url_rate(self):
         """ Return crawling rate in terms of # URLs/sec """
@@ -120,6 +132,8 @@ class CrawlerStats(object):
         log.justlog("Start Timestamp",self.start_timestamp, justify=40)
         log.justlog("End Timestamp",self.end_timestamp, justify=40)
         log.justlog("Crawl Time",str(self.crawl_time), justify=40)
+        log.justlog("Download Time (s)",self.download_time, justify=40)
+        log.justlog("Sleep Time (s)",self.sleep_time, justify=40)
         log.justlog("# URLs",self.num_urls, justify=40)
         log.justlog("# URLs downloaded",self.num_urls_downloaded, justify=40)
         log.justlog("# URLs with error",self.num_urls_error, justify=40)
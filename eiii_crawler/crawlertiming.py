@@ -0,0 +1,157 @@
+""" Latency histograms of the stages of the crawl pipeline """
+
+import bisect
+import urlparse
+import threading
+
+from eiii_crawler import utils
+
+class Histogram(object):
+    """ Histogram of durations with fixed buckets """
+
+    # Upper bounds of buckets in milliseconds - the
+    # last bucket takes everything above
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        # Total and maximum in seconds
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """ Add a duration in seconds """
+
+        self.counts[bisect.bisect_left(self.bounds, seconds*1000)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """ Return upper bound in milliseconds of the bucket of the
+        p'th percentile, None if it is in the last bucket or there
+        are no durations """
+
+        if self.count == 0:
+            return None
+
+        rank, cumulative = p*self.count/100.0, 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                break
+
+        return self.bounds[i] if i < len(self.bounds) else None
+
+    def get_dict(self):
+        """ Return histogram as a dictionary """
+
+        return {'count': self.count,
+                'total': round(self.total, 6),
+                'max': round(self.max, 6),
+                'mean': round(self.total/self.count, 6) if self.count else 0,
+                'p50_ms': self.percentile(50),
+                'p90_ms': self.percentile(90),
+                'p99_ms': self.percentile(99),
+                'buckets': self.counts[:]}
+
+class CrawlerTimings(object):
+    """ Time taken by each stage of the crawl pipeline, kept as
+    histograms for the whole crawl and for each host. Hosts only get
+    their own histograms once a URL of theirs passes the checks or is
+    downloaded, so that the many external hosts of links are kept in
+    the crawl histograms only.
+
+    The stages are,
+
+    frontier_wait - waiting for a URL from the queue
+    robots - robots.txt rules check (including fetching robots.txt)
+    rules - rules and scoping checks of a URL before download and of
+            its content after download (robots excluded)
+    cache_read - reading a URL from the local cache
+    revalidate - conditional HEAD request for a cached URL
+    connect_ttfb - DNS lookup, connect and waiting for the response
+                   headers (these cannot be told apart through requests)
+    transfer - reading the response body
+    cache_write - writing a URL to the local cache
+    noscript - cleaning up <noscript> content before parsing
+    js_parse - parsing Javascript for redirects
+    html_parse - parsing HTML for child URLs
+    admission - checking child URLs before pushing them to the queue
+    sleep - sleep between URLs of a worker """
+
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
+
+    stages = ('frontier_wait', 'robots', 'rules', 'cache_read', 'revalidate',
+              'connect_ttfb', 'transfer', 'cache_write', 'noscript', 'js_parse',
+              'html_parse', 'admission', 'sleep')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Reset the timings """
+
+        with self.lock:
+            self.crawl = dict((stage, Histogram()) for stage in self.stages)
+            # Histograms per host, made when first needed
+            self.hosts = {}
+
+    def record(self, stage, seconds, url=None, add_host=True):
+        """ Record time in seconds taken by a stage for a URL. If
+        add_host is False, the time is recorded for the host of the
+        URL only if the host already has histograms """
+
+        host = urlparse.urlparse(url).netloc.lower() if url else None
+
+        with self.lock:
+            self.crawl[stage].add(seconds)
+            if host:
+                histograms = self.hosts.get(host)
+                if histograms == None:
+                    if not add_host:
+                        return
+                    histograms = self.hosts[host] = {}
+                if stage not in histograms:
+                    histograms[stage] = Histogram()
+                histograms[stage].add(seconds)
+
+    def get_total(self, *stages):
+        """ Return total time in seconds taken by stages """
+
+        with self.lock:
+            return sum(self.crawl[stage].total for stage in stages)
+
+    def get_dict(self):
+        """ Return timings as a dictionary """
+
+        with self.lock:
+            return {'bounds_ms': list(Histogram.bounds),
+                    'stages': dict((stage, hist.get_dict()) for stage, hist in self.crawl.items()),
+                    'hosts': dict((host, dict((stage, hist.get_dict()) for stage, hist in histograms.items())) \
+                                  for host, histograms in self.hosts.items())}
+
+if __name__ == "__main__":
+    timings = CrawlerTimings()
+    for ms in (0.5, 3, 3, 40, 40, 40, 120, 900, 45000):
+        timings.record('connect_ttfb', ms/1000.0, 'http://www.foo.com/x.html')
+    timings.record('html_parse', 0.004)
+    timings.record('admission', 0.001, 'http://www.bar.com/', add_host=False)
+    timings.record('admission', 0.001, 'http://www.foo.com/y.html', add_host=False)
+
+    d = timings.get_dict()
+    hist = d['stages']['connect_ttfb']
+    assert hist['count'] == 9 and hist['max'] == 45.0
+    assert hist['buckets'][0] == 1 and hist['buckets'][-1] == 1
+    assert hist['p50_ms'] == 50 and hist['p99_ms'] == None
+    assert d['hosts']['www.foo.com']['connect_ttfb']['count'] == 9
+    assert 'html_parse' not in d['hosts']['www.foo.com']
+    assert d['stages']['sleep']['count'] == 0 and d['stages']['sleep']['p50_ms'] == None
+    assert 'www.bar.com' not in d['hosts'] and d['stages']['admission']['count'] == 2
+    assert d['hosts']['www.foo.com']['admission']['count'] == 1
+    assert abs(timings.get_total('connect_ttfb', 'html_parse') - 46.1505) < 1e-6
+    print 'All tests passed.'
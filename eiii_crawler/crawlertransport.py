@@ -0,0 +1,260 @@
+""" Transports of HTTP requests of the crawler - the network and
+record/replay of the network through an HTTP archive.
+
+All downloads of urlhelper (get_url, head_url and fetch_url) make their
+requests through the transport of the current crawl. By default it is
+the network. A crawl with network_record set records every exchange -
+status, headers, body and timing - into an archive folder, and a crawl
+with network_replay set answers all requests from such an archive
+without touching the network. Replay sleeps the recorded times scaled
+by network_timescale, 0 for no sleeping at all, so crawls of a frozen
+copy of a site can be timed and profiled repeatedly.
+
+An archive folder has an index.json file with one JSON entry per line
+for every exchange and a bodies folder with the response bodies, each
+in a file named by the SHA-1 of the body.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from eiii_crawler import utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+# Request headers which make a request conditional
+conditional_headers = ('if-modified-since', 'if-none-match')
+
+def is_conditional(headers):
+    """ Whether request headers make a conditional request """
+
+    return any(key.lower() in conditional_headers for key in headers)
+
+class NetworkTransport(object):
+    """ Transport making requests over the network """
+
+    def request(self, method, url, headers, **kwargs):
+        """ Make a request and return the response """
+
+        return requests.request(method, url, headers=headers, **kwargs)
+
+class HttpArchive(object):
+    """ Folder of recorded HTTP exchanges """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.bodies_path = os.path.join(self.path, 'bodies')
+        # Entries keyed on (method, URL, conditional)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Load the index of the archive """
+
+        with open(self.index_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                key = (entry['method'], entry['url'], entry['conditional'])
+                # Last exchange of a request wins
+                self.entries[key] = entry
+
+        log.info('Loaded',len(self.entries),'exchanges from archive',self.path)
+        return self
+
+    def lookup(self, method, url, conditional):
+        """ Return entry of a request, preferring one which was made
+        conditional or not like the request. Return None if the
+        request is not in the archive """
+
+        entry = self.entries.get((method, url, conditional))
+        if entry == None:
+            entry = self.entries.get((method, url, not conditional))
+        return entry
+
+    def get_body(self, entry):
+        """ Return body of an entry """
+
+        if entry['body'] == None:
+            return ''
+        return open(os.path.join(self.bodies_path, entry['body'][:2], entry['body']), 'rb').read()
+
+    def add(self, entry, body):
+        """ Add an exchange to the archive """
+
+        if body:
+            digest = hashlib.sha1(body).hexdigest()
+            folder = os.path.join(self.bodies_path, digest[:2])
+            fpath = os.path.join(folder, digest)
+            if not os.path.isfile(fpath):
+                with utils.ignore(): os.makedirs(folder)
+                # Write and rename so that readers never see a partial body
+                tmp_path = '%s.%s' % (fpath, threading.current_thread().ident)
+                open(tmp_path, 'wb').write(body)
+                os.rename(tmp_path, fpath)
+            entry['body'] = digest
+        else:
+            entry['body'] = None
+
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            with utils.ignore(): os.makedirs(self.path)
+            with open(self.index_path, 'a') as f:
+                f.write(line)
+
+class RecordingTransport(NetworkTransport):
+    """ Transport making requests over the network and recording
+    them to an archive. Response bodies are read completely while
+    recording, so the time of the request includes the transfer """
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def request(self, method, url, headers, **kwargs):
+        t = time.time()
+        response = super(RecordingTransport, self).request(method, url, headers, **kwargs)
+        ttfb = time.time() - t
+
+        t = time.time()
+        body = response.content if method != 'HEAD' else ''
+        transfer = time.time() - t
+
+        entry = {'method': method,
+                 'url': url,
+                 'conditional': is_conditional(headers),
+                 'final_url': response.url,
+                 'status_code': response.status_code,
+                 'reason': response.reason,
+                 'headers': dict(response.headers),
+                 'ttfb': round(ttfb, 6),
+                 'transfer': round(transfer, 6),
+                 'timestamp': time.time()}
+
+        try:
+            self.archive.add(entry, body)
+        except (IOError, OSError), e:
+            log.error('Error recording',method,url,'to archive =>',e)
+
+        return response
+
+class RecordedResponse(object):
+    """ Response replayed from an archive, with the parts of the
+    interface of requests responses used by the crawler """
+
+    def __init__(self, entry, body, transfer=0.0):
+        self.url = entry['final_url']
+        self.status_code = entry['status_code']
+        self.reason = entry['reason']
+        self.headers = CaseInsensitiveDict(entry['headers'])
+        self._content = body
+        # Time to sleep when the body is first read
+        self.transfer = transfer
+
+    @property
+    def content(self):
+        if self.transfer:
+            time.sleep(self.transfer)
+            self.transfer = 0.0
+        return self._content
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        content = self.content
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i+chunk_size]
+
+    def close(self):
+        pass
+
+class ReplayTransport(object):
+    """ Transport answering requests from an archive. Requests not
+    in the archive fail like requests failing on the network """
+
+    def __init__(self, archive, timescale=1.0):
+        self.archive = archive
+        # Factor of recorded times to sleep
+        self.timescale = timescale
+
+    def request(self, method, url, headers, **kwargs):
+        entry = self.archive.lookup(method, url, is_conditional(headers))
+        if entry == None:
+            # Handled as a network error by urlhelper
+            raise IOError('%s %s not found in archive %s' % (method, url, self.archive.path))
+
+        if self.timescale:
+            time.sleep(entry['ttfb']*self.timescale)
+
+        return RecordedResponse(entry, self.archive.get_body(entry), entry['transfer']*self.timescale)
+
+class CrawlerTransport(object):
+    """ Transport of the requests of a crawl """
+
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
+
+    def __init__(self):
+        self.transport = NetworkTransport()
+
+    def configure(self, config):
+        """ Set transport as given by crawl configuration """
+
+        if config.network_replay:
+            archive = HttpArchive(config.network_replay)
+            try:
+                archive.load()
+            except (IOError, ValueError, KeyError), e:
+                # Never fall back to the network - all requests fail
+                log.error('Error loading archive',archive.path,'=>',e)
+            self.transport = ReplayTransport(archive, config.network_timescale)
+            log.info('Replaying requests from archive',archive.path,'...')
+        elif config.network_record:
+            self.transport = RecordingTransport(HttpArchive(config.network_record))
+            log.info('Recording requests to archive',config.network_record,'...')
+        else:
+            self.transport = NetworkTransport()
+
+def get_transport():
+    """ Return transport of the current crawl """
+
+    return CrawlerTransport.getInstance().transport
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    path = tempfile.mkdtemp()
+    try:
+        archive = HttpArchive(path)
+        archive.add({'method': 'GET', 'url': 'http://www.foo.com/', 'conditional': False,
+                     'final_url': 'http://www.foo.com/index.html', 'status_code': 200, 'reason': 'OK',
+                     'headers': {'Content-Type': 'text/html'}, 'ttfb': 0.05, 'transfer': 0.01,
+                     'timestamp': 0}, '<html></html>')
+        archive.add({'method': 'HEAD', 'url': 'http://www.foo.com/', 'conditional': True,
+                     'final_url': 'http://www.foo.com/index.html', 'status_code': 304, 'reason': 'Not Modified',
+                     'headers': {}, 'ttfb': 0.05, 'transfer': 0, 'timestamp': 0}, '')
+
+        transport = ReplayTransport(HttpArchive(path).load(), timescale=0)
+        response = transport.request('GET', 'http://www.foo.com/', {})
+        assert response.url == 'http://www.foo.com/index.html' and response.status_code == 200
+        assert response.headers['content-type'] == 'text/html'
+        assert ''.join(response.iter_content(4)) == response.content == '<html></html>'
+        response = transport.request('HEAD', 'http://www.foo.com/', {'If-None-Match': '"1"'})
+        assert response.status_code == 304 and response.content == ''
+        # Unconditional HEAD falls back to the conditional one
+        assert transport.request('HEAD', 'http://www.foo.com/', {}).status_code == 304
+
+        try:
+            transport.request('GET', 'http://www.foo.com/missing.html', {})
+            assert False
+        except IOError:
+            pass
+    finally:
+        shutil.rmtree(path)
+
+    print 'All tests passed.'
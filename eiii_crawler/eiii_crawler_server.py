@@ -21,9 +21,15 @@ try:
 except ImportError:
     from eiii_crawler.crawler import EIIICrawler, log
 try:
-    pass
+    from eiii_crawler.crawlerspool import CrawlerResultSpool
+    from eiii_crawler.crawlerscheduler import CrawlerTaskScheduler
+    from eiii_crawler.crawlermetrics import CrawlerMetrics, get_rss
+    from eiii_crawler.crawlerpages import read_pages, drop_pages, expire_pages
 except ImportError:
-    pass
+    from eiii_crawler.eiii_crawler.crawlerspool import CrawlerResultSpool
+    from eiii_crawler.eiii_crawler.crawlerscheduler import CrawlerTaskScheduler
+    from eiii_crawler.eiii_crawler.crawlermetrics import CrawlerMetrics, get_rss
+    from eiii_crawler.eiii_crawler.crawlerpages import read_pages, drop_pages, expire_pages
 
 pidfile = '/tmp/eiii_crawler_server.pid'
 def fix_url_graph(url_graph):
@@ -45,6 +51,43 @@ def fix_url_graph(url_graph):
 
     return url_graph_f
 
+def index_url_graph(url_graph):
+    """ Return the list of all URLs in the URL graph, a
+    dictionary mapping each URL to its index in the list and
+    a dictionary mapping each URL to its content-type """
+
+    url_ctype = {}
+
+    for url_key, url_values in url_graph.iteritems():
+        # Keys are always HTML since they are parents
+        url_ctype[url_key] = 'text/html'
+
+        for url, ctype in url_values:
+            url_ctype[url] = ctype
+
+    # Make a list out of it
+    # Bug: sorted gives a UnicodeDecodeError if an impoperly encoded unicode
+    # URL is present in the list - see http://gitlab.tingtun.no/eiii/eiii_crawler/issues/411
+    # Sorted is possibly not needed .
+    url_list = list(url_ctype)
+    url_index = dict((url, i) for i, url in enumerate(url_list))
+
+    return url_list, url_index, url_ctype
+
+def iter_directed_graph(url_graph):
+    """ Generate the entries of the directed graph of
+    the URL graph one by one - see make_directed_graph """
+
+    url_list, url_index, url_ctype = index_url_graph(url_graph)
+    empty = ()
+
+    for url in url_list:
+        # Find indices of children, since we are
+        # going through the same list, index will
+        # be shared across both lists.
+        child_index = [url_index[child_url] for child_url, ctype in url_graph.get(url, empty)]
+        yield (url_ctype[url], url, child_index)
+
 def make_directed_graph(url_graph):
     """ Convert the URL graph data structure obtained
     from crawler into a directed graph
@@ -59,53 +102,70 @@ def make_directed_graph(url_graph):
 
     """
 
-    url_set = set()
-    url_ctype = {}
+    return list(iter_directed_graph(url_graph))
 
-    # Add all to the set
-    for url_key, url_values in url_graph.items():
-        url_set.add(url_key)
-        # Keys are always HTML since they are parents
-        url_ctype[url_key] = 'text/html'
+def make_compact_graph(url_graph):
+    """ Convert the URL graph data structure obtained
+    from crawler into a compact directed graph in
+    compressed sparse row (CSR) format.
 
-        # print url_values
-        for url, ctype in url_values:
-            # print 'URL =>',url,ctype
-            url_set.add(url)
-            url_ctype[url] = ctype
+    Content-types are coded as indices into the list
+    of content-types. The children of the URL at index
+    i are children[offsets[i]:offsets[i+1]].
 
-    # Make a list out of it
-    # Bug: sorted gives a UnicodeDecodeError if an impoperly encoded unicode
-    # URL is present in the list - see http://gitlab.tingtun.no/eiii/eiii_crawler/issues/411
-    # Sorted is possibly not needed .
+    Example:
 
-    # url_list = sorted(list(url_set))
-    url_list = list(url_set)
-    # print url_list
+    { "urls": ["http://tingtun.no/", "http://tingtun.no/search",
+               "http://tingtun.no/research",
+               "http://tingtun.no/research/some.pdf"]
+    , "ctypes": ["text/html", "application/pdf"]
+    , "ctype": [0, 0, 0, 1]
+    , "offsets": [0, 3, 6, 10, 10]
+    , "children": [0,1,2, 0,1,2, 0,1,2,3]
+    , "__type__": "crawler-graph-csr"
+    }
 
-    url_dgraph = []
+    """
+
+    url_list, url_index, url_ctype = index_url_graph(url_graph)
+    ctypes, ctype_codes = [], {}
+    url_ctype_codes, offsets, children = [], [0], []
+    empty = ()
 
     for url in url_list:
         ctype = url_ctype[url]
-        child_index = []
-
-        # Do I have children ?
-        if url in url_graph:
-            # Find indices of children, since we are
-            # going through the same list, index will
-            # be shared across both lists.
-            child_urls = map(lambda x: x[0], url_graph[url])
-            for child_url in child_urls:
-                child_index.append(url_list.index(child_url))
-        else:
-            # No child URLs
-            pass
-
-        url_dgraph.append((ctype, url, child_index))
-
-    # print 'URL directed graph=>',url_dgraph
-    return url_dgraph
-
+        code = ctype_codes.get(ctype)
+        if code is None:
+            code = ctype_codes[ctype] = len(ctypes)
+            ctypes.append(ctype)
+
+        url_ctype_codes.append(code)
+        children.extend([url_index[child_url] for child_url, ctype in url_graph.get(url, empty)])
+        offsets.append(len(children))
+
+    return {'urls': url_list,
+            'ctypes': ctypes,
+            'ctype': url_ctype_codes,
+            'offsets': offsets,
+            'children': children,
+            '__type__': 'crawler-graph-csr'}
+
+def expand_compact_graph(graph):
+    """ Convert a compact directed graph returned by
+    make_compact_graph to the format returned by
+    make_directed_graph """
+
+    ctypes, offsets, children = graph['ctypes'], graph['offsets'], graph['children']
+    return [(ctypes[code], url, children[offsets[i]:offsets[i+1]]) \
+            for i, (code, url) in enumerate(zip(graph['ctype'], graph['urls']))]
+
+def make_result_graph(url_graph, compact=False):
+    """ Return the directed graph of the URL graph in
+    the format requested by the client """
+
+    if compact:
+        return make_compact_graph(url_graph)
+    return make_directed_graph(url_graph)
 
 class EIIICrawlerServer(SimpleTTRPCServer):
     """ EIII crawler server obeying the tt-rpc protocol """
@@ -119,7 +179,9 @@ class EIIICrawlerServer(SimpleTTRPCServer):
 
     _logger = _LoggerWrapper()
 
-    def __init__(self, nprocs=10, loglevel='info',bus_uri=None,port=8910,bind_addr='127.0.0.1'):
+    def __init__(self, nprocs=10, loglevel='info',bus_uri=None,port=8910,bind_addr='127.0.0.1',
+                 spooldir='~/.eiii/crawler/spool', ncrawls=1, preempt=False,
+                 sizesfile='~/.eiii/crawler/sitesizes.json', pagesdir='~/.eiii/crawler/pages'):
         open(pidfile, 'w').write(str(os.getpid()))
         # All the crawler objects
         self.instances = []
@@ -127,15 +189,35 @@ class EIIICrawlerServer(SimpleTTRPCServer):
         self.ntasks = 0
         # Tasks queue
         self.task_queue = multiprocessing.Queue()
-        # Dictionary used to share return-values from
+        # Queue on which crawler processes notify results
+        self.result_queue = multiprocessing.Queue()
+        # Spool used to share return-values from
         # crawler processing
-        self.manager = multiprocessing.Manager()
-        # Return shared state dictionary shared with crawler processes
-        self.return_dict = self.manager.dict()
-        # Shared state - indicates crawler activity
-        self.state = self.manager.dict()
+        self.return_dict = CrawlerResultSpool(spooldir, notify=self.result_queue)
+        # Results of earlier runs are of no use
+        self.return_dict.clear()
+        # Folder of pages kept for clients by crawls
+        self.pagesdir = pagesdir
+        # Notified by the scheduler process when a result arrives
+        self.result_cond = multiprocessing.Condition()
+        # Shared state - number of active crawls,
+        # one slot per crawler process
+        self.state = multiprocessing.Array('i', nprocs)
+        # Live metrics of crawler processes
+        self.crawl_metrics = CrawlerMetrics(nprocs)
         # Maxium number of crawl instances
         self.nprocs = nprocs
+        # Number of concurrent crawls per crawl instance
+        self.ncrawls = ncrawls
+        # Preempt low priority crawls for high priority ones ?
+        self.preempt = preempt
+        # Scheduler handing tasks to the crawl instances
+        self.scheduler = CrawlerTaskScheduler(self.task_queue, self.state,
+                                              nprocs*ncrawls, self.return_dict,
+                                              sizesfile=sizesfile, preempt=preempt,
+                                              result_queue=self.result_queue,
+                                              result_cond=self.result_cond,
+                                              threads=nprocs*(ncrawls + int(preempt)))
         # Log level
         self.loglevel = loglevel
         self.bus_url = None
@@ -156,6 +238,8 @@ class EIIICrawlerServer(SimpleTTRPCServer):
                 t.start()
 
         self.init_crawler_procs()
+        # Before handler processes are forked by listen
+        self.scheduler.start()
 
         signal.signal(signal.SIGINT, self.sighandler)
         signal.signal(signal.SIGTERM, self.sighandler)
@@ -198,7 +282,11 @@ class EIIICrawlerServer(SimpleTTRPCServer):
             # Make a new instance
             crawler = EIIICrawler(task_queue = self.task_queue,
                                   value_dict = self.return_dict,
-                                  state = self.state)
+                                  state = self.state,
+                                  slot = i,
+                                  metrics = self.crawl_metrics,
+                                  # One more crawl to run tasks preempting others
+                                  ncrawls = self.ncrawls + int(self.preempt))
             log.info("Initialized Crawler ", crawler.id)
             self.instances.append(crawler)
             crawler.start()
@@ -206,6 +294,15 @@ class EIIICrawlerServer(SimpleTTRPCServer):
         # Turn console logging off.
         log.setConsole(False)
 
+    def wait_result(self, task_id, timeout=10):
+        """ Wait till the result for a task is spooled """
+
+        with self.result_cond:
+            while not self.return_dict.has_key(task_id):
+                # Time out now and then in case the scheduler
+                # process notified before this waited.
+                self.result_cond.wait(timeout)
+        
     def do_crawl(self, ctl, crawler_rules):
         """ Perform crawling """
 
@@ -221,34 +318,32 @@ class EIIICrawlerServer(SimpleTTRPCServer):
 
         # Set task id
         config_dict['task_id'] = ctl.id_
-        # Push the task
+        # Pages are kept where the server reads them
+        config_dict['pagesdir'] = self.pagesdir
+        # Schedule the task
         task = (urls, config_dict)
-        self.task_queue.put(task)
+        self.scheduler.submit(task, client=crawler_rules.get('client', ''),
+                              priority=crawler_rules.get('priority', 'normal'))
         # Increment tasks
         self.ntasks += 1
         
         return ctl.id_
 
-    def poll(self, ctl, task_id):
+    def poll(self, ctl, task_id, compact=False):
         """ Poll for crawl results - done by the client
-        which crawls the server """
-
-        # Poll for result 
-        # NOTE: This is better done with a synchronization primitive
-        # like a shared semaphore which automatically makes the
-        # client wait till the crawl finishes. However the semantics
-        # for shared memory semaphores and the synchronization is sometimes
-        # tricky to get right - so right now a polling is done as it
-        # though stupid, is simple.
+        which crawls the server. If compact is True the
+        URL graph is returned in the compact format of
+        make_compact_graph """
+
+        # Wait for result 
         print 'Calling poll for results...'
-        while not self.return_dict.has_key(task_id):
-            # print 'Client waiting...',task_id,'...'
-            time.sleep(10)
+        self.wait_result(task_id)
 
         return_data = self.return_dict[task_id]
         url_graph = return_data['graph']
         stats_dict = return_data['stats']
         error_msg = return_data.get('error', '')
+        self.scheduler.record_size(task_id, stats_dict)
         
         if len(url_graph) <= 1:
             print 'URL graph is empty'
@@ -259,7 +354,7 @@ class EIIICrawlerServer(SimpleTTRPCServer):
         except Exception, e:
             log.error(traceback.format_exc())
         
-        result = { 'result': make_directed_graph(url_graph),
+        result = { 'result': make_result_graph(url_graph, compact),
                  'error': error_msg,
                  'stats': stats_dict,
                  '__type__': "crawler-result"}
@@ -269,6 +364,8 @@ class EIIICrawlerServer(SimpleTTRPCServer):
             del self.return_dict[task_id]
         except KeyError, e:
             print 'Could not remove data for',task_id,'from crawler shared dictionary.'
+        # Fragments of a streaming task are not needed any more
+        self.return_dict.drop_fragments(task_id, return_data.get('fragments', 0))
         
         return (result,self.load(None))
 
@@ -281,7 +378,7 @@ class EIIICrawlerServer(SimpleTTRPCServer):
         #    t.start()
         return self.do_crawl(ctl, crawler_rules)
 
-    def getresult(self, ctl, taskid):
+    def getresult(self, ctl, taskid, compact=False):
         """ Return results for a task id """
 
         return_data = self.return_dict.get(taskid)
@@ -289,13 +386,95 @@ class EIIICrawlerServer(SimpleTTRPCServer):
             url_graph = return_data['graph']
             stats_dict = return_data['stats']
         
-            return { 'result': make_directed_graph(url_graph),
+            return { 'result': make_result_graph(url_graph, compact),
                      'stats': stats_dict,
                      '__type__': "crawler-result"}
         else:
             print 'No result found for task',taskid
             return {}
     
+    def fetch(self, ctl, task_id, cursor=0):
+        """ Return the URL graph fragments and stats changes published
+        so far for a crawl started with 'stream-results' set, starting
+        from the fragment at cursor. Does not wait.
+
+        The graph maps parent URLs to their new child URLs and the stats
+        have the changes to the counters. The returned cursor is passed
+        in the next call. Once done is True, all fragments are returned,
+        the stats are the final stats and the task result is removed.
+
+        Fragments let a client use results early - the crawl still
+        builds the full URL graph and stats for its final result. """
+
+        # Check this first so that no fragment published
+        # before the result is missed.
+        done = self.return_dict.has_key(task_id)
+
+        url_graph, stats_delta = {}, {}
+        while True:
+            fragment = self.return_dict.pop((task_id, cursor), None)
+            if fragment == None: break
+            cursor += 1
+
+            for url, children in fragment['graph'].iteritems():
+                url_graph.setdefault(url, []).extend(children)
+            for key, delta in fragment['stats'].iteritems():
+                stats_delta[key] = stats_delta.get(key, 0) + delta
+
+        try:
+            url_graph = fix_url_graph(url_graph)
+        except Exception, e:
+            log.error(traceback.format_exc())
+            
+        result = { 'graph': [(url, list(children)) for url, children in url_graph.iteritems()],
+                   'stats': stats_delta,
+                   'cursor': cursor,
+                   'done': done,
+                   '__type__': "crawler-fragment"}
+
+        if done:
+            return_data = self.return_dict.pop(task_id, {})
+            self.return_dict.drop_fragments(task_id, return_data.get('fragments', 0))
+            self.scheduler.record_size(task_id, return_data.get('stats'))
+            result['stats'] = return_data.get('stats', {})
+            result['error'] = return_data.get('error', '')
+
+        return result
+    
+    def getpages(self, ctl, task_id, offset=0, limit=100):
+        """ Return the bodies and headers of pages downloaded by the
+        crawl of a task started with 'retain-pages' set, up to limit
+        pages starting from the page at offset. Does not wait.
+
+        Bodies are zlib compressed, as kept by the crawl. Pages can be
+        fetched while the crawl runs - the returned offset is passed in
+        the next call and once done is True and offset equals total, all
+        pages are returned. Pages are kept for 'retain-pages-ttl' seconds
+        (a day by default) after the crawl or till dropped by droppages """
+
+        expire_pages(self.pagesdir)
+        try:
+            pages, total, done = read_pages(self.pagesdir, task_id, offset, limit)
+        except ValueError, e:
+            raise UserError(0, str(e))
+
+        return { 'pages': pages,
+                 'offset': offset + len(pages),
+                 'total': total,
+                 'done': done,
+                 'encoding': 'zlib',
+                 '__type__': "crawler-pages"}
+
+    def droppages(self, ctl, task_id):
+        """ Remove the pages kept for a task """
+
+        try:
+            drop_pages(self.pagesdir, task_id)
+        except ValueError, e:
+            raise UserError(0, str(e))
+
+        return True
+    
     def load(self, ctl):
         """
         Returns a number. Ranges from 0 - 100. 0 means crawlers are idling,
@@ -305,10 +484,82 @@ class EIIICrawlerServer(SimpleTTRPCServer):
         100 it is compared to the other servers in rotation.
         """
 
-        # Load => # of active crawlers/# of nprocs
-        nactive = len(filter(lambda x: x==1, self.state.values()))
-        print '# active/# procs =>',nactive,'=>',self.nprocs
-        return int(100.0*nactive/self.nprocs)
+        # Load => # of running (not paused) crawls/# of crawls possible.
+        # Waiting tasks make it 100 - their counts are in loadinfo.
+        info = self.scheduler.get_info()
+        print '# running/# queued/# procs =>',info['running'],'=>',info['queued'],'=>',self.nprocs
+        if info['queued']:
+            return 100
+        return min(100, int(100.0*info['running']/info['capacity']))
+
+    def loadinfo(self, ctl):
+        """ Return a dictionary with the number of queued, running and
+        paused crawls, the capacity and the load (as returned by load) """
+
+        info = self.scheduler.get_info()
+        info['load'] = self.load(ctl)
+        return info
+
+    def profile(self, ctl, task_id, timeout=30):
+        """ Return a snapshot of the sampling profile of a running
+        crawl as collapsed stacks (one 'frame;frame;... count' line per
+        stack). Crawls not profiled all along are sampled for a couple
+        of seconds for the snapshot """
+
+        key = (task_id, 'profile')
+        self.return_dict.request_snapshot(task_id)
+        
+        deadline = time.time() + timeout
+        with self.result_cond:
+            while not self.return_dict.has_key(key) and time.time() < deadline:
+                self.result_cond.wait(1.0)
+
+        self.return_dict.cancel_snapshot(task_id)
+        snapshot = self.return_dict.pop(key)
+        if snapshot == None:
+            return {'folded': '',
+                    'error': 'No running crawl of task %s answered' % task_id,
+                    '__type__': 'crawler-profile'}
+
+        snapshot['error'] = ''
+        snapshot['__type__'] = 'crawler-profile'
+        return snapshot
+
+    def metrics(self, ctl):
+        """ Return live metrics of the server aggregated over all
+        crawler processes - rates, frontier depth, cache hit ratio,
+        error rates and memory use of each process. Rates are over
+        the time since the previous call of this method """
+
+        totals = self.crawl_metrics.get_totals()
+        pages_rate, bytes_rate = self.crawl_metrics.get_rates(totals)
+
+        fetched = totals['pages'] + totals['cache_hits']
+        # Requests made - downloaded or failed
+        requests = totals['pages'] + sum(totals[f] for f in self.crawl_metrics.error_fields) - totals['errors_http_5xx']
+
+        processes = []
+        for slot, crawler in enumerate(self.instances):
+            row = self.crawl_metrics.get_row(slot)
+            processes.append({'pid': crawler.pid,
+                              'alive': crawler.is_alive(),
+                              'active_crawls': self.state[slot],
+                              'rss': get_rss(crawler.pid),
+                              'pages': int(row['pages'] + row['cache_hits']),
+                              'frontier': int(row['frontier'])})
+
+        return {'uptime': round(time.time() - self.crawl_metrics.start_time, 1),
+                'pages_per_sec': round(pages_rate, 3),
+                'bytes_per_sec': round(bytes_rate, 1),
+                'frontier_depth': int(totals['frontier']),
+                'cache_hit_ratio': round(totals['cache_hits']/fetched, 4) if fetched else 0.0,
+                'error_rates': dict((f[len('errors_'):], round(totals[f]/requests, 4) if requests else 0.0) \
+                                    for f in self.crawl_metrics.error_fields),
+                'counters': dict((k, int(v)) for k,v in totals.items()),
+                'tasks': self.scheduler.get_info(),
+                'server_rss': get_rss(os.getpid()),
+                'processes': processes,
+                '__type__': 'crawler-metrics'}
         
           
 if __name__ == "__main__":
@@ -333,6 +584,14 @@ if __name__ == "__main__":
                         help='URI to bus to register on.')
     parser.add_argument('--bindaddr', dest='bind_addr', default='127.0.0.1', type=str,
                         help='IP address on which to listen.')
+    parser.add_argument('--ncrawls', dest='ncrawls', default=1,type=int,
+                        help='Number of crawls run concurrently by each crawler process')
+    parser.add_argument('--preempt', dest='preempt', action='store_true', default=False,
+                        help='Pause low priority crawls to run high priority ones')
+    parser.add_argument('--spooldir', dest='spooldir', default='~/.eiii/crawler/spool', type=str,
+                        help='Folder where crawler processes spool results.')
+    parser.add_argument('--pagesdir', dest='pagesdir', default='~/.eiii/crawler/pages', type=str,
+                        help='Folder where crawls keep pages for clients.')
     args = parser.parse_args()
     print 'Number of parallel crawler processes set to',args.nprocs
     print 'Starting crawler server on port',args.port,'...'
@@ -343,7 +602,9 @@ if __name__ == "__main__":
 
     log.setLevel(args.loglevel)
     EIIICrawlerServer(nprocs=args.nprocs,loglevel=args.loglevel,
-                      bus_uri=args.bus_uri, port=args.port, bind_addr=args.bind_addr
+                      bus_uri=args.bus_uri, port=args.port, bind_addr=args.bind_addr,
+                      spooldir=args.spooldir, ncrawls=args.ncrawls, preempt=args.preempt,
+                      pagesdir=args.pagesdir
                      ).listen("tcp://%s:%d" % (args.bind_addr, args.port), nprocs=args.nprocs*2)
 
 
@@ -13,6 +13,12 @@ import re
 import sys
 import os
 import time
+import Queue
+import threading
+import collections
+import multiprocessing.util
+
+from eiii_crawler import crawlercontext
 
 # List of current loggers
 __loggers__ = {}
@@ -20,6 +26,178 @@ __loggers__ = {}
 # A custom level between debug and info
 logging.EXTRA = 15
 
+# Levels of the logging functions of LoggerWrapper
+log_levels = {'debug': logging.DEBUG,
+              'extra': logging.EXTRA,
+              'info': logging.INFO,
+              'warning': logging.WARNING,
+              'error': logging.ERROR,
+              'critical': logging.CRITICAL}
+
+class LogFormatter(logging.Formatter):
+    """ Formatter which leaves records logged as plain
+    (by logsimple) unformatted """
+
+    def format(self, record):
+        if getattr(record, 'plain', False):
+            return record.getMessage()
+        return logging.Formatter.format(self, record)
+
+class LogWriter(object):
+    """ Writer thread for log files. Records are queued by the
+    logging threads and written to the file handlers by this
+    thread, so the logging threads never wait for the disk """
+
+    def __init__(self):
+        # File handlers - replaced, never changed in place, so
+        # the writer thread can use them without locking
+        self.handlers = ()
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        # Process of the writer thread
+        self.pid = None
+
+    def start(self):
+        """ Start the writer thread """
+
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='LogWriter')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        # Write the queued records at exit, also of processes
+        # of multiprocessing which don't run atexit functions.
+        multiprocessing.util.Finalize(self, self.stop, exitpriority=1)
+
+    def stop(self):
+        """ Write the queued records and stop the writer thread """
+
+        if self.thread != None and self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+
+    def flush(self):
+        """ Wait till the queued records are written """
+
+        if self.thread != None and self.pid == os.getpid():
+            self.queue.join()
+
+    def add_handler(self, handler):
+        with self.lock:
+            self.handlers = self.handlers + (handler,)
+
+    def remove_handler(self, handler):
+        with self.lock:
+            self.handlers = tuple(h for h in self.handlers if h is not handler)
+
+    def dispatch(self, record):
+        """ Write a record to the file handlers """
+
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def put(self, record):
+        """ Queue a record for writing """
+
+        if self.pid != os.getpid():
+            # Threads don't survive a fork - start
+            # a writer thread in the new process.
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        elif self.thread == None:
+            # Stopped - at exit
+            return self.dispatch(record)
+
+        self.queue.put(record)
+
+    def run(self):
+        """ Writer thread loop """
+
+        queue = self.queue
+        while True:
+            record = queue.get()
+            try:
+                if record == None:
+                    break
+                self.dispatch(record)
+            except Exception:
+                pass
+            finally:
+                queue.task_done()
+
+class TaskLogHandler(logging.Handler):
+    """ Handler writing records to the log file of the crawl they
+    were logged in, given by the logfile attribute of the record.
+    At most maxfiles log files are kept open - the least recently
+    used is closed when another one is needed """
+
+    def __init__(self, maxfiles=32):
+        logging.Handler.__init__(self)
+        self.maxfiles = maxfiles
+        # Open files keyed on log file, least recently used first
+        self.files = collections.OrderedDict()
+
+    def get_file(self, logfile):
+        """ Return open file of a log file """
+
+        f = self.files.pop(logfile, None)
+        if f == None:
+            if len(self.files) >= self.maxfiles:
+                self.files.popitem(last=False)[1].close()
+            f = open(logfile, 'a')
+        self.files[logfile] = f
+        return f
+
+    def emit(self, record):
+        logfile = getattr(record, 'logfile', None)
+        if logfile == None:
+            return
+
+        try:
+            f = self.get_file(logfile)
+            f.write(self.format(record) + '\n')
+            f.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close_file(self, logfile):
+        """ Close a log file if it is open """
+
+        with self.lock:
+            f = self.files.pop(logfile, None)
+            if f != None:
+                f.close()
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+        logging.Handler.close(self)
+
+class QueueHandler(logging.Handler):
+    """ Handler queueing records to a log writer """
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def handle(self, record):
+        # The queue is thread safe - no need of the handler lock
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        try:
+            self.writer.put(record)
+        except Exception:
+            self.handleError(record)
+
 class LoggerWrapper(object):
     """ Wrapper class on logging object which provides
     convenience functions for logging at different levels """
@@ -41,7 +219,13 @@ class LoggerWrapper(object):
             setattr(self, name, func)
 
         # Standard formatter
-        self.stdformat = logging.Formatter('%(asctime)s [%(timespent)s] :%(levelname)-8s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        self.stdformat = LogFormatter('%(asctime)s [%(timespent)s] :%(levelname)-8s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        # Writer thread of log files if writing asynchronously
+        self._writer = None
+        self._qhandler = None
+        # Log files of crawls keyed on crawl context and their handler
+        self._tasklogs = {}
+        self._taskhandler = None
         
         self.__console = False
         # Add console logging if specified
@@ -68,8 +252,8 @@ class LoggerWrapper(object):
         self.shout = logging.StreamHandler(sys.stdout)
         self.sherr = logging.StreamHandler(sys.stderr)       
         # Formatter - skip debugging for console formatter
-        formatter2 = logging.Formatter('%(asctime)s [%(timespent)s] :%(levelname)-8s - %(message)s',
-                                       datefmt='%Y-%m-%d %H:%M:%S')
+        formatter2 = LogFormatter('%(asctime)s [%(timespent)s] :%(levelname)-8s - %(message)s',
+                                  datefmt='%Y-%m-%d %H:%M:%S')
         self.shout.setFormatter(formatter2)
         self.sherr.setFormatter(formatter2)      
         # shout should filter all log records >= ERROR
@@ -105,48 +289,45 @@ class LoggerWrapper(object):
         """ Return message with variable arguments """
 
         try:
-            return ' '.join([str(msg)] + map(lambda x: str(x), args))
+            return ' '.join([str(msg)] + map(str, args))
         except (UnicodeEncodeError, UnicodeDecodeError), e:
             return ' '.join([self.myrepr(msg)] + map(lambda x: self.myrepr(x), args))           
 
-    def _dolog(self, levelname, msg, *args, **kwargs):
-        """ Generic function for logging with variable arguments """
+    def _getTimeSpent(self):
+        """ Return time since start (or reset) as hh:mm:ss """
 
-        tnow = time.time()
-        tdiff = int(round(tnow - self._startt))
+        tdiff = int(round(time.time() - self._startt))
 
         hr, rem = divmod(tdiff, 3600)
         mins, sec = divmod(rem, 60)
-        tsofar = '%.2d:%.2d:%.2d' % (hr, mins, sec)
-                         
-        try:
-            logfunc = getattr(self._log, levelname)
-            # print self._log, id(self._log), self._log.level
-            return logfunc(self._getMessage(msg, *args), extra={'timespent': tsofar})         
-        except AttributeError:
-            logfunc = getattr(self._log, 'info')
-            level = eval('logging.' + levelname.upper())
+        return '%.2d:%.2d:%.2d' % (hr, mins, sec)
+        
+    def _dolog(self, levelname, msg, *args, **kwargs):
+        """ Generic function for logging with variable arguments """
 
-            # Custom levels are < INFO
-            if (self._log.level <= level):
-                return logfunc(self._getMessage(msg, *args), extra={'timespent': tsofar})
+        level = log_levels[levelname]
+        # Check level before any formatting - most calls
+        # are below the level in production.
+        if not self._log.isEnabledFor(level):
+            return
 
-    def logsimple(self, msg, *args):
-        """ Send a log line to the log file with no formatting """
+        # Custom levels are logged as INFO
+        if level == logging.EXTRA:
+            level = logging.INFO
 
-        # Save current formatting - for the time being all formatting
-        # is the same so we save just the first one.
-        formatter = self._log.handlers[0].formatter
-        plain_formatter = logging.Formatter("%(message)s")
-        for handler in self._log.handlers:
-            handler.setFormatter(plain_formatter)
+        return self._log.log(level, self._getMessage(msg, *args),
+                             extra={'timespent': self._getTimeSpent(),
+                                    'logfile': self._tasklogs.get(crawlercontext.get_context())})
 
-        # Log the message at info level
-        self._log.info(self._getMessage(msg, *args))
+    def logsimple(self, msg, *args):
+        """ Send a log line to the log file with no formatting """
 
-        # Reset formatter
-        for handler in self._log.handlers:
-            handler.setFormatter(formatter)        
+        # Log the message at info level, marked for the
+        # formatters to leave it as it is.
+        if self._log.isEnabledFor(logging.INFO):
+            self._log.info(self._getMessage(msg, *args),
+                           extra={'timespent': '', 'plain': True,
+                                  'logfile': self._tasklogs.get(crawlercontext.get_context())})
 
     def justlog(self, msg, *args, **kwargs):
         """ Send a log line justified by a fixed width of spaces.
@@ -194,15 +375,65 @@ class LoggerWrapper(object):
         self._log.setLevel(level)
         
         # Need to set level on each handler as well.
-        for handler in self._log.handlers:
+        for handler in self._getHandlers():
             # print 'Setting level',level,'for handler',handler
             handler.setLevel(level)     
     
     def setFormat(self, format):
         """ Set format for log lines """
 
-        for handler in self._log.handlers:
-            handler.setFormatter(logging.Formatter(format))
+        for handler in self._getHandlers():
+            handler.setFormatter(LogFormatter(format))
+
+    def _getHandlers(self):
+        """ Return all handlers, including those of the writer thread """
+
+        handlers = [h for h in self._log.handlers if h is not self._qhandler]
+        if self._writer != None:
+            handlers += self._writer.handlers
+        return handlers
+    
+    def _addFileHandler(self, handler):
+        """ Add a file handler to the logger or its writer thread """
+
+        if self._writer != None:
+            self._writer.add_handler(handler)
+        else:
+            self._log.addHandler(handler)
+
+    def _removeFileHandler(self, handler):
+        """ Remove a file handler from the logger or its writer thread """
+
+        if self._writer != None:
+            self._writer.remove_handler(handler)
+        else:
+            self._log.removeHandler(handler)
+
+    def setAsync(self, val=True):
+        """ Toggle writing of log files by a writer thread. Console
+        logging is not affected """
+
+        if val and self._writer == None:
+            self._writer = LogWriter()
+            self._qhandler = QueueHandler(self._writer)
+            for handler in self._log.handlers[:]:
+                if isinstance(handler, (logging.FileHandler, TaskLogHandler)):
+                    self._log.removeHandler(handler)
+                    self._writer.add_handler(handler)
+            self._log.addHandler(self._qhandler)
+            self._writer.start()
+        elif (not val) and self._writer != None:
+            self._log.removeHandler(self._qhandler)
+            self._writer.stop()
+            for handler in self._writer.handlers:
+                self._log.addHandler(handler)
+            self._writer = self._qhandler = None
+
+    def flush(self):
+        """ Wait till log records queued for the writer thread are written """
+
+        if self._writer != None:
+            self._writer.flush()
 
     def setConsole(self, val=True):
         """ Toggle console logging settings """
@@ -220,13 +451,15 @@ class LoggerWrapper(object):
         # Remove previous file handle if any
         if self._extrafhandle != None:
             # print 'Removing file handle',self._extrafhandle
-            self._log.removeHandler(self._extrafhandle)
+            self._removeFileHandler(self._extrafhandle)
+            self.flush()
+            self._extrafhandle.close()
             
         # print 'LOGFILE=>',logfile
         fh = logging.FileHandler(logfile)
         fh.setFormatter(self.stdformat)
         # add handler to logger object
-        self._log.addHandler(fh)
+        self._addFileHandler(fh)
         if sethandler: self._extrafhandle = fh
 
     def removeLogFile(self, logfile):
@@ -235,7 +468,7 @@ class LoggerWrapper(object):
         rhandle = None
         logfile = os.path.abspath(logfile)
         
-        for handler in self._log.handlers:
+        for handler in self._getHandlers():
             if type(handler) == logging.FileHandler:
                 # print handler.baseFilename, logfile
                 if handler.baseFilename == logfile:
@@ -245,7 +478,31 @@ class LoggerWrapper(object):
 
         if rhandle != None:
             # print 'Removing file handler=>',rhandle
-            self._log.removeHandler(rhandle)
+            self._removeFileHandler(rhandle)
+            self.flush()
+            rhandle.close()
+
+    def setTaskLogFile(self, logfile):
+        """ Write log lines of the current crawl context (see
+        crawlercontext) to logfile also, till clearTaskLogFile """
+
+        if self._taskhandler == None:
+            self._taskhandler = TaskLogHandler()
+            self._taskhandler.setFormatter(self.stdformat)
+            self._addFileHandler(self._taskhandler)
+
+        self._tasklogs[crawlercontext.get_context()] = os.path.abspath(logfile)
+
+    def clearTaskLogFile(self):
+        """ Stop writing log lines of the current crawl context
+        to its log file and close it """
+
+        logfile = self._tasklogs.pop(crawlercontext.get_context(), None)
+        # Concurrent crawls of a site may share a log file
+        if logfile != None and logfile not in self._tasklogs.values():
+            # Write queued lines first
+            self.flush()
+            self._taskhandler.close_file(logfile)
 
 class ErrorFilter(object):
     """ Logging filter class that filters out all
@@ -313,8 +570,8 @@ def getMultiLogger(app, logfile, errlogfile, level=logging.INFO, console=False):
     fhout = logging.FileHandler(logfile)
     fherr = logging.FileHandler(errlogfile) 
 
-    formatter = logging.Formatter('%(asctime)s [%(timespent)s]: %(levelname)-8s - %(message)s',
-                                  datefmt='%Y-%m-%d %H:%M:%S') 
+    formatter = LogFormatter('%(asctime)s [%(timespent)s]: %(levelname)-8s - %(message)s',
+                             datefmt='%Y-%m-%d %H:%M:%S') 
 
     fhout.setFormatter(formatter)
     fherr.setFormatter(formatter)
@@ -14,20 +14,24 @@ URLs wrongly).
 a. Also take care of content of URLs - ?
 b. Only use content of the URL and dont bother with URL patterns.
 
+(See the nearduplicate plugin for a content based detector).
+
+Query strings are reduced to a signature of their sorted parameter
+names and the class of each value, so that a URL is matched to its
+pattern by a single dictionary lookup. The exclusion rules made from
+them match the parameters in any order, like the signature.
+
 """
 
 import urlparse
 import re
+import threading
+import collections
 
 from eiii_crawler.crawlerevent import subscribe
 from eiii_crawler.crawlerbase import CrawlerConfig
 from eiii_crawler import utils
 
-# Dictionary mapping dynamic URL regexes to their hit counts
-__regexes__ = {}
-# Dictionary mapping dynamic URL regex to their total URLs count
-__regexurls__ = {}
-
 # Default logging object
 log = utils.get_default_logger()
 
@@ -37,26 +41,78 @@ log = utils.get_default_logger()
 # 2. The actual threshold of percentage of such URLs over # of total URLs (from the
 # time the rule has been created). The dynamic rules are created only after the threshold
 # is hit.
+# 3. Max # of query patterns tracked, least recently seen ones are dropped beyond this.
 
-min_hits, threshold, url_patterns = 10, 20.0, []
+min_hits, threshold, url_patterns, max_patterns = 10, 20.0, [], 5000
 
 # Regex paths of URLs to exclude from dynamic filtering
 url_exclude_paths  = ('/', '')
 url_regexclude_paths = ('default\.[a-zA-Z]+', 'index\.[a-zA-Z]+', 'home\.[a-zA-Z]+', 'frontend\.[a-zA-Z]+')
 
+# Classes of query parameter values and their regexes
+value_classes = (('word', re.compile('[a-zA-Z_0-9]+$'), '[a-zA-Z_0-9]+'),
+                 ('empty', re.compile('$'), ''),
+                 ('other', re.compile('.*$'), '[^&]*'))
+
+class CircuitState(object):
+    """ Configuration and state of the plugin for a crawl """
+
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
+
+    def __init__(self):
+        # Configuration - global defaults
+        self.min_hits, self.threshold, self.url_patterns = min_hits, threshold, url_patterns
+        self.max_patterns = max_patterns
+        self.url_exclude_paths, self.url_regexclude_paths = url_exclude_paths, url_regexclude_paths
+        # Query signatures mapped to [rule pattern, hit count, count of
+        # URLs seen when created] - least recently seen first
+        self.patterns = collections.OrderedDict()
+        # Count of URLs with query seen
+        self.nurls = 0
+        # Worker threads publish events concurrently
+        self.lock = threading.Lock()
+
 def set_config(**kwargs):
     """ Set configuration for the plugin """
 
-    # Reset global state
-    global __regexes__, __regexurls__
-
+    state = CircuitState.getInstance()
+    
     for key,value in kwargs.items():
-        # Set globally
+        # Set for this crawl
         log.info("\tSetting configuration",key,"to",value)
-        globals()[key] = value
-
-    __regexurls__.clear()
-    __regexes__.clear()
+        setattr(state, key, value)
+
+    # Reset state
+    with state.lock:
+        state.patterns.clear()
+        state.nurls = 0
+
+def value_class(value):
+    """ Return class name and regex of a query parameter value """
+
+    for name, regex, pattern in value_classes:
+        if regex.match(value):
+            return name, pattern
+
+def query_signature(query):
+    """ Return signature of a query string - its sorted parameter
+    names with the class of each value - and the regex pattern of
+    the query, which matches the parameters in any order """
+
+    params = []
+    for item in query.split('&'):
+        name, value = (item.strip().split('=', 1) + [''])[:2]
+        vclass, vpattern = value_class(value)
+        params.append((name, vclass, vpattern))
+
+    params.sort()
+    # A lookahead per parameter, so the order in the URL does not matter.
+    # Parameters with empty values may have no '=' at all.
+    pattern = ''.join('(?=.*[?&]' + re.escape(name) + ('(?:\\=)?' if vclass == 'empty' else '\\=') + \
+                      vpattern + '(?:[&#]|$))' for name, vclass, vpattern in params)
+
+    return tuple((name, vclass) for name, vclass, vpattern in params), pattern
     
 @subscribe('download_complete')
 def check_circuit(event):
@@ -64,6 +120,8 @@ def check_circuit(event):
 
     url = event.params.get('url')
     # print 'Checking for circuit',url,'...'
+    state = CircuitState.getInstance()
+    url_patterns = state.url_patterns
 
     # Parse the URL
     urlp = urlparse.urlparse(url)
@@ -76,66 +134,72 @@ def check_circuit(event):
     
     # If specific blacklist patterns are provided only look for them.
     if url_patterns:
-        if (lastpath in url_patterns) or any([re.match(re.escape(pattern), lastpath) for pattern in url_patterns]):
+        if (lastpath in url_patterns) or any(re.match(re.escape(pattern), lastpath) for pattern in url_patterns):
             log.extra("URL matches path blacklist. Checking for circuit", url)
         else:
             return False
     else:
         # If no blacklist patterns provided check for not whitelisted patterns.
-        if (lastpath in url_exclude_paths) or any([re.match(pattern, lastpath, re.IGNORECASE) for pattern in url_regexclude_paths]):
+        if (lastpath in state.url_exclude_paths) or any(re.match(pattern, lastpath, re.IGNORECASE) for pattern in state.url_regexclude_paths):
             log.extra("URL matches path whitelist. Not checking for circuit", url)
             return False
     
     if query_p:
-        # Check against any of the existing regexes
-        # Split and normalize the query parameter
-        query_p_norm = '&'.join(map(lambda x:x.strip(), query_p.split('&')))
-        hit = False
-        
-        for regex in __regexes__:
-            # Increase count of regex URL dictionary
-            __regexurls__[regex] += 1
-            # Check for a match
-            if regex.match(query_p_norm):
-                # print 'Matching regex =>',regex.pattern
-                # Add a hit for this regex
-                __regexes__[regex] += 1
-                hit = True
-                break
-
-        # If no hit found - make an entry for this URLs query parameter in the regex dictionary
-        if not hit:
-            # print 'Making entry for URL',url,'in regex dictionary...'
-            # Get last path of the URL
-            paths = urlp.path
-            regex_s='\&'.join(map(lambda x:x.strip().split('=')[0] + '\=[a-zA-Z_0-9]+', query_p.split('&')))
-            regex = re.compile(regex_s)
-            # Insert entry into regex dictionary
-            __regexes__[regex] = 0
-            # Make 1 entry in regex URL dictionary
-            __regexurls__[regex] = 1
-        else:
-            # Hit - check percentage - if >=20% of total URLs seen so far, mark this as
-            # a repeating template. Also do this only after at least 10 actual hits
-            count, total = __regexes__[regex], __regexurls__[regex]
+        # Look up the signature of the query among the patterns seen
+        signature, pattern = query_signature(query_p)
+        rule = None
+
+        with state.lock:
+            state.nurls += 1
+            entry = state.patterns.pop(signature, None)
             
-            if (total>=min_hits) and 100.0*count/total >= threshold:
-                # print 'Template hit for regex =>',regex.pattern, count, total
+            if entry == None:
+                # No hit - make an entry for this URLs query pattern
+                entry = [pattern, 0, state.nurls]
+            else:
+                # Hit - check percentage - if >=20% of total URLs seen since the
+                # entry was made, mark this as a repeating template. Also do this
+                # only after at least 10 actual hits
+                entry[1] += 1
+                count, total = entry[1], state.nurls - entry[2] + 1
+
+                if (total>=state.min_hits) and 100.0*count/total >= state.threshold:
+                    # Prefix a .* before the rule pattern to be a catch-all on prefix
+                    rule = '.*' + entry[0]
+                    # Drop this entry
+                    entry = None
+
+            if entry != None:
+                # Most recently seen last
+                state.patterns[signature] = entry
+                while len(state.patterns) > state.max_patterns:
+                    state.patterns.popitem(last=False)
+
+            if rule != None:
                 # Append this rule to exclude of crawler config
-                # Prefix a .* before the rule pattern to be a catch-all on prefix
-                rule = '.*' + regex.pattern
                 config = CrawlerConfig.getInstance()
                 if rule not in config._url_dynamic_exclude_rules:
-                    log.info('Hit threshold. Creating dynamic rule to exclude',regex.pattern,'...')
+                    log.info('Hit threshold. Creating dynamic rule to exclude',rule[2:],'...')
                     config._url_dynamic_exclude_rules.append(rule)
-                    # print '\tnew exclusion rules=>',config._url_exclude_rules
-                    # Drop this rule from the dictionary
-                    del __regexurls__[regex]
-                    del __regexes__[regex]
-
 
         return True
             
     else:
         # print 'No query param found, not doing anything'
         pass
+
+if __name__ == "__main__":
+    signature, pattern = query_signature('b=2&a=x')
+    assert signature == query_signature('a=y&b=3')[0]
+    for url in ('http://www.foo.com/x?b=5&a=z', 'http://www.foo.com/x?a=z&c=1&b=5#top'):
+        assert re.match('.*' + pattern, url, re.IGNORECASE)
+    for url in ('http://www.foo.com/x?a=z', 'http://www.foo.com/x?a=z-1&b=5', 'http://www.foo.com/x?ba=z&b=5'):
+        assert not re.match('.*' + pattern, url, re.IGNORECASE)
+
+    # Parameters without values
+    signature, pattern = query_signature('a=1&flag')
+    assert signature == query_signature('flag=&a=2')[0]
+    for url in ('http://www.foo.com/x?a=1&flag', 'http://www.foo.com/x?flag&a=1', 'http://www.foo.com/x?flag=&a=1'):
+        assert re.match('.*' + pattern, url, re.IGNORECASE)
+    assert not re.match('.*' + pattern, 'http://www.foo.com/x?a=1&flags', re.IGNORECASE)
+    print 'All tests passed.'
@@ -0,0 +1,243 @@
+"""
+Near duplicate detector - Detect crawl traps from page content.
+
+This complements the circuitbreaker plugin which looks only at
+the shape of query strings of URLs. Here a SimHash fingerprint of
+the text of every downloaded HTML page is computed and looked up
+in an index of the fingerprints of pages of the same host.
+
+A page whose fingerprint differs from that of an earlier page in
+at most max_distance bits is a near duplicate. Near duplicates are
+not parsed for child URLs. If a large share of the pages of a URL
+pattern (URL with numeric path segments and query values wildcarded)
+turn out to be near duplicates, a dynamic rule excluding the pattern
+is added to the crawler configuration so that the rest of the trap
+is not downloaded at all.
+
+The index is a banded LSH index - the 64 bit fingerprint is split
+into 4 bands of 16 bits and a page is compared only to pages sharing
+at least one band with it. Two fingerprints differing in at most 3
+bits always share a band, so no near duplicate is missed with the
+default max_distance. Larger values would miss near duplicates and
+are capped at 3 (one less than the number of bands).
+
+"""
+
+import re
+import urlparse
+import hashlib
+import threading
+import collections
+
+from eiii_crawler.crawlerevent import subscribe
+from eiii_crawler.crawlerbase import CrawlerConfig
+from eiii_crawler import utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+# Global configuration
+# 1. Max # of differing bits of fingerprints of near duplicates
+# 2. Min # of words of a page to fingerprint it
+# 3. Min # of pages of a URL pattern to be seen before threshold is imposed
+# 4. The threshold of percentage of near duplicates over # of pages of the pattern
+
+max_distance, min_words, min_hits, threshold = 3, 50, 10, 50.0
+
+# Fingerprint size and LSH bands
+nbits, nbands = 64, 4
+band_bits = nbits/nbands
+band_mask = (1<<band_bits) - 1
+# Largest distance at which near duplicates always share a band
+max_band_distance = nbands - 1
+
+# Words per shingle
+shingle_size = 3
+
+# Parts of HTML which are not text
+script_re = re.compile(r'<(script|style)[^>]*>.*?</\1\s*>', re.IGNORECASE|re.DOTALL)
+tag_re = re.compile(r'<[^>]*>|&[#a-zA-Z0-9]+;')
+word_re = re.compile(r'\w+', re.UNICODE)
+# Path segments which are variable in URL patterns
+variable_re = re.compile(r'\d')
+
+class NearDuplicateState(object):
+    """ Configuration and state of the plugin for a crawl """
+
+    # This class is a Singleton in each crawl context
+    __metaclass__ = utils.ContextSingletonMeta
+
+    def __init__(self):
+        # Configuration - global defaults
+        self.max_distance, self.min_words = max_distance, min_words
+        self.min_hits, self.threshold = min_hits, threshold
+        # LSH index - dictionary mapping (host, band number, band value)
+        # to fingerprints of pages
+        self.index = collections.defaultdict(list)
+        # Dictionary mapping URL patterns to their (pages, near duplicates) count
+        self.patterns = collections.defaultdict(lambda: [0, 0])
+        # Worker threads publish events concurrently
+        self.lock = threading.Lock()
+
+def set_config(**kwargs):
+    """ Set configuration for the plugin """
+
+    state = NearDuplicateState.getInstance()
+
+    for key,value in kwargs.items():
+        if key == 'max_distance' and value > max_band_distance:
+            log.warning('max_distance',value,'is more than the LSH index can find, using',max_band_distance)
+            value = max_band_distance
+        # Set for this crawl
+        log.info("\tSetting configuration",key,"to",value)
+        setattr(state, key, value)
+
+    # Reset state
+    state.index.clear()
+    state.patterns.clear()
+
+def get_shingles(content):
+    """ Return the set of word shingles of the text of HTML content """
+
+    text = tag_re.sub(' ', script_re.sub(' ', content))
+    words = word_re.findall(text.lower())
+    return words, set(' '.join(words[i:i+shingle_size]) for i in range(max(1, len(words)-shingle_size+1)))
+
+def simhash(features):
+    """ Return the SimHash fingerprint of a set of string features """
+
+    hashes = [int(hashlib.md5(f.encode('utf-8') if type(f) is unicode else f).hexdigest()[:nbits/4], 16) \
+              for f in features]
+    half = len(hashes)/2.0
+    fingerprint = 0
+
+    # Count bits a byte at a time - each byte value
+    # is counted once instead of every bit of every hash
+    for shift in range(0, nbits, 8):
+        counts = collections.Counter([(h >> shift) & 0xff for h in hashes])
+        for bit in range(8):
+            if sum(count for value, count in counts.iteritems() if (value >> bit) & 1) > half:
+                fingerprint |= 1 << (shift + bit)
+
+    return fingerprint
+
+def distance(fp1, fp2):
+    """ Return the Hamming distance of two fingerprints """
+
+    return bin(fp1 ^ fp2).count('1')
+
+def url_pattern(url):
+    """ Return the pattern of a URL - host, path segments with the
+    variable ones wildcarded and names of query parameters. Return
+    None for URLs with nothing variable """
+
+    urlp = urlparse.urlparse(url)
+    segments = tuple(None if variable_re.search(seg) else seg for seg in urlp.path.split('/'))
+    params = tuple(p.split('=')[0] for p in urlp.query.split('&') if p)
+
+    if (None not in segments) and not params:
+        return None
+
+    return (urlp.scheme, urlp.netloc.lower(), segments, params)
+
+def pattern_rule(pattern):
+    """ Return exclusion rule regex for a URL pattern """
+
+    scheme, netloc, segments, params = pattern
+    rule = re.escape(scheme + '://' + netloc)
+    rule += '/'.join('[^/?]*' if seg==None else re.escape(seg) for seg in segments)
+    if params:
+        rule += '\?' + '\&'.join(re.escape(p) + '\=[^&]*' for p in params)
+
+    return rule
+
+def find_near_duplicate(state, host, fingerprint):
+    """ Return fingerprint of a near duplicate page of the host if
+    found and index the fingerprint """
+
+    found = None
+    for band in range(nbands):
+        key = (host, band, (fingerprint >> (band*band_bits)) & band_mask)
+        bucket = state.index[key]
+        if found == None:
+            for fp in bucket:
+                if distance(fp, fingerprint) <= state.max_distance:
+                    found = fp
+                    break
+        # Duplicates give nothing new to the index
+        if found == None:
+            bucket.append(fingerprint)
+
+    return found
+
+@subscribe('download_complete')
+def check_near_duplicate(event):
+    """ Check whether a downloaded page is a near duplicate
+    of a page crawled earlier """
+
+    url = event.params.get('url')
+    content = event.params.get('content')
+    if (not content) or event.params.get('content_type') != 'text/html':
+        return False
+
+    state = NearDuplicateState.getInstance()
+    words, shingles = get_shingles(content)
+    # Too little text to tell
+    if len(words) < state.min_words:
+        return False
+
+    fingerprint = simhash(shingles)
+    host = urlparse.urlparse(url).netloc.lower()
+    pattern = url_pattern(url)
+
+    with state.lock:
+        duplicate = find_near_duplicate(state, host, fingerprint) != None
+        if pattern != None:
+            counts = state.patterns[pattern]
+            counts[0] += 1
+            counts[1] += int(duplicate)
+
+    if not duplicate:
+        return False
+
+    log.info('URL',url,'is a near duplicate of a page crawled earlier')
+    # Tell the worker not to parse the page
+    event.publisher.near_duplicate = True
+
+    if pattern != None:
+        pages, duplicates = counts
+        if (pages>=state.min_hits) and 100.0*duplicates/pages >= state.threshold:
+            rule = pattern_rule(pattern)
+            config = CrawlerConfig.getInstance()
+            with state.lock:
+                if rule not in config._url_dynamic_exclude_rules:
+                    log.info('Hit threshold. Creating dynamic rule to exclude',rule,'...')
+                    config._url_dynamic_exclude_rules.append(rule)
+                    state.patterns.pop(pattern, None)
+
+    return True
+
+if __name__ == "__main__":
+    page = '<html><body><p>%s</p><script>var x=1;</script></body></html>'
+    text = ' '.join('word%d' % i for i in range(200))
+    fp1 = simhash(get_shingles(page % text)[1])
+    fp2 = simhash(get_shingles(page % (text + ' 17 June'))[1])
+    fp3 = simhash(get_shingles(page % ' '.join('other%d' % i for i in range(200)))[1])
+    assert distance(fp1, fp2) <= max_distance
+    assert distance(fp1, fp3) > max_distance
+
+    state = NearDuplicateState()
+    assert find_near_duplicate(state, 'foo.com', fp1) == None
+    assert find_near_duplicate(state, 'foo.com', fp2) == fp1
+    assert find_near_duplicate(state, 'bar.com', fp2) == None
+    assert find_near_duplicate(state, 'foo.com', fp3) == None
+
+    set_config(max_distance=8)
+    assert NearDuplicateState.getInstance().max_distance == max_band_distance
+
+    pattern = url_pattern('http://www.foo.com/calendar/2014/06?day=17&view=month')
+    assert url_pattern('http://www.foo.com/about/contact.html') == None
+    rule = pattern_rule(pattern)
+    assert re.match(rule, 'http://www.foo.com/calendar/2015/01?day=3&view=week', re.IGNORECASE)
+    assert not re.match(rule, 'http://www.foo.com/news/2015/01?day=3&view=week', re.IGNORECASE)
+    print 'All tests passed.'
@@ -3,19 +3,331 @@
 
 import urlparse
 import re
+import time
+import os
+import json
+import tempfile
+import threading
+import collections
+import contextlib
+import email.utils
 
 import eiii_crawler.urlhelper as urlhelper
+import eiii_crawler.utils as utils
 
 ___author__ = "Anand B Pillai"
 __maintainer__ = "Anand B Pillai"
 __version__ = "0.1"
 
+# Default logging object
+log = utils.get_default_logger()
+
+class RobotsRules(object):
+    """ Allow/Disallow rules of a site compiled into a path prefix trie.
+
+    Literal rules are stored in the trie itself, rules with '*' wildcards
+    are stored against the node of their literal prefix along with a
+    compiled regex for the rest of the rule and rules ending with '$'
+    only match at the end of the path. As in the robots.txt RFC, the
+    longest matching rule wins and on a tie, Allow wins. Checking a path
+    costs O(path length) plus the wildcard rules found along the path """
+
+    # Trie node slots
+    CHILDREN, PREFIX, EXACT, PATTERNS = range(4)
+
+    def __init__(self, crawldelay=-1, sitemaps=None, ttl=0):
+        # Root node
+        self.root = self.make_node()
+        # Number of rules
+        self.nrules = 0
+        self.crawldelay = crawldelay
+        self.sitemaps = sitemaps or []
+        # Time after which the rules should be fetched again
+        self.expires = time.time() + ttl
+
+    def make_node(self):
+        """ Return a new trie node """
+
+        # Children, best prefix match, best exact match, wildcard patterns
+        return [{}, None, None, []]
+
+    def expired(self):
+        """ Are the rules stale ? """
+
+        return time.time() >= self.expires
+
+    def add(self, rule, allow=False):
+        """ Add a rule - rule is a path, optionally with
+        wildcards ('*') and an end-of-path anchor ('$') """
+
+        # Trailing wildcards are implicit in a prefix match
+        rule = rule.rstrip('*')
+        exact = rule.endswith('$')
+        literal = rule.rstrip('$').split('*')[0]
+        # Rule strength - the length of the rule
+        match = (len(rule), allow)
+
+        node = self.root
+        for char in literal:
+            node = node[self.CHILDREN].setdefault(char, self.make_node())
+
+        if '*' in rule:
+            tail = rule[len(literal):].rstrip('$')
+            regex = '.*'.join(re.escape(piece) for piece in tail.split('*'))
+            if exact: regex += r'\Z'
+            node[self.PATTERNS].append((re.compile(regex), match))
+        elif exact:
+            node[self.EXACT] = max(node[self.EXACT], match)
+        else:
+            node[self.PREFIX] = max(node[self.PREFIX], match)
+
+        self.nrules += 1
+
+    def allowed(self, path):
+        """ Is the path (including any query string) allowed ? """
+
+        CHILDREN, PREFIX, PATTERNS = self.CHILDREN, self.PREFIX, self.PATTERNS
+        # Nothing matches - allowed
+        best = (-1, True)
+
+        node = self.root
+        pos, plen = 0, len(path)
+
+        while True:
+            if node[PREFIX] is not None and node[PREFIX] > best:
+                best = node[PREFIX]
+
+            for regex, match in node[PATTERNS]:
+                if match > best and regex.match(path, pos):
+                    best = match
+
+            if pos == plen:
+                if node[self.EXACT] is not None and node[self.EXACT] > best:
+                    best = node[self.EXACT]
+                break
+
+            node = node[CHILDREN].get(path[pos])
+            if node is None: break
+            pos += 1
+
+        return best[1]
+
+class RobotsCache(object):
+    """ Cache of robots.txt files shared by all workers of a crawler
+    process. The fetched robots.txt files are also persisted in a local
+    folder so they are shared by all crawler processes and survive
+    across crawls.
+
+    A robots.txt is cached for the time allowed by its HTTP caching
+    headers but never longer than the configured TTL. Missing files
+    (4XX) are cached as allow-all for the TTL, while fetch failures and
+    server errors (5XX) are cached as allow-all with an exponential
+    backoff before trying again """
+
+    # This class is a Singleton
+    __metaclass__ = utils.SingletonMeta
+
+    # Minimum time in seconds for which any result is cached
+    min_ttl = 300
+    # Maximum sites kept in memory - above this expired sites
+    # and then the least recently used ones are dropped
+    max_sites = 1000
+    
+    def __init__(self, cachedir=None):
+        # Folder for persisting robots.txt files - None means
+        # the cache is in memory only
+        self.cachedir = None
+        if cachedir:
+            self.cachedir = os.path.expanduser(cachedir)
+            with utils.ignore():
+                if not os.path.isdir(self.cachedir):
+                    os.makedirs(self.cachedir)
+                    
+        # Cache entries keyed on site, least recently used first
+        self.entries = collections.OrderedDict()
+        # Parsed rules keyed on (site, useragent)
+        self.parsed = {}
+        # Per site locks so that a robots.txt is fetched
+        # only once even if many workers ask for it - as
+        # [lock, number of threads holding or waiting on it]
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def site_lock(self, site):
+        """ Hold the lock of a site. Threads using a lock are counted
+        so that it is not dropped while a thread is waiting on it """
+
+        with self.lock:
+            item = self.locks.get(site)
+            if item == None:
+                item = self.locks[site] = [threading.Lock(), 0]
+            item[1] += 1
+
+        try:
+            with item[0]:
+                yield
+        finally:
+            with self.lock:
+                item[1] -= 1
+
+    def touch(self, site, entry):
+        """ Set the entry of a site as the most recently used one,
+        dropping sites if there are too many """
+
+        with self.lock:
+            self.entries.pop(site, None)
+            self.entries[site] = entry
+            if len(self.entries) > self.max_sites:
+                self.evict()
+
+    def evict(self):
+        """ Drop expired sites and then the least recently used
+        ones till there are max_sites. Called with the lock held """
+
+        now = time.time()
+        for site in [site for site, entry in self.entries.items() if entry['expires'] <= now]:
+            del self.entries[site]
+        while len(self.entries) > self.max_sites:
+            self.entries.popitem(last=False)
+
+        self.parsed = dict((key, rules) for key, rules in self.parsed.items() if key[0] in self.entries)
+        # Locks in use are of sites being fetched or waited for
+        self.locks = dict((site, item) for site, item in self.locks.items() \
+                          if site in self.entries or item[1] > 0)
+
+    def get_path(self, site):
+        """ Return the cache file path for a site """
+
+        return os.path.join(self.cachedir, re.sub(r'[^\w\.\-]', '_', site) + '.robots')
+
+    def load(self, site):
+        """ Load the cache entry for a site from disk """
+
+        if self.cachedir == None:
+            return None
+
+        try:
+            # First line has the metadata, rest is the content
+            meta, content = open(self.get_path(site), 'rb').read().split('\n', 1)
+            entry = json.loads(meta)
+            entry['content'] = content
+            return entry
+        except (IOError, ValueError):
+            return None
+
+    def save(self, site, entry):
+        """ Save the cache entry for a site to disk """
+
+        if self.cachedir == None:
+            return
+
+        meta = dict((k,v) for k,v in entry.items() if k != 'content')
+        try:
+            # Write to a temporary file and rename so readers in other
+            # processes never see a partial file.
+            fd, tmppath = tempfile.mkstemp(dir=self.cachedir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(meta) + '\n' + entry['content'])
+            os.rename(tmppath, self.get_path(site))
+        except (IOError, OSError), e:
+            log.error('Error saving robots.txt of',site,'to cache =>',e)
+
+    def get_freshness(self, headers, ttl):
+        """ Return the time in seconds a robots.txt can be cached
+        for as per its HTTP caching headers """
+
+        freshness = ttl
+        cache_control = headers.get('cache-control', '').lower()
+
+        if ('no-cache' in cache_control) or ('no-store' in cache_control):
+            freshness = 0
+        elif 'max-age' in cache_control:
+            try:
+                freshness = int(cache_control.split('max-age')[1].lstrip(' =').split(',')[0])
+            except ValueError:
+                pass
+        elif headers.get('expires'):
+            expires = email.utils.parsedate_tz(headers.get('expires'))
+            if expires:
+                freshness = email.utils.mktime_tz(expires) - time.time()
+
+        return max(self.min_ttl, min(freshness, ttl))
+
+    def fetch(self, site, previous, ttl):
+        """ Fetch robots.txt for a site and return a
+        new cache entry """
+
+        now = time.time()
+        robots_url = site + '/robots.txt'
+        status, error = 0, ''
+        
+        try:
+            freq = urlhelper.fetch_url(robots_url, verify=True)
+            status = freq.status_code
+        except urlhelper.FetchUrlException, e:
+            error = str(e)
+
+        if status == 0 or status >= 500:
+            # Failure - allow all, try again after a backoff.
+            failures = (previous or {}).get('failures', 0) + 1
+            backoff = min(ttl, self.min_ttl * 2**(failures - 1))
+            error = error or 'HTTP status %d for %s' % (status, robots_url)
+            # Bug : This cause the frosta kommune slow crawl issue #422. The
+            # robots.txt URL of this site was causing a lot of redirects
+            # and finally failing, but we are not catching it. We need
+            # to catch it and disable the robots.txt rules of the site
+            # by adding a default allow-all rule. If we had fetched the
+            # robots.txt before, keep using it meanwhile.
+            content = (previous or {}).get('content', '')
+            return {'status': status, 'content': content, 'error': error,
+                    'failures': failures, 'expires': now + backoff}
+        elif status >= 400:
+            # No robots.txt - allow all
+            return {'status': status, 'content': '', 'error': '',
+                    'failures': 0, 'expires': now + ttl}
+        
+        return {'status': status, 'content': freq.content, 'error': '', 'failures': 0,
+                'expires': now + self.get_freshness(freq.headers, ttl)}
+
+    def get_rules(self, url, robocop):
+        """ Return a 2-tuple of the parsed robots.txt rules (RobotsRules) for
+        the site of the URL and an error message if fetching the robots.txt failed """
+
+        site = urlhelper.get_website(url, scheme=True)
+        # Site without scheme
+        site_nos = urlhelper.get_website(url, remove_www=False)
+        key = (site_nos, robocop.ua)
+
+        with self.site_lock(site_nos):
+            rules = self.parsed.get(key)
+            entry = self.entries.get(site_nos)
+            if rules is not None and not rules.expired() and entry != None:
+                self.touch(site_nos, entry)
+                return rules, ''
+
+            entry = entry or self.load(site_nos)
+            error = ''
+            if entry == None or entry['expires'] <= time.time():
+                entry = self.fetch(site, entry, robocop.ttl)
+                error = entry['error']
+                self.save(site_nos, entry)
+                
+            rules = robocop.parse_robotstxt(entry['content'].split('\n'), site_nos)
+            rules.expires = entry['expires']
+            self.parsed[key] = rules
+            self.touch(site_nos, entry)
+
+        return rules, error
+
 class Robocop(object):
     """ Robots.txt parser for websites """
 
     meta_re = re.compile(r'\<meta\s+name=\"robots\"\s+content=\"([a-zA-Z,\s]+)\"\s*', re.IGNORECASE)
+    # Time in seconds for which parsed robots.txt rules are valid
+    ttl = 86400
     
-    def __init__(self, url=None, useragent=None, debug=False):
+    def __init__(self, url=None, useragent=None, debug=False, ttl=None, cache=None):
 
         # An instance of this class is meant to be persisted
         # against a crawler and used. Don't reinitialize this
@@ -25,10 +337,14 @@ class Robocop(object):
         # instance of this class can be used to check many sites
         self.ua = useragent
         # Compiled rules - dictionary with the site
-        # as key and list of compiled rules as values
+        # as key and RobotsRules object as values
         self.rules = {}
         # Debug flag
         self.debug = debug
+        if ttl is not None: self.ttl = ttl
+        self.crawldelay = -1
+        # Shared robots.txt cache
+        self.cache = cache or RobotsCache.getInstance()
         if url: self.parse_site(url)
         
     def parse_site(self, url):
@@ -37,119 +353,120 @@ class Robocop(object):
         if self.debug:
             print 'Parsing site =>',url
 
-        site = urlhelper.get_website(url, scheme=True)
         # Site without scheme
         site_nos = urlhelper.get_website(url, remove_www=False)
         # print 'Site no scheme =>',site_nos
         # print 'Robocop rules =>',self.rules
-        # If rules already exist, don't parse again
-        if self.rules.has_key(site_nos):
+        # If rules already exist and are fresh, don't parse again
+        rules = self.rules.get(site_nos)
+        if rules is not None and not rules.expired():
             # print "Robots.txt already parsed for site",site_nos
             return True, ''
-        
-        robots_url = site + '/robots.txt'
 
-        try:
-            # print 'Robots URL =>',robots_url
-            # print 'Fetching URL =>',robots_url
-            freq = urlhelper.fetch_url(robots_url, verify=True)
-            content = freq.content.split('\n')
-            self.parse_robotstxt(content, site_nos)
-        except urlhelper.FetchUrlException, e:
-            # Bug : This cause the frosta kommune slow crawl issue #422. The
-            # robots.txt URL of this site was causing a lot of redirects
-            # and finally failing, but we are not catching it. We need
-            # to catch it and disable the robots.txt rules of the site
-            # by adding a default allow-all rule.
-            content = []
-            # Allow all
-            self.rules[site_nos] = []
-            return False, e
+        rules, error = self.cache.get_rules(url, self)
+        self.rules[site_nos] = rules
+        if error:
+            return False, error
 
         return True, ''
 
+    def get_sitemaps(self, url):
+        """ Return the sitemap URLs listed in the robots.txt
+        of the site of the URL """
+
+        self.parse_site(url)
+        site_rules = self.rules.get(urlhelper.get_website(url, remove_www=False))
+        if site_rules is None:
+            return []
+        
+        return site_rules.sitemaps[:]
+        
     def parse_robotstxt(self, content, site):
         """ Parse the robots.txt content """
         
-        sitemap = ''
-        site_rules, raw_rules = [], []
+        sitemaps = []
+        allow_rules, disallow_rules = [], []
+        ua = (self.ua or '*').lower()
         
-        useragent = '*'
-        state = ''
+        # User-agents of the current group - rules without
+        # any user-agent line apply to all
+        useragents = ['*']
+        # Was the last line a user-agent line ?
+        in_agents = False
 
         self.crawldelay = -1
 
         for line in content:
             # print 'LINE =>',line
-            line = line.lower().strip()
-            if line.startswith('#'):
-                continue
-
             # Issue #442, drop inline comments in rules
-            line = line.split('#')[0]
-            
-            if line.startswith('sitemap:'):
-                # CHECKME: So ? This is not being used further or what...
-                sitemap = ':'.join(line.split(':')[1:]).strip()
-                continue
-            # if line.lower().strip().startswith('user-agent:'):
-            if 'user-agent' in line:
-                useragent = ':'.join(line.split(':')[1:]).strip()
-                # print 'user-agent:',useragent
+            line = line.split('#')[0].strip()
+            if ':' not in line:
                 continue
-            if 'disallow' in line.lower():
-                state = 'disallow'
-                # Do we have a disallow: / ?
-            elif 'allow' in line.lower():
-                state = 'allow'
-            if (line.startswith('crawldelay:') or line.startswith('crawl-delay:')) and useragent in ('*',self.ua):
-                # Remove any comments - Issue #439
-                self.crawldelay = float(':'.join(line.split(':')[1:]).strip())
+
+            field, value = line.split(':', 1)
+            field, value = field.strip().lower(), value.strip()
+
+            if field == 'sitemap':
+                sitemaps.append(value)
                 continue
 
-            # Bug: this will catch ALL content, even if the content
-            # doesn't have the format of a robots.txt!
-            # E.g: http://www.nord-odal.kommune.no/no/robots.txt
-            if state == 'disallow' and useragent in ('*', self.ua):
-                # print useragent,disallowallow,line#,rules
-                rules = ':'.join(line.split(':')[1:]).strip().split()
-                # print 'rules=>',rules
-                for rule in rules:
-                    # print 'Rule=>',rule
-                    if rule.strip():
-                        raw_rules.append(rule)
-
-        # Compile the rules and map it to the site
-        # print 'Rules =>',raw_rules
-        # Issue #432 - Ignore default block-all rule if specific rules are present
-        if '/' in raw_rules and len(raw_rules)>1:
-            raw_rules.remove('/')
+            if field == 'user-agent':
+                # Consecutive user-agent lines form one group
+                if not in_agents:
+                    useragents = []
+                useragents.append(value.lower())
+                in_agents = True
+                continue
 
-        for rule in raw_rules:
-            # Ignore rules like .* _* etc i.e any rule ending with an asterik
-            # Fix for issue #447
-            if rule.strip().endswith('*'): continue
+            in_agents = False
+            applies = ('*' in useragents) or (ua in useragents)
+            if not applies:
+                continue
             
-            if 'http' in rule:
-                site_rules.append(rule + '.*')
-            else:
+            if field in ('crawldelay', 'crawl-delay'):
+                # Remove any comments - Issue #439
                 try:
-                    site_rules.append('https?://'+site+'/'+rule.lstrip('/')+'.*')
-                except UnicodeDecodeError:
-                    rule = rule.decode('utf-8')
-                    site_rules.append('https?://'+site+'/'+rule.lstrip('/')+'.*')
+                    self.crawldelay = float(value)
+                except ValueError:
+                    pass
+            elif field in ('allow', 'disallow'):
+                # Bug: this will catch ALL content, even if the content
+                # doesn't have the format of a robots.txt!
+                # E.g: http://www.nord-odal.kommune.no/no/robots.txt
+                rules = allow_rules if field == 'allow' else disallow_rules
+                for rule in value.split():
+                    rules.append(rule)
                     
-        # print 'Site rules =>',site_rules
-        # rules_c = [re.compile(i.lower()) for i in site_rules]
-        rules_c = []
-        for i in site_rules:
-            try:
-                rules_c.append(re.compile(i.lower()))
-            except:
-                pass
+        # print 'Rules =>',disallow_rules
+        # Issue #432 - Ignore default block-all rule if specific rules are present
+        if '/' in disallow_rules and len(disallow_rules)>1:
+            disallow_rules.remove('/')
+
+        site_rules = RobotsRules(self.crawldelay, sitemaps, ttl=self.ttl)
+        
+        for allow, rules in ((False, disallow_rules), (True, allow_rules)):
+            for rule in rules:
+                if isinstance(rule, unicode):
+                    rule = rule.encode('utf-8')
+                    
+                if rule.startswith(('http://', 'https://')):
+                    # Absolute URL as rule
+                    urlp = urlparse.urlparse(rule)
+                    if urlp.netloc.lower() != site: continue
+                    rule = urlp.path + ('?' + urlp.query if urlp.query else '')
+                elif not rule.startswith(('/', '*')):
+                    rule = '/' + rule
+
+                # Issue #447 - rules ending with an asterisk are plain prefix
+                # rules, but a rule like '*' means the whole site.
+                if rule.rstrip('*') == '':
+                    rule = '/'
+                    
+                site_rules.add(rule, allow)
             
-        self.rules[site] = rules_c
-        # print 'RULES =>',site,len(rules_c)
+        self.rules[site] = site_rules
+        # print 'RULES =>',site,site_rules.nrules
+        return site_rules
 
     def x_robots_check(self, url, headers):
         """ Check X-Robots-Tag header """
@@ -234,19 +551,89 @@ class Robocop(object):
         if meta: 
             return self.check_meta(url, content)[0]
 
-        site_rules = self.rules.get(site, [])
+        site_rules = self.rules.get(site)
         # print site_rules
         
         # Maybe no robots.txt ?
-        if len(site_rules)==0:
+        if site_rules is None or site_rules.nrules==0:
             # Allow - default
             return True
+
+        urlp = urlparse.urlparse(url)
+        path = urlp.path or '/'
+        if urlp.query: path += '?' + urlp.query
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
         
         # Check against the rules
-        return not any(rule.match(url) for rule in site_rules)
+        return site_rules.allowed(path)
                   
 if __name__ == '__main__':
 
+    # Offline tests for the rule matching
+    r = Robocop()
+    r.parse_robotstxt(['User-agent: *',
+                       'Disallow: /private/',
+                       'Allow: /private/public/',
+                       'Disallow: /*.pdf$',
+                       'Disallow: /search?q=*&page=',
+                       'Disallow: /Admin',
+                       'Disallow: /exact$',
+                       'Allow: /tie',
+                       'Disallow: /tie',
+                       'Crawl-delay: 2.5 # comment',
+                       'Sitemap: http://www.foo.com/sitemap.xml',
+                       '',
+                       'User-agent: googlebot',
+                       'Disallow: /'], 'www.foo.com')
+    assert(r.crawldelay == 2.5)
+    assert(r.rules['www.foo.com'].sitemaps == ['http://www.foo.com/sitemap.xml'])
+    assert(r.can_fetch('http://www.foo.com/'))
+    assert(not r.can_fetch('http://www.foo.com/private/x.html'))
+    assert(r.can_fetch('http://www.foo.com/private/public/x.html'))
+    assert(r.get_sitemaps('http://www.foo.com/x.html') == ['http://www.foo.com/sitemap.xml'])
+    # Longer Allow rule wins
+    assert(r.can_fetch('http://www.foo.com/private/public/x.pdf'))
+    assert(not r.can_fetch('http://www.foo.com/docs/x.pdf'))
+    assert(r.can_fetch('http://www.foo.com/x.pdf?download=1'))
+    assert(not r.can_fetch('www.foo.com/search?q=abc&page=2'))
+    assert(r.can_fetch('www.foo.com/search?q=abc'))
+    assert(not r.can_fetch('http://www.foo.com/Admin/login'))
+    assert(r.can_fetch('http://www.foo.com/admin/login'))
+    assert(not r.can_fetch('http://www.foo.com/exact'))
+    assert(r.can_fetch('http://www.foo.com/exact/not'))
+    assert(r.can_fetch('http://www.foo.com/tie'))
+    # Issue #432
+    r.parse_robotstxt(['User-agent: *', 'Disallow: /', 'Disallow: /tmp'], 'www.bar.com')
+    assert(r.can_fetch('http://www.bar.com/index.html'))
+    assert(not r.can_fetch('http://www.bar.com/tmp/x'))
+
+    # Expired and then least recently used sites are dropped from the cache
+    cache = RobotsCache.getInstance()
+    cache.max_sites = 2
+    now = time.time()
+    cache.touch('a.com', {'expires': now + 100})
+    cache.touch('b.com', {'expires': now - 1})
+    cache.touch('c.com', {'expires': now + 100})
+    assert(cache.entries.keys() == ['a.com', 'c.com'])
+    cache.touch('a.com', {'expires': now + 100})
+    cache.touch('d.com', {'expires': now + 100})
+    assert(cache.entries.keys() == ['a.com', 'd.com'])
+
+    # Locks of sites not in the cache are kept while threads wait on them
+    def waiter():
+        with cache.site_lock('e.com'): pass
+    with cache.site_lock('e.com'):
+        lock = cache.locks['e.com'][0]
+        t = threading.Thread(target=waiter)
+        t.start()
+        while cache.locks['e.com'][1] < 2: time.sleep(0.01)
+        cache.touch('f.com', {'expires': now + 100})
+        assert(cache.locks['e.com'][0] is lock)
+    t.join()
+    cache.touch('g.com', {'expires': now + 100})
+    assert('e.com' not in cache.locks)
+    
     # These are unit-tests for robocop module.
     # Issue #442
     r = Robocop('http://kildare.ie', debug=True)
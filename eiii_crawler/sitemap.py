@@ -0,0 +1,182 @@
+# -- coding: utf-8
+""" Streaming reader of XML sitemaps and sitemap indexes """
+
+import re
+import zlib
+import calendar
+import xml.etree.cElementTree as ElementTree
+
+import eiii_crawler.urlhelper as urlhelper
+import eiii_crawler.utils as utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+# W3C datetime as used by lastmod - date, optional time and timezone
+lastmod_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)(?:T(\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?\s*(Z|[+-]\d\d:?\d\d)?)?$')
+
+def parse_lastmod(value):
+    """ Return lastmod value of a sitemap entry as seconds since
+    the epoch (UTC) or None if it cannot be parsed """
+
+    m = lastmod_re.match(value.strip())
+    if m == None:
+        return None
+
+    year, month, day, hour, minute, second, tz = m.groups()
+    try:
+        ts = calendar.timegm((int(year), int(month), int(day), int(hour or 0),
+                              int(minute or 0), int(second or 0), 0, 0, 0))
+    except ValueError:
+        return None
+
+    if tz and tz != 'Z':
+        tz = tz.replace(':', '')
+        offset = 3600*int(tz[1:3]) + 60*int(tz[3:5])
+        ts += (-offset if tz[0] == '+' else offset)
+
+    return ts
+
+class SitemapTarget(object):
+    """ Parser target collecting the entries of a sitemap
+    (<url>) or sitemap index (<sitemap>) as they are parsed """
+
+    def __init__(self):
+        # Parsed entries not yet taken - (type, loc, lastmod) tuples
+        self.entries = []
+        self.entry = None
+        self.text = []
+
+    def start(self, tag, attrib):
+        tag = tag.rsplit('}', 1)[-1]
+        if tag in ('url', 'sitemap'):
+            self.entry = {}
+        self.text = []
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, tag):
+        tag = tag.rsplit('}', 1)[-1]
+        if self.entry == None:
+            return
+
+        if tag in ('loc', 'lastmod'):
+            self.entry[tag] = ''.join(self.text).strip()
+        elif tag in ('url', 'sitemap'):
+            if self.entry.get('loc'):
+                self.entries.append((tag, self.entry['loc'], parse_lastmod(self.entry.get('lastmod', ''))))
+            self.entry = None
+
+    def close(self):
+        pass
+
+class SitemapReader(object):
+    """ Reader of the sitemaps of a site. Sitemaps are parsed
+    incrementally while they are downloaded, so that large sitemaps
+    are never held in memory. Gzipped sitemaps are decompressed on
+    the fly and sitemap indexes are followed """
+
+    # Read size for downloads
+    chunk_size = 65536
+
+    def __init__(self, config, maxurls=0, maxsitemaps=100):
+        self.config = config
+        # Maximum number of URLs to read, 0 for no limit
+        self.maxurls = maxurls
+        # Maximum number of sitemap files to read
+        self.maxsitemaps = maxsitemaps
+
+    def read(self, url):
+        """ Download and parse a sitemap, yielding its entries as
+        (type, loc, lastmod) tuples where type is 'url' or 'sitemap' """
+
+        headers = {'user-agent': self.config.get_real_useragent()}
+        try:
+            freq = urlhelper.get_url(url, headers=headers,
+                                     proxy=self.config.network_proxy,
+                                     verify=self.config.flag_ssl_validate)
+        except urlhelper.FetchUrlException, e:
+            log.error('Error downloading sitemap',url,'=>',str(e))
+            return
+
+        if freq.status_code != 200:
+            log.info('Sitemap',url,'not found, status code',freq.status_code)
+            freq.close()
+            return
+
+        target = SitemapTarget()
+        parser = ElementTree.XMLParser(target=target)
+        decompressor = None
+
+        try:
+            for chunk in freq.iter_content(self.chunk_size):
+                # A .xml.gz file - not a gzip content-encoding
+                # which is already decoded.
+                if decompressor == None and chunk.startswith('\x1f\x8b'):
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                if decompressor != None:
+                    chunk = decompressor.decompress(chunk)
+
+                parser.feed(chunk)
+                for entry in target.entries:
+                    yield entry
+                del target.entries[:]
+
+            parser.close()
+            for entry in target.entries:
+                yield entry
+        except (SyntaxError, zlib.error), e:
+            # cElementTree raises ParseError, a SyntaxError
+            log.error('Error parsing sitemap',url,'=>',str(e))
+        except Exception, e:
+            log.error('Error reading sitemap',url,'=>',str(e))
+        finally:
+            freq.close()
+
+    def iter_urls(self, sitemap_urls):
+        """ Yield (URL, lastmod) tuples of all URLs listed in the
+        sitemaps, following sitemap indexes """
+
+        pending = list(sitemap_urls)
+        seen = set(pending)
+        nsitemaps, nurls = 0, 0
+
+        while pending and nsitemaps < self.maxsitemaps:
+            url = pending.pop(0)
+            nsitemaps += 1
+            log.info('Reading sitemap',url,'...')
+
+            for etype, loc, lastmod in self.read(url):
+                if etype == 'sitemap':
+                    if loc not in seen:
+                        seen.add(loc)
+                        pending.append(loc)
+                    continue
+
+                yield loc, lastmod
+                nurls += 1
+                if self.maxurls and nurls >= self.maxurls:
+                    log.info('Read maximum of',nurls,'URLs from sitemaps.')
+                    return
+
+if __name__ == "__main__":
+    assert parse_lastmod('2014-06-17') == calendar.timegm((2014, 6, 17, 0, 0, 0))
+    assert parse_lastmod('2014-06-17T10:30:00+02:00') == calendar.timegm((2014, 6, 17, 8, 30, 0))
+    assert parse_lastmod('2014-06-17T10:30:00.45Z') == calendar.timegm((2014, 6, 17, 10, 30, 0))
+    assert parse_lastmod('yesterday') == None
+
+    target = SitemapTarget()
+    parser = ElementTree.XMLParser(target=target)
+    sitemap = """<?xml version="1.0" encoding="UTF-8"?>
+    <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+    <url><loc>http://www.foo.com/</loc><lastmod>2014-06-17</lastmod></url>
+    <url><loc> http://www.foo.com/about.html </loc></url>
+    </urlset>"""
+    # Feed in small pieces as when downloading
+    for i in range(0, len(sitemap), 7):
+        parser.feed(sitemap[i:i+7])
+    parser.close()
+    assert target.entries == [('url', 'http://www.foo.com/', parse_lastmod('2014-06-17')),
+                              ('url', 'http://www.foo.com/about.html', None)]
+    print 'All tests passed.'
@@ -9,6 +9,8 @@ import traceback
 
 from eiii_crawler import utils
 from eiii_crawler import urlhelper
+from eiii_crawler import crawlercontext
+from eiii_crawler.crawlertiming import CrawlerTimings
 
 from eiii_crawler.crawlerbase import CrawlerUrlData, CrawlerWorkerBase
 from eiii_crawler.crawlerevent import CrawlerEventRegistry
@@ -23,7 +25,11 @@ class ThreadedWorkerBase(threading.Thread, CrawlerWorkerBase):
         """ Initializer - sets configuration """
 
         self.config = config
+        # Snapshot of settings used in the per-URL loop
+        self.settings = config.snapshot()
         self.state = 0
+        # Crawl context of the creating thread
+        self.context = crawlercontext.get_context()
         # Prepare config
         self.prepare_config()
         threading.Thread.__init__(self, None, None, 'ThreadedCrawlerWorker-' + uuid.uuid4().hex)
@@ -31,15 +37,15 @@ class ThreadedWorkerBase(threading.Thread, CrawlerWorkerBase):
 
     def __getattr__(self, name):
         """ Overloaded getattr method to allow
-        access of config variables as local attributes """
+        access of config variables as local attributes. This is
+        only called when regular lookup fails - code in the per-URL
+        loop should use self.settings instead """
 
-        try:
-            return self.__dict__[name]
-        except KeyError:
-            try:
-                return getattr(self.config, name)
-            except AttributeError:
-                raise
+        if name in ('config', 'settings', 'context'):
+            # Not initialized yet
+            raise AttributeError, name
+
+        return getattr(self.config, name)
 
     def get_state(self):
         """ Return the state """
@@ -69,12 +75,16 @@ class ThreadedWorkerBase(threading.Thread, CrawlerWorkerBase):
     def sleep(self):
         """ Sleep it off """
         
+        settings = self.settings
         # Sleep
-        if self.flag_randomize_sleep:
+        if settings.flag_randomize_sleep:
             # Randomize 50% on both sides
-            time.sleep(random.uniform(self.time_sleeptime, self.time_sleeptime*2))
+            sleeptime = random.uniform(settings.time_sleeptime, settings.time_sleeptime*2)
         else:
-            time.sleep(self.time_sleeptime)
+            sleeptime = settings.time_sleeptime
+
+        time.sleep(sleeptime)
+        CrawlerTimings.getInstance().record('sleep', sleeptime)
 
     def do_crawl(self):
         """ Do the actual crawl. This function provides a pluggable
@@ -88,11 +98,15 @@ class ThreadedWorkerBase(threading.Thread, CrawlerWorkerBase):
         """
 
         eventr = CrawlerEventRegistry.getInstance()
+        timings = CrawlerTimings.getInstance()
+        settings = self.settings
 
         while self.work_pending() and (not self.should_stop()):
             # State is 0 - about to get data
             self.state = 0
+            t = time.time()
             data = self.get()
+            timings.record('frontier_wait', time.time() - t)
 
             eventr.publish(self, 'heartbeat')
             
@@ -134,10 +148,16 @@ class ThreadedWorkerBase(threading.Thread, CrawlerWorkerBase):
                        self.allowed(url, parent_url, url_data, content_type, headers, parse=True):
 
                     # Can proceed further
-                    # Parse the data
-                    url, child_urls = self.parse(url_data, url)
+                    # Parse the data unless the URL is unchanged since
+                    # an earlier crawl which found its children.
+                    reused = self.reuse_children(url, urlobj)
+                    if reused != None:
+                        url, child_urls = reused
+                    else:
+                        url, child_urls = self.parse(url_data, url)
+                        self.save_children(url, urlobj, child_urls)
 
-                    if self.flag_randomize_urls:
+                    if settings.flag_randomize_urls:
                         random.shuffle(child_urls)
                         
                     newurls = []
@@ -199,6 +219,8 @@ class ThreadedWorkerBase(threading.Thread, CrawlerWorkerBase):
         """ Do the actual crawl """
 
         log.info('Worker',self,'starting...')
+        # Run in the crawl context of the creator
+        crawlercontext.set_context(self.context)
         # Defines the "framework" for crawling
         try:
             self.before_crawl()
@@ -0,0 +1,218 @@
+"""
+End to end benchmark of a crawl against a local synthetic website.
+
+Starts the synthetic site of synthsite.py in a process of its own and
+crawls it with EIIICrawler, each crawl in a fresh process. The crawls
+use cache, stats and robots folders made empty for the benchmark. By
+default the site is crawled twice, sharing the cache, so that the
+second crawl can measure the cached (304) path. For every crawl it reports
+
+pages/sec - URLs downloaded or served from cache per second of crawl
+CPU per page - user+system CPU time of the crawler process per URL
+peak RSS - maximum resident memory of the crawler process
+time to first page - from crawl start to the first URL done
+
+along with request counters of the site. Everything runs on the local
+machine, so results of different configurations and versions can be
+compared with each other.
+
+$ python bench_crawl.py --pages 2000 --latency 20 --workers 4
+
+Known issues of the crawler which affect the results,
+
+1. CachingUrlData.write_headers_and_data looks up 'last-modified' and
+   'etag' in dict(self.headers), which keeps the capitalisation of the
+   response headers. So only the start URL is cached and later crawls
+   download everything again. A later crawl with no URLs from the cache
+   is reported with a warning and marked 'cache_miss' in the JSON - its
+   numbers are not of the cached path.
+2. The 'verify' flag is passed to requests among the request headers,
+   which requests 2.11 and later reject as a header value that is not a
+   string. Crawls need requests older than 2.11, though setup.py asks
+   for 2.20 or later.
+
+Instead of the synthetic site, a real site can be crawled once with its
+requests recorded to an HTTP archive (see crawlertransport) and then be
+crawled any number of times offline from the archive.
+
+$ python bench_crawl.py --url http://www.example.com/ --runs 1 --record example
+$ python bench_crawl.py --url http://www.example.com/ --replay example --timescale 0
+"""
+
+import os
+import json
+import Queue
+import time
+import shutil
+import urllib2
+import resource
+import argparse
+import tempfile
+import multiprocessing
+
+from synthsite import SyntheticSiteServer, add_site_arguments, make_site
+
+def serve(args, conn):
+    """ Run the synthetic site, sending its port through conn """
+
+    server = SyntheticSiteServer(('127.0.0.1', args.port), make_site(args))
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+def get_cpu_time():
+    """ Return user+system CPU time in seconds of this process """
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def crawl(url, args, workdir, queue):
+    """ Crawl the site once, putting the measurements to queue """
+
+    from eiii_crawler import utils
+    from eiii_crawler.crawler import EIIICrawler
+
+    log = utils.get_default_logger()
+    log.setLevel(args.loglevel)
+
+    config = {'num_workers': args.workers,
+              'time_sleeptime': args.sleeptime,
+              'flag_randomize_sleep': False,
+              'time_worker_rampup': args.rampup,
+              'flag_sitemaps': args.sitemaps,
+              'network_record': args.record or '',
+              'network_replay': args.replay or '',
+              'network_timescale': args.timescale,
+              'url_limits': {'text/html': args.pages + 1},
+              'storedir': os.path.join(workdir, 'store'),
+              'statsdir': os.path.join(workdir, 'stats'),
+              'robotsdir': os.path.join(workdir, 'robots')}
+
+    crawler = EIIICrawler([url], fromdict=config)
+    first = []
+
+    def first_page(event):
+        if not first:
+            first.append(time.time())
+
+    crawler.eventr.subscribe('download_complete', first_page)
+    crawler.eventr.subscribe('download_cache', first_page)
+
+    cpu_time, start = get_cpu_time(), time.time()
+    crawler.crawl()
+    # Workers may be idle at first till they get the start URL
+    while crawler.work_pending() or (not first and time.time() - start < 30):
+        time.sleep(0.05)
+
+    elapsed = time.time() - start
+    cpu_time = get_cpu_time() - cpu_time
+    [w.stop() for w in crawler.workers]
+    crawler.eventr.publish(crawler, 'crawl_ended')
+
+    stats = crawler.stats
+    npages = stats.num_urls_downloaded + stats.num_urls_cache
+    queue.put({'pages': stats.num_urls_downloaded,
+               'cached': stats.num_urls_cache,
+               'errors': stats.num_urls_error,
+               'skipped': stats.num_urls_skipped,
+               'elapsed': elapsed,
+               'pages_per_sec': npages/elapsed,
+               'cpu_ms_per_page': 1000.0*cpu_time/max(npages, 1),
+               # Kilobytes on Linux
+               'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+               'ttfp_ms': 1000.0*(first[0] - start) if first else None})
+
+def get_site_stats(url):
+    """ Return request counters of the synthetic site """
+
+    return json.loads(urllib2.urlopen(url + '_stats').read())
+
+def print_result(i, result, site_stats):
+    """ Print measurements of a crawl """
+
+    ttfp = '%.1f ms' % result['ttfp_ms'] if result['ttfp_ms'] != None else '-'
+    print 'Crawl %d: %d downloaded, %d from cache, %d errors, %d skipped in %.2fs' % \
+          (i, result['pages'], result['cached'], result['errors'], result['skipped'], result['elapsed'])
+    print '  pages/sec: %.1f, CPU/page: %.2f ms, peak RSS: %.1f MB, time to first page: %s' % \
+          (result['pages_per_sec'], result['cpu_ms_per_page'], result['peak_rss_mb'], ttfp)
+    if site_stats:
+        print '  site: %s' % ', '.join('%s=%d' % item for item in sorted(site_stats.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark crawls of a local synthetic website')
+    add_site_arguments(parser)
+    parser.add_argument('--port', dest='port', type=int, default=0, help='Port of the site (default any)')
+    parser.add_argument('-w','--workers', dest='workers', type=int, default=2, help='Crawler workers')
+    parser.add_argument('-s','--sleeptime', dest='sleeptime', type=float, default=0,
+                        help='Sleep time of workers between URLs in seconds')
+    parser.add_argument('--rampup', dest='rampup', type=float, default=0,
+                        help='Wait after starting a worker per worker yet to start, in seconds')
+    parser.add_argument('--sitemaps', dest='sitemaps', action='store_true', help='Seed crawl from sitemap')
+    parser.add_argument('-r','--runs', dest='runs', type=int, default=2,
+                        help='Crawls of the site sharing the cache - later ones should be cached')
+    parser.add_argument('--url', dest='url', help='Crawl this URL instead of the synthetic site')
+    parser.add_argument('--record', dest='record', metavar='DIR', help='Record requests to archive DIR')
+    parser.add_argument('--replay', dest='replay', metavar='DIR', help='Replay requests from archive DIR')
+    parser.add_argument('--timescale', dest='timescale', type=float, default=1.0,
+                        help='Factor of recorded times to sleep when replaying')
+    parser.add_argument('-l','--loglevel', dest='loglevel', default='error', help='Crawler log level')
+    parser.add_argument('--json', dest='json', metavar='FILE', help='Write results as JSON to FILE')
+    args = parser.parse_args()
+
+    if args.replay and not args.url:
+        parser.error('--replay needs the --url of the recorded crawl')
+
+    server = None
+    if args.url:
+        url = args.url
+    else:
+        parent_conn, child_conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve, args=(args, child_conn))
+        server.daemon = True
+        server.start()
+        url = 'http://127.0.0.1:%d/' % parent_conn.recv()
+
+    workdir = tempfile.mkdtemp(prefix='bench_crawl')
+    for folder in ('stats', 'robots'):
+        os.makedirs(os.path.join(workdir, folder))
+    from eiii_crawler import utils
+    utils.create_cache_structure(os.path.join(workdir, 'store'))
+
+    if server != None:
+        print 'Site: %s - %d pages, fanout %d, %d byte pages, %.1f ms %s latency' % \
+              (url, args.pages, args.fanout, args.page_size, args.latency, args.latency_dist)
+    else:
+        print 'Site: %s%s' % (url, ' replayed from ' + args.replay if args.replay else '')
+
+    results = []
+    try:
+        for i in range(args.runs):
+            before = get_site_stats(url) if server != None else {}
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=crawl, args=(url, args, workdir, queue))
+            proc.start()
+            while True:
+                try:
+                    result = queue.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    if not proc.is_alive():
+                        raise SystemExit('Crawl process failed')
+            proc.join()
+
+            after = get_site_stats(url) if server != None else {}
+            site_stats = dict((key, after[key] - before.get(key, 0)) for key in after)
+            result['site'] = site_stats
+            # Later crawls are meant to measure the cached path
+            result['cache_miss'] = (i > 0 and result['cached'] == 0)
+            results.append(result)
+            print_result(i + 1, result, site_stats)
+            if result['cache_miss']:
+                print '  WARNING: no URLs from cache - not a measurement of the cached path (see known issues)'
+    finally:
+        if server != None:
+            server.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        json.dump({'options': vars(args), 'results': results}, open(args.json, 'w'), indent=1)
+        print 'Wrote results to',args.json
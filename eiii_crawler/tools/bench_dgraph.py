@@ -0,0 +1,113 @@
+"""
+Benchmark of building the directed graph returned by poll.
+
+Builds synthetic URL graphs of 10k, 100k and 1M edges and compares
+the list.index based builder which was used earlier with the index
+based make_directed_graph and the compact CSR format returned by
+make_compact_graph. The earlier builder is O(V.E), so it is only
+run on graphs up to --max-old edges.
+"""
+
+import time
+import random
+import argparse
+
+from eiii_crawler.eiii_crawler_server import make_directed_graph, make_compact_graph, expand_compact_graph
+
+def make_directed_graph_old(url_graph):
+    """ The list.index based builder """
+
+    url_set = set()
+    url_ctype = {}
+
+    for url_key, url_values in url_graph.items():
+        url_set.add(url_key)
+        url_ctype[url_key] = 'text/html'
+
+        for url, ctype in url_values:
+            url_set.add(url)
+            url_ctype[url] = ctype
+
+    url_list = list(url_set)
+    url_dgraph = []
+
+    for url in url_list:
+        ctype = url_ctype[url]
+        child_index = []
+
+        if url in url_graph:
+            child_urls = map(lambda x: x[0], url_graph[url])
+            for child_url in child_urls:
+                child_index.append(url_list.index(child_url))
+
+        url_dgraph.append((ctype, url, child_index))
+
+    return url_dgraph
+
+def synthetic_graph(nedges, nlinks, seed=0):
+    """ Return a URL graph with about nedges edges, with
+    nlinks links per page, a fifth of them to documents """
+
+    rnd = random.Random(seed)
+    npages = max(1, nedges/nlinks)
+    pages = ['http://www.foo.com/page%d.html' % i for i in range(npages)]
+
+    url_graph = {}
+    for url in pages:
+        children = set()
+        for i in range(nlinks):
+            if rnd.random() < 0.2:
+                children.add(('http://www.foo.com/doc%d.pdf' % rnd.randint(0, npages), 'application/pdf'))
+            else:
+                children.add((rnd.choice(pages), 'text/html'))
+        url_graph[url] = children
+
+    return url_graph
+
+def bench(func, url_graph, repeat):
+    """ Return best time in seconds for building the graph """
+
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        func(url_graph)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+
+    return best
+
+def same_graph(dgraph1, dgraph2):
+    """ Return True if both directed graphs describe the same URL graph """
+
+    def edges(dgraph):
+        return sorted((ctype, url, sorted(dgraph[i][1] for i in children)) for ctype, url, children in dgraph)
+
+    return edges(dgraph1) == edges(dgraph2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark building the directed URL graph')
+    parser.add_argument('-e','--edges', dest='edges', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='Number of edges of the synthetic graphs')
+    parser.add_argument('-l','--links', dest='links', type=int, default=100, help='Links per page')
+    parser.add_argument('-m','--max-old', dest='max_old', type=int, default=100000,
+                        help='Run the list.index builder only on graphs up to this many edges')
+    parser.add_argument('-r','--repeat', dest='repeat', type=int, default=3, help='Repeat count')
+    args = parser.parse_args()
+
+    for nedges in args.edges:
+        url_graph = synthetic_graph(nedges, args.links)
+        nedges = sum(map(len, url_graph.values()))
+
+        dgraph = make_directed_graph(url_graph)
+        assert same_graph(dgraph, expand_compact_graph(make_compact_graph(url_graph)))
+
+        print '%d pages, %d URLs, %d edges' % (len(url_graph), len(dgraph), nedges)
+        if nedges <= args.max_old:
+            assert same_graph(dgraph, make_directed_graph_old(url_graph))
+            told = bench(make_directed_graph_old, url_graph, 1)
+            print '\tlist.index:  %.3fs' % told
+        tnew = bench(make_directed_graph, url_graph, args.repeat)
+        tcsr = bench(make_compact_graph, url_graph, args.repeat)
+        print '\tindex map:   %.3fs' % tnew
+        print '\tcompact CSR: %.3fs' % tcsr
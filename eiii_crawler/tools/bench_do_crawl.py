@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of the ThreadedWorkerBase.do_crawl inner loop.
+
+Runs the per-URL loop over an in-memory frontier with downloading,
+parsing and sleeping stubbed out, once with workers reading settings
+through the config __getattr__ fallthrough (old behaviour) and once
+with the slotted settings snapshot.
+"""
+
+import time
+import argparse
+
+from eiii_crawler import utils
+from eiii_crawler.crawlerbase import CrawlerConfig
+from eiii_crawler.threaded import ThreadedWorkerBase
+
+# Keep the loop quiet
+log = utils.get_default_logger()
+log.setLevel('error')
+
+class FakeUrlData(object):
+    """ Downloaded URL stand-in """
+
+    status = True
+
+    def __init__(self, url, content_type):
+        self.url = url
+        self.content_type = content_type
+
+    def get_data(self): return '<html></html>'
+    def get_headers(self): return {}
+    def get_url(self): return self.url
+    def get_content_type(self): return self.content_type
+
+class BenchWorker(ThreadedWorkerBase):
+    """ Worker crawling a fixed number of synthetic URLs """
+
+    def __init__(self, config, nurls, nchildren):
+        self.urls = [('text/html','http://www.foo.com/page%d.html' % i, None) for i in range(nurls)]
+        self.children = ['/child%d.html' % i for i in range(nchildren)]
+        ThreadedWorkerBase.__init__(self, config)
+
+    def work_pending(self): return len(self.urls)>0
+    def get(self, timeout=30): return self.urls.pop()
+    def parse_queue_urls(self, data): return data
+    def download(self, url, parent_url=None, content_type='text/html'): return FakeUrlData(url, content_type)
+    def parse(self, data, url): return (url, self.children[:])
+    def build_url(self, child_url, parent_url): return 'http://www.foo.com' + child_url
+    def push(self, content_type, url, parent_url, key=None): return True
+    def sleep(self): self.sleeptime = self.settings.time_sleeptime
+
+    def allowed(self, url, parent_url=None, content=None, content_type='text/html', headers={},
+                parse=False, download=False):
+        # Flags looked up by EIIICrawlerQueuedWorker for every URL
+        settings = self.settings
+        return (content_type in settings.client_valid_mimetypes) and \
+               not (settings.flag_ignorerobots and settings.flag_metarobots and settings.flag_x_robots)
+
+class LegacyBenchWorker(BenchWorker):
+    """ Same worker, reading config through the old __getattr__ """
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            return getattr(self.config, name)
+
+    def sleep(self): self.sleeptime = self.time_sleeptime
+
+    def allowed(self, url, parent_url=None, content=None, content_type='text/html', headers={},
+                parse=False, download=False):
+        return (content_type in self.config.client_mimetypes + self.config.client_extended_mimetypes) and \
+               not (self.flag_ignorerobots and self.flag_metarobots and self.flag_x_robots)
+
+    def do_crawl(self):
+        # The loop reads the randomize flag through __getattr__
+        self.settings = self
+        ThreadedWorkerBase.do_crawl(self)
+
+def bench(klass, config, nurls, nchildren, repeat):
+    """ Return best time in seconds for crawling nurls URLs """
+
+    best = None
+    for i in range(repeat):
+        worker = klass(config, nurls, nchildren)
+        t = time.time()
+        worker.do_crawl()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the do_crawl inner loop')
+    parser.add_argument('-n','--nurls', dest='nurls', type=int, default=2000, help='URLs to crawl')
+    parser.add_argument('-c','--nchildren', dest='nchildren', type=int, default=50, help='Child URLs per page')
+    parser.add_argument('-r','--repeat', dest='repeat', type=int, default=5, help='Repeat count')
+    args = parser.parse_args()
+
+    config = CrawlerConfig()
+    config.time_sleeptime = 0
+
+    told = bench(LegacyBenchWorker, config, args.nurls, args.nchildren, args.repeat)
+    tnew = bench(BenchWorker, config, args.nurls, args.nchildren, args.repeat)
+
+    print 'URLs: %d, child URLs per page: %d' % (args.nurls, args.nchildren)
+    print 'config fallthrough: %.3fs (%.1f usec/URL)' % (told, 1e6*told/args.nurls)
+    print 'settings snapshot:  %.3fs (%.1f usec/URL)' % (tnew, 1e6*tnew/args.nurls)
+    print 'speedup: %.2fx' % (told/tnew)
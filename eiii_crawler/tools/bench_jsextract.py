@@ -0,0 +1,92 @@
+"""
+Benchmark of the script block extraction in HTMLJSParser.
+
+Compares the pyparsing grammar which was used earlier for extracting
+script blocks and trimming HTML comments with the linear scanner,
+on the saved pages in js/samples and on one large page made of all
+of them. Statements and positions of both are checked to be the same.
+
+Needs pyparsing for the old grammar. The statements of the old grammar
+are sliced from the page at the positions given by scanString, since
+the layout of its tokens differs across pyparsing versions.
+"""
+
+import os
+import glob
+import time
+import argparse
+
+from pyparsing import *
+
+import js.jsparser as jsparser
+
+class PyparsingJSParser(jsparser.HTMLJSParser):
+   """ HTMLJSParser extracting scripts using pyparsing """
+
+   script_content = Literal("<") + Literal("script") + ZeroOrMore(Word(alphas) + Literal("=") + Word(alphanums + "./\"'")) + Literal(">") + SkipTo(Literal("</") + Literal("script") + Literal(">"), True)
+   comment_open = Literal("<!--") + SkipTo("\n", include=True)
+   comment_close = Literal("//") + ZeroOrMore(Word(alphanums)) + Literal("-->")
+
+   def __init__(self):
+      self.comment_open.setParseAction(replaceWith(''))
+      self.comment_close.setParseAction(replaceWith(''))
+      jsparser.HTMLJSParser.__init__(self)
+
+   def extract(self, prefilter=False):
+      # scanString positions are in the page with tabs expanded
+      rawdata = self.rawdata.expandtabs()
+      for tokens, start, end in self.script_content.scanString(rawdata):
+         # Script is between the end of the opening tag and
+         # the closing tag - attribute values have no '>'
+         block = rawdata[start:end]
+         statement = block[block.index('>')+1:block.rindex('</')]
+         self.statements.append(statement.strip())
+         self.positions.append((start, end))
+
+      for x in range(len(self.statements)):
+         s = self.statements[x]
+         s = self.comment_open.transformString(s)
+         s = self.comment_close.transformString(s)
+         s = self.syntaxendre.sub('', s).strip()
+         if s: self.statements[x] = s
+
+def extract(klass, data):
+   p = klass()
+   p.feed(data)
+   return p.statements, p.positions
+
+def bench(klass, pages, repeat):
+   """ Return best time in seconds for extracting scripts from all pages """
+
+   best = None
+   for i in range(repeat):
+      t = time.time()
+      for data in pages:
+         extract(klass, data)
+      t = time.time() - t
+      if best is None or t < best:
+         best = t
+
+   return best
+
+if __name__ == "__main__":
+   samples = os.path.join(os.path.dirname(jsparser.__file__), 'samples')
+
+   parser = argparse.ArgumentParser(description='Benchmark JS script block extraction')
+   parser.add_argument('-s','--samples', dest='samples', default=samples, help='Folder with saved HTML pages')
+   parser.add_argument('-r','--repeat', dest='repeat', type=int, default=3, help='Repeat count')
+   args = parser.parse_args()
+
+   pages = [open(fpath).read() for fpath in sorted(glob.glob(os.path.join(args.samples, '*.html')))]
+
+   for name, corpus in (('saved pages', pages), ('large page', [''.join(pages)])):
+      mismatch = [i for i, data in enumerate(corpus) \
+                  if extract(PyparsingJSParser, data) != extract(jsparser.HTMLJSParser, data)]
+
+      size = sum(map(len, corpus))
+      told = bench(PyparsingJSParser, corpus, args.repeat)
+      tnew = bench(jsparser.HTMLJSParser, corpus, args.repeat)
+      print '%d %s (%d KB), different output: %d' % (len(corpus), name, size/1024, len(mismatch))
+      print '\tpyparsing: %.3fs (%.2f ms/page)' % (told, 1000*told/len(corpus))
+      print '\tscanner:   %.3fs (%.2f ms/page)' % (tnew, 1000*tnew/len(corpus))
+      print '\tspeedup: %.1fx' % (told/max(tnew, 1e-6))
@@ -0,0 +1,78 @@
+"""
+Benchmark of the JS redirect detection done for every crawled page.
+
+Compares building a new JSParser and extracting all script blocks
+for every page with the re-used parser which extracts only the
+script blocks referring to the location or writing to the document.
+The corpus is the saved pages in js/samples plus the same pages with
+their scripts removed.
+"""
+
+import os
+import re
+import glob
+import time
+import argparse
+
+import js.jsparser as jsparser
+
+script_block_re = re.compile(r'<[ \t\r\n]*script.*?</[ \t\r\n]*script[ \t\r\n]*>', re.DOTALL)
+
+def load_corpus(folder):
+    """ Return pages with and without JS from the samples folder """
+
+    with_js, without_js = [], []
+    for fpath in sorted(glob.glob(os.path.join(folder, '*.html'))):
+        data = open(fpath).read()
+        with_js.append(data)
+        without_js.append(script_block_re.sub('', data))
+
+    return with_js, without_js
+
+def parse(jsp, data):
+    try:
+        jsp.parse(data)
+    except jsparser.JSParserException:
+        pass
+    
+def parse_new(pages):
+    for data in pages:
+        jsp = jsparser.JSParser()
+        jsp.prefilter = False
+        parse(jsp, data)
+
+def parse_reused(pages):
+    for data in pages:
+        parse(jsparser.get_parser(), data)
+
+def bench(func, pages, repeat):
+    """ Return best time in seconds for parsing all pages """
+
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        func(pages)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+
+    return best
+
+if __name__ == "__main__":
+    samples = os.path.join(os.path.dirname(jsparser.__file__), 'samples')
+    
+    parser = argparse.ArgumentParser(description='Benchmark JS redirect detection')
+    parser.add_argument('-s','--samples', dest='samples', default=samples, help='Folder with saved HTML pages')
+    parser.add_argument('-r','--repeat', dest='repeat', type=int, default=3, help='Repeat count')
+    args = parser.parse_args()
+
+    with_js, without_js = load_corpus(args.samples)
+    
+    for name, pages in (('pages with JS', with_js), ('pages without JS', without_js)):
+        size = sum(map(len, pages))
+        told = bench(parse_new, pages, args.repeat)
+        tnew = bench(parse_reused, pages, args.repeat)
+        print '%d %s (%d KB)' % (len(pages), name, size/1024)
+        print '\tnew parser, all blocks: %.3fs (%.2f ms/page)' % (told, 1000*told/len(pages))
+        print '\tre-used parser, prefilter: %.3fs (%.2f ms/page)' % (tnew, 1000*tnew/len(pages))
+        print '\tspeedup: %.1fx' % (told/max(tnew, 1e-6))
@@ -0,0 +1,119 @@
+"""
+Micro-benchmark of logging overhead per crawled URL.
+
+Makes the log calls of a worker for one URL - a few debug and extra
+calls with a URL and some numbers and one info call - for a number of
+URLs, with the logger at the debug, info and error levels. Each level
+is run with the old formatting of every call before the level check
+(legacy), with level gating and log files written by the logging
+thread (sync) and with level gating and a writer thread (async). For
+async the time to drain the queue of the writer is reported separately,
+since that is not spent by the workers.
+
+$ python bench_logging.py --nurls 20000 --threads 4
+"""
+
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+
+from eiii_crawler import logger
+
+class LegacyLoggerWrapper(logger.LoggerWrapper):
+    """ Logger formatting every call before checking the level """
+
+    def _dolog(self, levelname, msg, *args, **kwargs):
+        tsofar = self._getTimeSpent()
+        message = self._getMessage(msg, *args)
+        if levelname == 'extra':
+            if self._log.level <= logging.EXTRA:
+                return self._log.info(message, extra={'timespent': tsofar})
+        else:
+            return getattr(self._log, levelname)(message, extra={'timespent': tsofar})
+
+def log_url(log, i):
+    """ Log calls made by a worker for one URL """
+
+    url = 'http://www.foo.com/section%d/page%d.html' % (i % 10, i)
+    parent_url = 'http://www.foo.com/section%d/' % (i % 10)
+    log.debug('Downloading URL',url,'from parent',parent_url,'...')
+    log.debug('Content-type for',url,'is','text/html')
+    log.extra('Downloaded',url,'in',0.25,'seconds','size',16384)
+    log.debug('Parsing URL',url,'...')
+    log.debug('Found',42,'child URLs for',url)
+    log.info('Crawled URL',url,'=>',i)
+
+# Log calls per URL above
+calls_per_url = 6
+
+def make_logger(klass, logfile, level, async):
+    """ Return logger writing to logfile only """
+
+    log = logging.getLogger('bench_logging.%s.%s.%d' % (klass.__name__, level, async))
+    log.handlers = []
+    log.propagate = False
+    log.setLevel(level)
+
+    logobject = klass(log)
+    logobject.addLogFile(logfile, sethandler=False)
+    logobject.setAsync(async)
+    return logobject
+
+def bench(klass, level, async, nurls, nthreads, dirpath):
+    """ Return (seconds spent by logging threads, seconds to drain
+    the writer) for logging nurls URLs """
+
+    logfile = os.path.join(dirpath, 'bench.log')
+    log = make_logger(klass, logfile, level, async)
+    per_thread = nurls/nthreads
+
+    def run():
+        for i in range(per_thread):
+            log_url(log, i)
+
+    threads = [threading.Thread(target=run) for i in range(nthreads)]
+    t = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    tlog = time.time() - t
+    log.flush()
+    tdrain = time.time() - t - tlog
+
+    log.setAsync(False)
+    log.removeLogFile(logfile)
+    os.remove(logfile)
+    return tlog, tdrain
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark logging overhead per URL')
+    parser.add_argument('-n','--nurls', dest='nurls', type=int, default=20000, help='URLs to log for')
+    parser.add_argument('-t','--threads', dest='threads', type=int, default=4, help='Logging threads')
+    parser.add_argument('-r','--repeat', dest='repeat', type=int, default=3, help='Repeat count')
+    args = parser.parse_args()
+
+    dirpath = tempfile.mkdtemp(prefix='bench_logging')
+    modes = (('legacy', LegacyLoggerWrapper, False),
+             ('sync', logger.LoggerWrapper, False),
+             ('async', logger.LoggerWrapper, True))
+
+    print 'URLs: %d, log calls per URL: %d, threads: %d' % (args.nurls, calls_per_url, args.threads)
+    try:
+        for level in ('debug', 'info', 'error'):
+            for name, klass, async in modes:
+                best = None
+                for i in range(args.repeat):
+                    result = bench(klass, level.upper(), async, args.nurls, args.threads, dirpath)
+                    if best is None or result[0] < best[0]:
+                        best = result
+
+                tlog, tdrain = best
+                line = '%-5s %-6s: %.3fs (%.1f usec/URL)' % (level, name, tlog, 1e6*tlog/args.nurls)
+                if async:
+                    line += ', writer drained in %.3fs' % tdrain
+                print line
+    finally:
+        shutil.rmtree(dirpath)
@@ -0,0 +1,272 @@
+"""
+Local synthetic website for benchmarking the crawler offline.
+
+Serves a generated site of numbered HTML pages over HTTP/1.1 with
+keep-alive. The site graph and content are fully determined by the
+command line, so two runs with the same options serve the same site.
+
+Page n links to its children n*fanout+1 .. n*fanout+fanout (so every
+page is reachable from /) and to a few other random pages. Some of
+the links go through a 301 redirect and some go to a folder which
+robots.txt disallows. /sitemap.xml lists all pages, and pages are
+served with Last-Modified and ETag headers and answer conditional
+requests with 304.
+
+/_stats returns the request counters of the server as JSON.
+
+$ python synthsite.py --port 8000 --pages 2000 --fanout 8 --latency 20
+"""
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+import email.utils
+import SocketServer
+import BaseHTTPServer
+
+page_re = re.compile(r'/page/(\d+)\.html$')
+redirect_re = re.compile(r'/go/(\d+)$')
+private_re = re.compile(r'/private/(\d+)\.html$')
+
+# Filler text for page bodies
+words = ('crawler', 'accessibility', 'benchmark', 'synthetic', 'website', 'content',
+         'navigation', 'document', 'service', 'public', 'information', 'example')
+
+class SyntheticSite(object):
+    """ Generator of the pages of a synthetic site """
+
+    def __init__(self, npages=1000, fanout=8, ncross=2, page_size=16384, latency=0.0,
+                 latency_dist='fixed', redirects=0.05, private=0.01, seed=0):
+        self.npages = npages
+        # Child links per page
+        self.fanout = fanout
+        # Links per page to random pages
+        self.ncross = ncross
+        # Approximate size of a page in bytes
+        self.page_size = page_size
+        # Mean latency of a response in seconds and its distribution,
+        # one of fixed, uniform (0 to twice the mean) or exp
+        self.latency = latency
+        self.latency_dist = latency_dist
+        # Fraction of links through a redirect and to disallowed pages
+        self.redirects = redirects
+        self.private = private
+        self.seed = seed
+        # All pages last modified when the site is made
+        self.mtime = int(time.time())
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        # Request counters
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, key, value=1):
+        """ Increment a request counter """
+
+        with self.lock:
+            self.counts[key] += value
+
+    def get_latency(self):
+        """ Return latency in seconds of a response """
+
+        if self.latency <= 0:
+            return 0.0
+        if self.latency_dist == 'uniform':
+            return random.uniform(0, 2*self.latency)
+        elif self.latency_dist == 'exp':
+            return random.expovariate(1.0/self.latency)
+        return self.latency
+
+    def get_links(self, n):
+        """ Return the link paths of page n """
+
+        rnd = random.Random(self.seed*1000003 + n)
+        children = range(n*self.fanout + 1, min(n*self.fanout + self.fanout + 1, self.npages))
+        others = [rnd.randrange(self.npages) for i in range(self.ncross)]
+
+        links = []
+        for m in children + others:
+            x = rnd.random()
+            if x < self.private:
+                links.append('/private/%d.html' % m)
+            elif x < self.private + self.redirects:
+                links.append('/go/%d' % m)
+            else:
+                links.append('/page/%d.html' % m)
+
+        return links
+
+    def get_page(self, n):
+        """ Return the HTML of page n """
+
+        rnd = random.Random(self.seed*1000003 + n)
+        parts = ['<!DOCTYPE html>\n<html lang="en"><head><meta charset="utf-8">',
+                 '<title>Page %d</title></head><body>' % n,
+                 '<h1>Page %d</h1><ul>' % n]
+        parts += ['<li><a href="%s">Link %d</a></li>' % (link, i) for i, link in enumerate(self.get_links(n))]
+        parts.append('</ul>')
+
+        size = sum(map(len, parts))
+        while size < self.page_size:
+            para = '<p>%s</p>\n' % ' '.join(rnd.choice(words) for i in range(60))
+            parts.append(para)
+            size += len(para)
+
+        parts.append('</body></html>\n')
+        return ''.join(parts)
+
+    def get_robots(self, host):
+        """ Return robots.txt of the site """
+
+        return 'User-agent: *\nDisallow: /private/\n\nSitemap: http://%s/sitemap.xml\n' % host
+
+    def get_sitemap(self, host):
+        """ Return sitemap of the site listing all pages """
+
+        lastmod = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.mtime))
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+                 '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+        parts += ['<url><loc>http://%s/page/%d.html</loc><lastmod>%s</lastmod></url>\n' % (host, n, lastmod) \
+                  for n in range(self.npages)]
+        parts.append('</urlset>\n')
+        return ''.join(parts)
+
+class SyntheticSiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Request handler of the synthetic site """
+
+    # Keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body='', ctype='text/html', headers={}, count=True):
+        """ Send a response """
+
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+        if count:
+            self.server.site.count('status_%d' % code)
+            if self.command != 'HEAD':
+                self.server.site.count('bytes', len(body))
+
+    def not_modified(self, etag):
+        """ Whether a conditional request can be answered with 304 """
+
+        site = self.server.site
+        if self.headers.get('If-None-Match') == etag:
+            return True
+
+        since = self.headers.get('If-Modified-Since')
+        if since:
+            parsed = email.utils.parsedate_tz(since)
+            if parsed and email.utils.mktime_tz(parsed) >= site.mtime:
+                return True
+
+        return False
+
+    def do_GET(self):
+        site = self.server.site
+        path = self.path.split('?')[0]
+        host = self.headers.get('Host', 'localhost')
+
+        if path == '/_stats':
+            # Not counted itself
+            with site.lock:
+                counts = dict(site.counts)
+            return self.send(200, json.dumps(counts), ctype='application/json', count=False)
+
+        site.count('requests')
+        site.count(self.command)
+
+        delay = site.get_latency()
+        if delay:
+            time.sleep(delay)
+
+        m = page_re.match(path)
+        if path == '/' or (m and int(m.group(1)) < site.npages):
+            n = int(m.group(1)) if m else 0
+            etag = '"%d-%d-%d"' % (site.seed, site.mtime, n)
+            headers = {'Last-Modified': site.last_modified, 'ETag': etag}
+            if self.not_modified(etag):
+                return self.send(304, headers=headers)
+            site.count('pages')
+            return self.send(200, site.get_page(n), headers=headers)
+
+        m = redirect_re.match(path)
+        if m:
+            return self.send(301, headers={'Location': 'http://%s/page/%s.html' % (host, m.group(1))})
+
+        if private_re.match(path):
+            # Crawler should never get here
+            site.count('robots_violations')
+            return self.send(200, site.get_page(0))
+
+        if path == '/robots.txt':
+            return self.send(200, site.get_robots(host), ctype='text/plain')
+        elif path == '/sitemap.xml':
+            return self.send(200, site.get_sitemap(host), ctype='application/xml')
+
+        self.send(404, '<html><body>Not found</body></html>')
+
+    do_HEAD = do_GET
+
+class SyntheticSiteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded HTTP server of a synthetic site """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, site):
+        self.site = site
+        BaseHTTPServer.HTTPServer.__init__(self, address, SyntheticSiteHandler)
+
+def add_site_arguments(parser):
+    """ Add the options of the synthetic site to an argument parser """
+
+    parser.add_argument('--pages', dest='pages', type=int, default=1000, help='Number of pages')
+    parser.add_argument('--fanout', dest='fanout', type=int, default=8, help='Child links per page')
+    parser.add_argument('--cross', dest='cross', type=int, default=2, help='Links per page to random pages')
+    parser.add_argument('--page-size', dest='page_size', type=int, default=16384, help='Page size in bytes')
+    parser.add_argument('--latency', dest='latency', type=float, default=0, help='Mean latency in milliseconds')
+    parser.add_argument('--latency-dist', dest='latency_dist', default='fixed',
+                        choices=('fixed','uniform','exp'), help='Latency distribution')
+    parser.add_argument('--redirects', dest='redirects', type=float, default=0.05,
+                        help='Fraction of links which are redirects')
+    parser.add_argument('--private', dest='private', type=float, default=0.01,
+                        help='Fraction of links disallowed by robots.txt')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Random seed of the site')
+
+def make_site(args):
+    """ Return synthetic site for parsed arguments """
+
+    return SyntheticSite(npages=args.pages, fanout=args.fanout, ncross=args.cross,
+                         page_size=args.page_size, latency=args.latency/1000.0,
+                         latency_dist=args.latency_dist, redirects=args.redirects,
+                         private=args.private, seed=args.seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a synthetic website')
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', dest='port', type=int, default=8000, help='Port to listen on')
+    add_site_arguments(parser)
+    args = parser.parse_args()
+
+    server = SyntheticSiteServer((args.host, args.port), make_site(args))
+    print 'Serving %d pages at http://%s:%d/ ...' % (args.pages, args.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -7,6 +7,7 @@ class in different ways """
 import crawlerbase
 import hashlib
 import zlib
+import marshal
 import os
 import re
 import httplib
@@ -16,6 +17,7 @@ from eiii_crawler import urlhelper
 from eiii_crawler import utils
 
 from eiii_crawler.crawlerscoping import CrawlerScopingRules
+from eiii_crawler.crawlertiming import CrawlerTimings
 
 # Default logging object
 log = utils.get_default_logger()
@@ -43,7 +45,18 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
         # True -> Success
         # False -> Failed
         self.status = False
+        # Retrieved from cache as unchanged ?
+        self.from_cache = False
+        # Near duplicate of another page of the crawl ?
+        self.near_duplicate = False
+        # Last modified time (seconds since epoch) of the
+        # URL known beforehand, e.g from sitemaps.
+        self.lastmod = None
         self.content_type = 'text/html'
+        # HTTP status, reason and request headers of the download
+        self.status_code = None
+        self.reason = None
+        self.request_headers = {}
         
     def get_url_store_paths(self):
         """ Return a 3-tuple of paths to the URL data and header files
@@ -62,11 +75,43 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
         fhdr = fpath + '.hdr'
 
         return (fpath, fhdr, dirpath)
+
+    def write_children(self, url, child_urls):
+        """ Save the child URLs found by parsing the cached content of
+        the URL, as returned by the parser, next to the cache entry """
+
+        if not self.config.flag_storedata: return
+        
+        fpath, fhdr, dirpath = self.get_url_store_paths()
+        # Only of use along with cached content
+        if not os.path.isfile(fpath): return
+        
+        try:
+            open(fpath + '.children', 'wb').write(zlib.compress(marshal.dumps((url, list(child_urls)))))
+        except (IOError, OSError, ValueError), e:
+            log.error("Error in writing child URLs for URL",self.url)
+            log.error("\t",str(e))
+
+    def read_children(self):
+        """ Return the (URL, child URLs) saved by write_children for
+        the cached content of the URL, None if there are none """
+
+        fpath, fhdr, dirpath = self.get_url_store_paths()
+        fchildren = fpath + '.children'
+        
+        try:
+            # Saved for an older copy of the content ?
+            if os.path.getmtime(fchildren) < os.path.getmtime(fpath):
+                return None
+            return marshal.loads(zlib.decompress(open(fchildren, 'rb').read()))
+        except (IOError, OSError, ValueError, EOFError, TypeError, zlib.error), e:
+            return None
         
     def write_headers_and_data(self):
         """ Save the headers and data for the URL to the local store """
 
         if self.config.flag_storedata:
+            t = time.time()
             fpath, fhdr, dirpath = self.get_url_store_paths()
             # Write data to fpath
             # Write data ONLY if either last-modified or etag header is found.
@@ -93,6 +138,8 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
                 log.error("Error in writing URL data for URL",self.url)
                 log.error("\t",str(e))
 
+            CrawlerTimings.getInstance().record('cache_write', time.time() - t, self.url)
+
     def make_head_request(self, headers):
         """ Make a head request with header values (if-modified-since and/or etag).
         Return True if data is up-to-date and False otherwise. """
@@ -105,10 +152,12 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
             if etag != None and self.config.flag_use_etags:
                 req_header['if-none-match'] = etag
 
+            t = time.time()
             try:
                 # print 'Making a head request =>',self.url
                 fhead = urlhelper.head_url(self.url, headers=req_header,
                                            verify = self.config.flag_ssl_validate)
+                CrawlerTimings.getInstance().record('revalidate', time.time() - t, self.url)
 
                 # Status code is 304 ?
                 if fhead.status_code == 304:
@@ -121,6 +170,19 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
         # No lmt or etag or URL is not uptodate
         return False
         
+    def is_cache_fresh(self, fpath, fhdr):
+        """ Is the cached copy - the older of its content and
+        headers files - newer than the known last modified time
+        of the URL ? """
+
+        if self.lastmod == None:
+            return False
+
+        try:
+            return min(os.path.getmtime(fpath), os.path.getmtime(fhdr)) >= self.lastmod
+        except OSError:
+            return False
+        
     def get_headers_and_data(self):
         """ Try and retrieve data and headers from the cache. If cache is
         up-to-date, this sets the values and returns True. If cache is out-dated,
@@ -134,10 +196,14 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
             
             if fpath_f and fhdr_f:
                 try:
+                    t = time.time()
                     content = zlib.decompress(open(fpath).read())
                     headers = eval(zlib.decompress(open(fhdr).read()))
+                    CrawlerTimings.getInstance().record('cache_read', time.time() - t, self.url)
 
-                    if self.make_head_request(headers):
+                    # Skip the HEAD request if the URL is known to
+                    # be unchanged since it was cached
+                    if self.is_cache_fresh(fpath, fhdr) or self.make_head_request(headers):
                         # Update URL from cache
                         self.url = self.headers.get('url', self.url)
                         
@@ -147,6 +213,7 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
                         self.headers = headers
 
                         self.content_type =  urlhelper.get_content_type(self.url, self.headers)
+                        self.from_cache = True
                         
                         eventr = crawlerbase.CrawlerEventRegistry.getInstance()                 
                         # Raise the event for retrieving URL from cache
@@ -257,17 +324,25 @@ class CachingUrlData(crawlerbase.CrawlerUrlData):
             # Satisfied already through cache or fake mime-types
             return ret
 
+        timings = CrawlerTimings.getInstance()
+        
         try:
             log.debug("Waiting for URL",self.url,"...")
-            freq = urlhelper.get_url(self.url, headers = self.build_headers(),
+            t = time.time()
+            self.request_headers = self.build_headers()
+            freq = urlhelper.get_url(self.url, headers = self.request_headers,
                                      content_types=self.config.client_mimetypes + self.config.client_extended_mimetypes,
                                      max_size = self.config.site_maxrequestsize*1024*1024,
                                      verify = self.config.flag_ssl_validate
                                      )
             log.debug("Downloaded URL",self.url,"...")          
-
+            # The response body is read only now
+            timings.record('connect_ttfb', time.time() - t, self.url)
+            t = time.time()
             self.content = freq.content
+            timings.record('transfer', time.time() - t, self.url)
             self.headers = freq.headers
+            self.status_code, self.reason = freq.status_code, freq.reason
 
             # Initialize refresh url
             mod_url = refresh_url = self.url
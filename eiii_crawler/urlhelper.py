@@ -18,6 +18,7 @@ import re
 import sgmlop
 
 from eiii_crawler import urlnorm
+from eiii_crawler.crawlertransport import get_transport
 import eiii_crawler.utils as utils
 from bs4 import BeautifulSoup
 
@@ -107,9 +108,10 @@ def fetch(url, *exceptions, **headers):
         if proxy:
             proxies = {'http' : proxy, 'https' : proxy}
             # Add a timeout of 15s
-            yield requests.get(url, headers=headers, proxies=proxies, verify=verify, timeout=15, stream=True)
+            yield get_transport().request('GET', url, headers, proxies=proxies, verify=verify, timeout=15,
+                                          stream=True)
         else:
-            yield requests.get(url, headers=headers, verify=verify, timeout=15, stream=True)          
+            yield get_transport().request('GET', url, headers, verify=verify, timeout=15, stream=True)
         # Catch a bunch of network errors - courtesy havestman
     except exceptions, e:
         raise FetchUrlException(e)
@@ -128,9 +130,9 @@ def fetch_quick(url, *exceptions, **headers):
         if proxy:
             proxies = {'http' : proxy, 'https' : proxy}
             # Add a timeout of 15s
-            yield requests.get(url, headers=headers, proxies=proxies, verify=verify, timeout=15)
+            yield get_transport().request('GET', url, headers, proxies=proxies, verify=verify, timeout=15)
         else:
-            yield requests.get(url, headers=headers, verify=verify, timeout=15)          
+            yield get_transport().request('GET', url, headers, verify=verify, timeout=15)
         # Catch a bunch of network errors - courtesy havestman
     except exceptions, e:
         raise FetchUrlException(e)
@@ -143,8 +145,8 @@ def head(url, *exceptions, **headers):
     try:
         # SSL cert verify
         verify = headers.get('verify', False)               
-        yield requests.head(url, headers=headers, allow_redirects=True, timeout=15,
-                            verify=verify)
+        yield get_transport().request('HEAD', url, headers, allow_redirects=True, timeout=15,
+                                      verify=verify)
         # Catch a bunch of network errors - courtesy havestman
     except exceptions, e:
         raise FetchUrlException(e)
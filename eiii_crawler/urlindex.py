@@ -0,0 +1,230 @@
+""" Compact storage of the URLs seen by a crawl, for the crawl stats.
+
+Every URL is kept once, in a URLIndex which gives it an integer id,
+and content-types get small integer codes. Sets of URLs are bitmaps
+of URL ids and the URL graph keeps an array of integer ids of
+(URL, content-type) entries per parent URL. The URLs are turned back
+into strings only when the stats are written.
+"""
+
+import array
+import bisect
+import threading
+
+class InternTable(object):
+    """ Table giving consecutive integer ids to values """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        self.lock = threading.Lock()
+
+    def intern(self, value):
+        """ Return id of a value, adding it if it is new """
+
+        try:
+            return self.ids[value]
+        except KeyError:
+            with self.lock:
+                id = self.ids.get(value)
+                if id == None:
+                    id = len(self.values)
+                    # Value first, so that an id is never ahead of it
+                    self.values.append(value)
+                    self.ids[value] = id
+                return id
+
+    def get(self, value):
+        """ Return id of a value, None if it is not in the table """
+
+        return self.ids.get(value)
+
+    def __getitem__(self, id):
+        return self.values[id]
+
+    def __len__(self):
+        return len(self.values)
+
+class URLIndex(object):
+    """ URLs and content-types of a crawl with their ids """
+
+    def __init__(self):
+        self.urls = InternTable()
+        self.ctypes = InternTable()
+        # (URL id, content-type code) pairs of graph entries
+        self.entries = InternTable()
+
+    def entry_id(self, url, ctype):
+        """ Return id of a (URL, content-type) entry """
+
+        return self.entries.intern((self.urls.intern(url), self.ctypes.intern(ctype)))
+
+    def find_entry(self, url, ctype):
+        """ Return id of a (URL, content-type) entry, None if
+        there is no such entry """
+
+        url_id, code = self.urls.get(url), self.ctypes.get(ctype)
+        if url_id == None or code == None:
+            return None
+        return self.entries.get((url_id, code))
+
+    def get_entry(self, id):
+        """ Return (URL, content-type) of an entry id """
+
+        url_id, code = self.entries[id]
+        return (self.urls[url_id], self.ctypes[code])
+
+class URLSet(object):
+    """ Set of URLs of an index, as a bitmap of URL ids """
+
+    def __init__(self, index):
+        self.index = index
+        self.bits = bytearray()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, url):
+        """ Add a URL """
+
+        id = self.index.urls.intern(url)
+        pos, bit = id >> 3, 1 << (id & 7)
+
+        with self.lock:
+            if pos >= len(self.bits):
+                # Grow by doubling
+                self.bits.extend(bytearray(max(pos + 1 - len(self.bits), len(self.bits))))
+            if not self.bits[pos] & bit:
+                self.bits[pos] |= bit
+                self.count += 1
+
+    def __contains__(self, url):
+        id = self.index.urls.get(url)
+        if id == None or (id >> 3) >= len(self.bits):
+            return False
+        return bool(self.bits[id >> 3] & (1 << (id & 7)))
+
+    def __iter__(self):
+        """ Iterate over the URLs in the order they were first seen """
+
+        urls = self.index.urls
+        for pos, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield urls[pos*8 + bit]
+
+    def __len__(self):
+        return self.count
+
+class URLPairSet(object):
+    """ Set of (URL, parent URL) pairs of an index. The parent
+    URL can be None """
+
+    def __init__(self, index):
+        self.index = index
+        # Pairs as single integers - URL id shifted above parent id
+        self.keys = set()
+
+    def add(self, url, parent_url):
+        """ Add a pair """
+
+        urls = self.index.urls
+        parent_id = urls.intern(parent_url) + 1 if parent_url != None else 0
+        self.keys.add((urls.intern(url) << 32) | parent_id)
+
+    def __iter__(self):
+        urls = self.index.urls
+        for key in list(self.keys):
+            parent_id = key & 0xffffffff
+            yield (urls[key >> 32], urls[parent_id - 1] if parent_id else None)
+
+    def __len__(self):
+        return len(self.keys)
+
+class URLGraph(object):
+    """ Graph of parent URLs to their (URL, content-type) children,
+    as sorted arrays of entry ids keyed on URL id of parent, so that
+    a child is looked up by binary search """
+
+    def __init__(self, index):
+        self.index = index
+        self.children = {}
+
+    def add(self, parent_url, url, ctype):
+        """ Add a child to a parent URL """
+
+        parent_id = self.index.urls.intern(parent_url)
+        entry = self.index.entry_id(url, ctype)
+
+        children = self.children.get(parent_id)
+        if children == None:
+            children = self.children.setdefault(parent_id, array.array('l'))
+
+        pos = bisect.bisect_left(children, entry)
+        if pos == len(children) or children[pos] != entry:
+            children.insert(pos, entry)
+
+    def has(self, parent_url, url, ctype):
+        """ Whether a parent URL has a child """
+
+        parent_id = self.index.urls.get(parent_url)
+        entry = self.index.find_entry(url, ctype)
+        if parent_id == None or entry == None:
+            return False
+
+        children = self.children.get(parent_id, ())
+        pos = bisect.bisect_left(children, entry)
+        return pos < len(children) and children[pos] == entry
+
+    def reset(self, parent_url):
+        """ Make a parent URL with no children """
+
+        self.children[self.index.urls.intern(parent_url)] = array.array('l')
+
+    def to_dict(self):
+        """ Return graph as a dictionary of parent URLs
+        to sets of (URL, content-type) children """
+
+        urls, get_entry = self.index.urls, self.index.get_entry
+        return dict((urls[parent_id], set(get_entry(entry) for entry in children)) \
+                    for parent_id, children in self.children.items())
+
+    def __len__(self):
+        return len(self.children)
+
+if __name__ == "__main__":
+    index = URLIndex()
+    urls = URLSet(index)
+    for url in ('http://www.foo.com/', 'http://www.foo.com/a', 'http://www.foo.com/', 'http://www.foo.com/b'):
+        urls.add(url)
+    assert len(urls) == 3 and list(urls) == ['http://www.foo.com/', 'http://www.foo.com/a', 'http://www.foo.com/b']
+    assert 'http://www.foo.com/a' in urls and 'http://www.foo.com/c' not in urls
+
+    # Bitmaps of different sets of the same index
+    other = URLSet(index)
+    other.add('http://www.foo.com/b')
+    assert list(other) == ['http://www.foo.com/b'] and 'http://www.foo.com/' not in other
+
+    errors = URLPairSet(index)
+    errors.add('http://www.foo.com/x', 'http://www.foo.com/')
+    errors.add('http://www.foo.com/', None)
+    errors.add('http://www.foo.com/', None)
+    assert sorted(errors) == [('http://www.foo.com/', None), ('http://www.foo.com/x', 'http://www.foo.com/')]
+
+    graph = URLGraph(index)
+    graph.add('http://www.foo.com/', 'http://www.foo.com/a', 'text/html')
+    graph.add('http://www.foo.com/', 'http://www.foo.com/a.pdf', 'application/pdf')
+    graph.add('http://www.foo.com/', 'http://www.foo.com/a.pdf', 'application/pdf')
+    graph.add('http://www.foo.com/b', 'http://www.foo.com/a', 'text/html')
+    graph.reset('http://www.foo.com/b')
+    assert graph.has('http://www.foo.com/', 'http://www.foo.com/a', 'text/html')
+    assert len(graph.children[index.urls.get('http://www.foo.com/')]) == 2
+    assert not graph.has('http://www.foo.com/', 'http://www.foo.com/a', 'application/pdf')
+    assert not graph.has('http://www.foo.com/b', 'http://www.foo.com/a', 'text/html')
+    assert graph.to_dict() == {'http://www.foo.com/': set([('http://www.foo.com/a', 'text/html'),
+                                                           ('http://www.foo.com/a.pdf', 'application/pdf')]),
+                               'http://www.foo.com/b': set()}
+    # Every URL is kept once
+    assert len(index.urls) == 5 and len(index.ctypes) == 2
+
+    print 'All tests passed.'
@@ -17,6 +17,7 @@ import threading
 from contextlib import contextmanager
 from types import StringTypes
 from eiii_crawler import logger
+from eiii_crawler import crawlercontext
 
 __logprefix__ = 'logs'
 
@@ -208,6 +209,21 @@ class SingletonMeta(type):
         """ Return an instance """
         return cls(*args, **kwargs)
 
+class ContextSingletonMeta(SingletonMeta):
+    """ A type for classes which are Singletons in each crawl
+    context - see crawlercontext. Outside of any crawl context,
+    these are regular Singletons """
+
+    def __call__(cls, *args, **kwargs):
+        context = crawlercontext.get_context()
+        if context is None:
+            return super(ContextSingletonMeta, cls).__call__(*args, **kwargs)
+
+        instance = context.instances.get(cls)
+        if instance is None:
+            instance = context.instances[cls] = type.__call__(cls, *args, **kwargs)
+        return instance
+
 class MyEncoder(json.JSONEncoder):
  
     def default(self, obj):
@@ -347,7 +363,9 @@ def convert_config(crawler_rules):
                     'min-crawl-delay': 'time_sleeptime',
                     'loglevel': 'loglevel',
                     'flag_urls_case_sensitive': 'urls_case_sensitive',
-                    'sslvalidate': 'flag_ssl_validate'
+                    'sslvalidate': 'flag_ssl_validate',
+                    'profile-rate': 'profile_rate',
+                    'retain-pages-ttl': 'pages_ttl'
                     }
 
     other_keys = {'max-pages': 'url_limits',
@@ -378,6 +396,20 @@ def convert_config(crawler_rules):
 
     # ignorerobots: true, metarobots: false
     config_dict['flag_metarobots'] = config_dict['flag_x_robots'] = not config_dict['flag_ignorerobots']
+
+    # Results are streamed only if the client asks for it, since
+    # fragments are kept by the server till the client fetches them.
+    config_dict['flag_stream_results'] = bool(crawler_rules.get('stream-results', False))
+    # Incremental recrawl using the URL graph of the last crawl
+    config_dict['flag_incremental'] = bool(crawler_rules.get('incremental', False))
+    # Seeding from sitemaps
+    config_dict['flag_sitemaps'] = bool(crawler_rules.get('sitemaps', False))
+    # Sampling profiler
+    config_dict['flag_profile'] = bool(crawler_rules.get('profile', False))
+    # Writing of WARC files
+    config_dict['flag_warc'] = bool(crawler_rules.get('warc', False))
+    # Keeping pages for the client
+    config_dict['flag_retain_pages'] = bool(crawler_rules.get('retain-pages', False))
     
     try:
         config_dict['url_filter'] = list(config_dict['url_filter'])
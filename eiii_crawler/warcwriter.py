@@ -0,0 +1,283 @@
+""" Streaming WARC writer for content downloaded by the crawler
+
+Writes a request and a response record for every downloaded URL to
+WARC 1.0 files, so that downstream tools can use the content of a crawl
+without fetching it again. Every record is a gzip member of its own, so
+that a record can be read by seeking to its offset. Files are rotated
+when they reach a maximum size and a CDX index of the response records
+is written along with them.
+
+Records are written by a background thread - workers only put the
+downloaded data to a queue and never wait for the disk.
+"""
+
+import os
+import zlib
+import uuid
+import time
+import Queue
+import base64
+import hashlib
+import threading
+import urlparse
+
+from eiii_crawler import utils
+
+# Default logging object
+log = utils.get_default_logger()
+
+# Header of CDX files - massaged URL, date, original URL, mime-type,
+# status code, digest, redirect, meta tags, compressed record size,
+# offset, file name
+cdx_header = ' CDX N b a m s k r M S V g\n'
+
+# Response headers which do not apply to the content as it is stored,
+# which is decoded already.
+dropped_headers = ('content-encoding', 'transfer-encoding', 'content-length')
+# Keys put in request headers by urlhelper
+internal_headers = ('proxy', 'verify')
+
+def warc_date(timestamp):
+    """ Return WARC-Date value of a timestamp """
+
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+def sha1_digest(data):
+    """ Return digest of data in the form used by WARC and CDX """
+
+    return 'sha1:' + base64.b32encode(hashlib.sha1(data).digest())
+
+def surt(url):
+    """ Return sort-friendly form of a URL for CDX files,
+    e.g www.foo.com/a?x=1 => com,foo)/a?x=1 """
+
+    urlp = urlparse.urlparse(url)
+    host = urlp.netloc.lower().split('@')[-1]
+    if host.startswith('www.'):
+        host = host[4:]
+    if host.endswith(':80') or host.endswith(':443'):
+        host = host.rsplit(':', 1)[0]
+
+    key = ','.join(reversed(host.split('.'))) + ')' + (urlp.path or '/').lower()
+    if urlp.query:
+        key += '?' + urlp.query.lower()
+    return key
+
+def make_record(warc_type, headers, block):
+    """ Return a WARC record """
+
+    lines = ['WARC/1.0', 'WARC-Type: ' + warc_type]
+    lines += ['%s: %s' % item for item in headers]
+    lines.append('Content-Length: %d' % len(block))
+    return '\r\n'.join(lines) + '\r\n\r\n' + block + '\r\n\r\n'
+
+def gzip_member(data):
+    """ Return data compressed as a gzip member """
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def encode(value):
+    """ Return a header value as a byte string """
+
+    if type(value) is unicode:
+        return value.encode('utf-8')
+    return str(value)
+
+class WarcWriter(object):
+    """ Writer of WARC files of a crawl """
+
+    def __init__(self, dirpath, prefix, max_size=1024*1024*1024, info={}):
+        self.dirpath = os.path.expanduser(dirpath)
+        # WARC files are named <prefix>-<number>.warc.gz
+        self.prefix = prefix
+        # Size in bytes at which a new file is started
+        self.max_size = max_size
+        # Fields of the warcinfo record of each file
+        self.info = info
+        self.queue = Queue.Queue()
+        self.thread = None
+        # Current file, its name and number
+        self.fwarc = None
+        self.fname = None
+        self.nfile = 0
+        self.warcinfo_id = None
+        # CDX lines written
+        self.cdx_lines = []
+        self.nrecords = 0
+
+    def start(self):
+        """ Start the writer thread """
+
+        with utils.ignore(): os.makedirs(self.dirpath)
+        self.thread = threading.Thread(target=self.run, name='WarcWriter')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def write(self, url, status_code, reason, headers, content, request_headers):
+        """ Queue the request and response of a downloaded URL for writing """
+
+        self.queue.put((url, status_code, reason, dict(headers), content,
+                        dict(request_headers), time.time()))
+
+    def close(self):
+        """ Write the queued records, close the files and write the index """
+
+        if self.thread == None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        """ Writer thread loop """
+
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+
+            try:
+                self.write_records(*item)
+            except Exception, e:
+                log.error('Error writing WARC records for',item[0],'=>',e)
+
+        if self.fwarc != None:
+            self.fwarc.close()
+            self.fwarc = None
+
+        self.write_index()
+        log.info('Wrote',self.nrecords,'response records to',self.nfile,'WARC files in',self.dirpath)
+
+    def open_file(self):
+        """ Start a new WARC file with a warcinfo record """
+
+        if self.fwarc != None:
+            self.fwarc.close()
+
+        self.nfile += 1
+        self.fname = '%s-%05d.warc.gz' % (self.prefix, self.nfile)
+        self.fwarc = open(os.path.join(self.dirpath, self.fname), 'wb')
+
+        self.warcinfo_id = '<urn:uuid:%s>' % uuid.uuid4()
+        block = ''.join('%s: %s\r\n' % (key, encode(value)) for key, value in sorted(self.info.items()))
+        self.append(make_record('warcinfo', [('WARC-Date', warc_date(time.time())),
+                                             ('WARC-Record-ID', self.warcinfo_id),
+                                             ('WARC-Filename', self.fname),
+                                             ('Content-Type', 'application/warc-fields')], block))
+
+    def append(self, record):
+        """ Append a record to the current file and
+        return its (offset, compressed size) """
+
+        data = gzip_member(record)
+        offset = self.fwarc.tell()
+        self.fwarc.write(data)
+        return offset, len(data)
+
+    def write_records(self, url, status_code, reason, headers, content, request_headers, timestamp):
+        """ Write request and response records of a URL """
+
+        if self.fwarc == None or self.fwarc.tell() >= self.max_size:
+            self.open_file()
+
+        url = encode(url)
+        date = warc_date(timestamp)
+        urlp = urlparse.urlparse(url)
+        path = urlp.path or '/'
+        if urlp.query:
+            path += '?' + urlp.query
+
+        # Request as sent - fields of the request are only known
+        # as given to requests.
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % urlp.netloc]
+        lines += ['%s: %s' % (key, encode(value)) for key, value in sorted(request_headers.items()) \
+                  if key.lower() not in internal_headers]
+        request = '\r\n'.join(lines) + '\r\n\r\n'
+
+        # Response with the decoded content
+        lines = ['HTTP/1.1 %d %s' % (status_code, encode(reason or ''))]
+        lines += ['%s: %s' % (key, encode(value)) for key, value in sorted(headers.items()) \
+                  if key.lower() not in dropped_headers]
+        lines.append('Content-Length: %d' % len(content))
+        response = '\r\n'.join(lines) + '\r\n\r\n' + content
+
+        response_id = '<urn:uuid:%s>' % uuid.uuid4()
+        payload_digest = sha1_digest(content)
+        offset, size = self.append(make_record('response', [('WARC-Date', date),
+                                                            ('WARC-Record-ID', response_id),
+                                                            ('WARC-Warcinfo-ID', self.warcinfo_id),
+                                                            ('WARC-Target-URI', url),
+                                                            ('WARC-Payload-Digest', payload_digest),
+                                                            ('WARC-Block-Digest', sha1_digest(response)),
+                                                            ('Content-Type', 'application/http; msgtype=response')],
+                                               response))
+        self.append(make_record('request', [('WARC-Date', date),
+                                            ('WARC-Record-ID', '<urn:uuid:%s>' % uuid.uuid4()),
+                                            ('WARC-Warcinfo-ID', self.warcinfo_id),
+                                            ('WARC-Target-URI', url),
+                                            ('WARC-Concurrent-To', response_id),
+                                            ('WARC-Block-Digest', sha1_digest(request)),
+                                            ('Content-Type', 'application/http; msgtype=request')],
+                                request))
+
+        lowered = dict((key.lower(), value) for key, value in headers.items())
+        mimetype = encode(lowered.get('content-type', '-')).split(';')[0].strip()
+        location = encode(lowered.get('location', '-'))
+        self.cdx_lines.append(' '.join((surt(url), time.strftime('%Y%m%d%H%M%S', time.gmtime(timestamp)),
+                                        url, mimetype or '-', str(status_code), payload_digest[5:],
+                                        location, '-', str(size), str(offset), self.fname)))
+        self.nrecords += 1
+
+    def write_index(self):
+        """ Write the sorted CDX index of the response records """
+
+        if not self.cdx_lines:
+            return
+
+        fpath = os.path.join(self.dirpath, self.prefix + '.cdx')
+        self.cdx_lines.sort()
+        with open(fpath, 'wb') as f:
+            f.write(cdx_header)
+            for line in self.cdx_lines:
+                f.write(line + '\n')
+
+if __name__ == "__main__":
+    import gzip
+    import shutil
+    import tempfile
+
+    dirpath = tempfile.mkdtemp()
+    try:
+        writer = WarcWriter(dirpath, 'test', max_size=1, info={'software': 'EIII Web Crawler'})
+        writer.start()
+        for i in range(3):
+            writer.write('http://www.foo.com/page%d.html' % i, 200, 'OK',
+                         {'Content-Type': 'text/html; charset=utf-8', 'Content-Encoding': 'gzip'},
+                         '<html>%s</html>' % ('x'*2000), {'user-agent': 'test', 'verify': True})
+        writer.close()
+
+        # Rotated at the maximum size
+        assert sorted(os.listdir(dirpath)) == ['test-00001.warc.gz', 'test-00002.warc.gz',
+                                               'test-00003.warc.gz', 'test.cdx']
+        lines = open(os.path.join(dirpath, 'test.cdx')).read().splitlines()
+        assert lines[0] == cdx_header.rstrip('\n') and len(lines) == 4
+        key, date, url, mimetype, status, digest, redirect, meta, size, offset, fname = lines[2].split()
+        assert key == 'com,foo)/page1.html' and mimetype == 'text/html' and status == '200'
+
+        # Random access to a record through the index
+        f = open(os.path.join(dirpath, fname), 'rb')
+        f.seek(int(offset))
+        record = zlib.decompress(f.read(int(size)), 16 + zlib.MAX_WBITS)
+        assert record.startswith('WARC/1.0\r\nWARC-Type: response\r\n')
+        assert 'WARC-Target-URI: http://www.foo.com/page1.html' in record
+        assert 'Content-Encoding' not in record and 'Content-Length: 2013\r\n\r\n<html>' in record
+
+        # A reader of the whole file sees all records
+        records = gzip.open(os.path.join(dirpath, 'test-00001.warc.gz')).read()
+        assert records.count('WARC/1.0\r\n') == 3 and 'verify' not in records
+    finally:
+        shutil.rmtree(dirpath)
+
+    print 'All tests passed.'
@@ -46,8 +46,8 @@ import sys, os
 import re
 import urllib2
 import urlparse
+import threading
 
-from pyparsing import *
 from jsdom import *
 
 # Javscript string methods
@@ -63,21 +63,29 @@ class HTMLJSParser(object):
    embedded in HTML. The parser only performs extraction, and no
    Javascript tokenizing """
 
-   script_content = Literal("<") + Literal("script") + ZeroOrMore(Word(alphas) + Literal("=") + Word(alphanums + "."+ "/"  + '"' + "'")) + Literal(">") + SkipTo(Literal("</") + Literal("script") + Literal(">"), True)
-
-   comment_open = Literal("<!--") + SkipTo("\n", include=True)
-   comment_close = Literal("//") + ZeroOrMore(Word(alphanums)) + Literal("-->")
-
-   brace_open = Literal("{")
-   brace_close = Literal("}")
+   # Script blocks are extracted with a hand-written scanner equivalent
+   # to this pyparsing grammar, which was used earlier.
+   # Literal("<") + Literal("script") + ZeroOrMore(Word(alphas) + Literal("=") +
+   # Word(alphanums + "./\"'")) + Literal(">") + SkipTo(Literal("</") +
+   # Literal("script") + Literal(">"), True)
+   # Like pyparsing, whitespace is allowed between the tokens and positions
+   # are relative to the document with tabs expanded.
+   whitespace_re = re.compile(r'[ \n\t\r]*')
+   attr_name_re = re.compile(r'[a-zA-Z]+')
+   attr_value_re = re.compile(r'[a-zA-Z0-9\./"\']+')
+   script_close_re = re.compile(r'</[ \n\t\r]*script[ \n\t\r]*>')
+   
+   # HTML comments around JS - '<!--' up to the end of line and '// -->'.
+   comment_open_re = re.compile(r'<!--(?=([ \n\t\r]*))\1[^\n]*\n')
+   comment_close_re = re.compile(r'//(?:[ \n\t\r]*[a-zA-Z0-9]+(?![a-zA-Z0-9]))*[ \n\t\r]*-->')
    
    syntaxendre = re.compile(r';$')
 
+   # Cheap locator for prefiltering - JS primitives which can change
+   # the location or the content of the document.
+   primitives_re = re.compile(r'location|document\.write', re.IGNORECASE)
+
    def __init__(self):
-      self.comment_open.setParseAction(replaceWith(''))
-      self.comment_close.setParseAction(replaceWith(''))
-      self.brace_open.setParseAction(replaceWith(''))
-      self.brace_close.setParseAction(replaceWith(''))            
       self.reset()
        
    def reset(self):
@@ -99,25 +107,92 @@ class HTMLJSParser(object):
             # This string is enclosed in quotes, so skip it
             # return ""
       
-   def feed(self, data):
+   def feed(self, data, prefilter=False):
+       """ Feed HTML data. If prefilter is True, only script blocks
+       which refer to the location or write to the document are
+       extracted """
 
        self.rawdata = self.rawdata + data
        # Extract javascript content
-       self.extract()
-    
+       self.extract(prefilter)
+
+   def match_start_tag(self, data, pos):
+      """ Return the end position of the script start tag
+      at pos or -1 if there is none """
+
+      skip = self.whitespace_re.match
+      pos = skip(data, pos + 1).end()
+      if not data.startswith('script', pos):
+         return -1
+      pos += 6
+
+      # Attributes - name=value
+      while True:
+         apos = skip(data, pos).end()
+         m = self.attr_name_re.match(data, apos)
+         if not m: break
+         apos = skip(data, m.end()).end()
+         if not data.startswith('=', apos): break
+         m = self.attr_value_re.match(data, skip(data, apos + 1).end())
+         if not m: break
+         pos = m.end()
+
+      pos = skip(data, pos).end()
+      if not data.startswith('>', pos):
+         return -1
+      return pos + 1
+   
+   def scan(self, data):
+      """ Scan the data for script blocks and yield 3-tuples of
+      (content, start, end) in one pass over the data """
+
+      # Last end tag found and position from where it was searched.
+      # An end tag is searched again only for start tags after it,
+      # so the data is not scanned again for every script block which
+      # does not have an end tag.
+      close, close_from = None, -1
+      pos = data.find('<')
+      
+      while pos != -1:
+         tag_end = self.match_start_tag(data, pos)
+         if tag_end == -1:
+            pos = data.find('<', pos + 1)
+            continue
+
+         content_start = self.whitespace_re.match(data, tag_end).end()
+         if close_from == -1 or content_start < close_from or \
+                (close is not None and content_start > close.start()):
+            close_from, close = content_start, None
+            cpos = data.find('</', content_start)
+            while cpos != -1:
+               close = self.script_close_re.match(data, cpos)
+               if close: break
+               cpos = data.find('</', cpos + 1)
+               
+         if close is None:
+            # No end tag after this
+            pos = data.find('<', pos + 1)
+            continue
+
+         yield (data[content_start:close.start()], pos, close.end())
+         pos = data.find('<', close.end())
+
    # Internal - parse the HTML to extract Javascript
-   def extract(self):
+   def extract(self, prefilter=False):
 
       rawdata = self.rawdata
-      for match in self.script_content.scanString(rawdata):
-         if not match: continue
-         if len(match) != 3: continue
-         if len(match[0])==0: continue
-         if len(match[0][-1])==0: continue         
-         statement = match[0][-1][0]
+      if prefilter and not self.primitives_re.search(rawdata):
+         # Nothing to do
+         return
+      
+      for statement, start, end in self.scan(rawdata.expandtabs()):
+         # Prefilter - only blocks which can change the location
+         # or the document.
+         if prefilter and not self.primitives_re.search(statement):
+            continue
          # print 'Statement=>',statement
          self.statements.append(statement.strip())
-         self.positions.append((match[-2], match[-1]))
+         self.positions.append((start, end))
 
       # print 'Length=>',len(self.statements)
 
@@ -134,8 +209,8 @@ class HTMLJSParser(object):
          # print 'Statement =>',s
          # Remove any braces
          # UPDATE: We need the { and } for detecting functions so commenting this.
-         s = self.comment_open.transformString(s)
-         s = self.comment_close.transformString(s)         
+         s = self.comment_open_re.sub('', s)
+         s = self.comment_close_re.sub('', s)
 
          # Clean up any syntax end chars
          s = self.syntaxendre.sub('', s).strip()
@@ -231,6 +306,10 @@ class JSParser(object):
    # Maximum number of lines in a function for a redirection
    # NOTE - This is totally arbitrary and is not really a good workaround!
    MAXJSLINES = 50
+   # Only extract script blocks which can change the location or the
+   # document. Other blocks have no effect on the result of parsing,
+   # so this only skips work.
+   prefilter = True
     
    def __init__(self):
       self._nflag = False
@@ -311,7 +390,7 @@ class JSParser(object):
       # print 'Onload handler=>',self.onload_handler
       # Create a jsparser to extract content inside <script>...</script>
       # print 'Extracting js content...'
-      self.parser.feed(data)
+      self.parser.feed(data, prefilter=self.prefilter)
       self.js = self.parser.statements[:]
       
       # print 'Extracted js content.'
@@ -796,6 +875,18 @@ class JSParser(object):
 
       return [item for item in self.parser.statements if item.strip()]
    
+# Parsers for re-use, one per thread
+_parsers = threading.local()
+
+def get_parser():
+   """ Return the JSParser instance of the calling thread. The instance
+   is re-used across calls, so parse one page at a time with it """
+
+   parser = getattr(_parsers, 'parser', None)
+   if parser is None:
+      parser = _parsers.parser = JSParser()
+   return parser
+
 def localtests():
     print 'Doing local tests...'
     